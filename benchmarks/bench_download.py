@@ -0,0 +1,144 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+"""Times get-cloudify's _download_file against a local HTTP server.
+
+The server supports range requests and ETags, so that segmented downloads
+and revalidating a cached copy can be timed as well as plain downloads.
+Nothing leaves the machine, so this measures the script's own overhead
+(copying, hashing, caching) rather than the network.
+
+Usage: python benchmarks/bench_download.py [iterations]
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import importlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+get_cloudify = importlib.import_module('get-cloudify')
+
+MB = 1024 * 1024
+FILES = {
+    '/small.tar.gz': 1 * MB,
+    '/large.tar.gz': 32 * MB,
+}
+# (name, path, segments, cached)
+CASES = [
+    ('small', '/small.tar.gz', 1, False),
+    ('large', '/large.tar.gz', 1, False),
+    ('segmented', '/large.tar.gz', 4, False),
+    ('revalidated', '/large.tar.gz', 1, True),
+]
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        content = self.server.files.get(self.path)
+        if content is None:
+            return self.send_error(404)
+        etag = '"{0}"'.format(self.server.etags[self.path])
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start, end = 0, len(content) - 1
+        ranges = self.headers.getheader('Range')
+        if ranges:
+            first, _, last = ranges.split('=', 1)[1].partition('-')
+            start, end = int(first), int(last) if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Segmented downloads close the first response after its headers,
+        # which breaks the pipe it is being written to
+        pass
+
+
+def start_server():
+    server = _Server(('127.0.0.1', 0), _RequestHandler)
+    server.files = dict((path, os.urandom(size))
+                        for path, size in FILES.items())
+    server.etags = dict((path, hashlib.sha256(content).hexdigest())
+                        for path, content in server.files.items())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def measure(iterations=5):
+    """Returns the mean duration of a download, in seconds, of each case."""
+    get_cloudify.logger.setLevel(logging.ERROR)
+    server = start_server()
+    tempdir = tempfile.mkdtemp()
+    try:
+        results = {}
+        for name, path, segments, cached in CASES:
+            url = 'http://127.0.0.1:{0}{1}'.format(
+                server.server_address[1], path)
+            destination = os.path.join(tempdir, name)
+            cache = get_cloudify._DownloadCache(
+                os.path.join(tempdir, 'cache')) if cached else None
+            if cached:
+                get_cloudify._download_file(url, destination, cache)
+            start = time.time()
+            for _ in range(iterations):
+                get_cloudify._download_file(url, destination, cache,
+                                            segments=segments)
+            results[name] = (time.time() - start) / iterations
+        return results
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tempdir)
+
+
+def main(iterations=5):
+    results = measure(iterations)
+    print('{0:<12} {1:>8} {2:>12} {3:>10}'.format(
+        'case', 'size', 'per call (s)', 'MB/s'))
+    for name, path, _, _ in CASES:
+        size = FILES[path]
+        print('{0:<12} {1:>6}MB {2:>12.4f} {3:>10.1f}'.format(
+            name, size / MB, results[name], size / MB / results[name]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,60 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+"""Times get-cloudify's parse_args, which builds the whole argument parser
+on every call, for a few typical command lines.
+
+Usage: python benchmarks/bench_parse_args.py [iterations]
+"""
+import importlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+get_cloudify = importlib.import_module('get-cloudify')
+
+COMMAND_LINES = [
+    ('defaults', []),
+    ('virtualenv', ['--virtualenv', 'env', '--version', '4.0', '--upgrade']),
+    ('source', ['--source', 'https://example.com/cli.tar.gz',
+                '--with-requirements', 'dev-requirements.txt',
+                '--pip-args=--no-cache-dir', '-v']),
+]
+
+
+def measure(iterations=500):
+    """Returns the mean duration of a call, in seconds, of each command
+    line.
+    """
+    results = {}
+    for name, args in COMMAND_LINES:
+        start = time.time()
+        for _ in range(iterations):
+            get_cloudify.parse_args(args)
+        results[name] = (time.time() - start) / iterations
+    return results
+
+
+def main(iterations=500):
+    results = measure(iterations)
+    print('{0:<12} {1:>14}'.format('arguments', 'per call (ms)'))
+    for name, _ in COMMAND_LINES:
+        print('{0:<12} {1:>14.3f}'.format(name, results[name] * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+"""Times get-cloudify's _run against a series of short lived commands.
+
+An installation runs a dozen or more subprocesses (pip, virtualenv,
+apt-get/yum...), most of which exit with output in bursts, so this mimics
+that with a mix of quiet, chatty and bursty commands.
+
+Usage: python benchmarks/bench_run.py [iterations]
+"""
+import importlib
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+get_cloudify = importlib.import_module('get-cloudify')
+
+PYTHON = sys.executable
+
+COMMANDS = [
+    ('quiet', '{0} -c "pass"'.format(PYTHON)),
+    ('chatty', '{0} -c "for i in range(20000): print(i)"'.format(PYTHON)),
+    ('bursty', '{0} -c "import time, sys\n'
+               'for i in range(5):\n'
+               '    print(i); sys.stdout.flush(); time.sleep(0.05)"'.format(
+                   PYTHON)),
+]
+
+
+def measure(iterations=15):
+    """Returns the mean duration of a call, in seconds, of each command."""
+    get_cloudify.logger.setLevel(logging.ERROR)
+    results = {}
+    for name, cmd in COMMANDS:
+        start = time.time()
+        for _ in range(iterations):
+            get_cloudify._run(cmd)
+        results[name] = (time.time() - start) / iterations
+    return results
+
+
+def main(iterations=15):
+    results = measure(iterations)
+    print('{0:<10} {1:>10} {2:>10}'.format('command', 'total (s)', 'per call'))
+    for name, _ in COMMANDS:
+        print('{0:<10} {1:>10.3f} {2:>10.4f}'.format(
+            name, results[name] * iterations, results[name]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,107 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+"""Times get-cloudify.py from starting the interpreter until it exits, for
+the invocations that do (almost) nothing.
+
+Configuration management tools run the script on every converge, where it
+usually only reports its version or finds Cloudify already installed as
+requested, so this is most of the time it ever takes.
+
+Usage: python benchmarks/bench_startup.py [iterations]
+"""
+import importlib
+import inspect
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+get_cloudify = importlib.import_module('get-cloudify')
+
+PYTHON = sys.executable
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'get-cloudify.py')
+
+
+def make_installed_virtualenv():
+    """Returns a fake virtualenv that a previous run installed Cloudify in,
+    so that running the script against it again does nothing.
+    """
+    env = tempfile.mkdtemp()
+    os.makedirs(os.path.join(env, 'bin'))
+    open(os.path.join(env, 'bin', 'activate'), 'w').close()
+    os.makedirs(os.path.join(env, 'lib', 'python2.7', 'site-packages',
+                             'cloudify-4.0.dist-info'))
+    # Record the state of the same request the command line makes
+    args = get_cloudify.parse_args(['--virtualenv', env])
+    params = inspect.getargspec(get_cloudify.CloudifyInstaller.__init__)[0]
+    installer = get_cloudify.CloudifyInstaller(
+        **dict((k, v) for k, v in args.items() if k in params))
+    state = installer.get_requested_state()
+    state['installed_version'] = '4.0'
+    with open(os.path.join(env, get_cloudify.STATE_FILE), 'w') as f:
+        json.dump(state, f)
+    return env
+
+
+def time_command(cmd, iterations):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(iterations):
+            start = time.time()
+            subprocess.check_call(cmd, stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+    return min(timings), sorted(timings)[len(timings) // 2]
+
+
+def measure(iterations=20):
+    """Returns the median duration, in seconds, of each case."""
+    env = make_installed_virtualenv()
+    try:
+        return dict((name, time_command(cmd, iterations)[1])
+                    for name, cmd in get_cases(env))
+    finally:
+        shutil.rmtree(env)
+
+
+def get_cases(env):
+    return [
+        ('python', [PYTHON, '-c', 'pass']),
+        ('version', [PYTHON, SCRIPT, '--get-version']),
+        ('help', [PYTHON, SCRIPT, '-h']),
+        ('no-op', [PYTHON, SCRIPT, '--virtualenv', env]),
+    ]
+
+
+def main(iterations=20):
+    env = make_installed_virtualenv()
+    try:
+        print('{0:<10} {1:>10} {2:>10}'.format('case', 'min (ms)',
+                                               'median (ms)'))
+        for name, cmd in get_cases(env):
+            best, median = time_command(cmd, iterations)
+            print('{0:<10} {1:>10.1f} {2:>10.1f}'.format(
+                name, best * 1000, median * 1000))
+    finally:
+        shutil.rmtree(env)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
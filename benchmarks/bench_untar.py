@@ -0,0 +1,113 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+"""Times archive extraction on generated source archives of several sizes.
+
+get-cloudify's _untar_requirement_files only extracts the requirement
+files, while the composer's untar extracts everything (here with the top
+level directory stripped, as for node.js).
+
+See bench_untar_requirements.py for the peak memory usage of extracting
+requirement files.
+
+Usage: python benchmarks/bench_untar.py [iterations]
+"""
+import importlib
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+get_cloudify = importlib.import_module('get-cloudify')
+composer = importlib.import_module('get-cloudify-composer')
+
+# Number of files in each archive
+SIZES = [100, 1000, 5000]
+
+
+def make_archive(path, files):
+    """Makes an archive shaped like a GitHub tarball, with the files spread
+    over 100 packages. The requirement files come last, so that finding
+    them takes reading the whole archive.
+    """
+    with tarfile.open(name=path, mode='w:gz') as tar:
+        names = ['cli-master/pkg{0}/module{1}.py'.format(i % 100, i)
+                 for i in range(files)]
+        names += ['cli-master/dev-requirements.txt',
+                  'cli-master/requirements.txt']
+        for name in names:
+            content = os.urandom(512).encode('hex')
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, StringIO(content))
+
+
+def untar_requirement_files(archive, destination):
+    get_cloudify._untar_requirement_files(archive, destination)
+
+
+def composer_untar(archive, destination):
+    composer.untar(archive, destination, strip_components=1)
+
+
+VARIANTS = [
+    ('requirements', untar_requirement_files),
+    ('composer', composer_untar),
+]
+
+
+def measure(iterations=3):
+    """Returns the mean duration of an extraction, in seconds, of each
+    variant and archive size.
+    """
+    get_cloudify.logger.setLevel(logging.ERROR)
+    composer.lgr.setLevel(logging.ERROR)
+    tempdir = tempfile.mkdtemp()
+    try:
+        results = {}
+        for files in SIZES:
+            archive = os.path.join(tempdir, '{0}.tar.gz'.format(files))
+            make_archive(archive, files)
+            for name, func in VARIANTS:
+                elapsed = 0
+                for _ in range(iterations):
+                    destination = tempfile.mkdtemp(dir=tempdir)
+                    start = time.time()
+                    func(archive, destination)
+                    elapsed += time.time() - start
+                    shutil.rmtree(destination)
+                results['{0}-{1}'.format(name, files)] = elapsed / iterations
+        return results
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def main(iterations=3):
+    results = measure(iterations)
+    print('{0:<14} {1:>8} {2:>12}'.format('variant', 'files', 'per call (s)'))
+    for name, _ in VARIANTS:
+        for files in SIZES:
+            print('{0:<14} {1:>8} {2:>12.4f}'.format(
+                name, files, results['{0}-{1}'.format(name, files)]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,111 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+"""Times requirement file extraction from a large synthetic source archive.
+
+The archive mimics a GitHub tarball: a single top level directory holding
+the requirement files followed by many other (and nested requirement)
+files. Each variant runs in its own process so that its peak memory usage
+can be reported.
+
+Usage: python benchmarks/bench_untar_requirements.py [files]
+"""
+import importlib
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+get_cloudify = importlib.import_module('get-cloudify')
+
+
+def make_archive(path, files):
+    with tarfile.open(name=path, mode='w:gz') as tar:
+        names = ['cli-master/dev-requirements.txt',
+                 'cli-master/requirements.txt']
+        names += ['cli-master/pkg{0}/module{1}.py'.format(i % 100, i)
+                  for i in range(files)]
+        names += ['cli-master/docs/requirements.txt']
+        for name in names:
+            content = os.urandom(512).encode('hex')
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, StringIO(content))
+
+
+def legacy_untar_requirement_files(archive, destination):
+    """The getmembers() based implementation, for comparison."""
+    with tarfile.open(name=archive) as tar:
+        req_files = [req_file for req_file in tar.getmembers()
+                     if os.path.basename(req_file.name)
+                     in get_cloudify.REQUIREMENT_FILE_NAMES]
+        tar.extractall(path=destination, members=req_files)
+
+
+VARIANTS = {
+    'getmembers': legacy_untar_requirement_files,
+    'streaming': get_cloudify._untar_requirement_files,
+}
+
+
+def run_variant(name, archive):
+    """Runs a variant in this process, printing its duration and peak RSS."""
+    destination = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        VARIANTS[name](archive, destination)
+        print('{0} {1}'.format(
+            time.time() - start,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    finally:
+        shutil.rmtree(destination)
+
+
+def main(files=50000):
+    tempdir = tempfile.mkdtemp()
+    try:
+        archive = os.path.join(tempdir, 'source.tar.gz')
+        # Generated in a child process to keep this one small, as Linux
+        # carries the peak RSS of a process over to the children it execs.
+        subprocess.check_call(
+            [sys.executable, __file__, '--make', archive, str(files)])
+        print('archive: {0} files, {1:.1f}MB'.format(
+            files, os.path.getsize(archive) / 1024.0 / 1024))
+        print('{0:<12} {1:>10} {2:>14}'.format(
+            'variant', 'time (s)', 'peak RSS (MB)'))
+        for name in sorted(VARIANTS):
+            duration, rss = subprocess.check_output(
+                [sys.executable, __file__, '--variant', name, archive]).split()
+            # ru_maxrss is in KB on Linux
+            print('{0:<12} {1:>10.3f} {2:>14.1f}'.format(
+                name, float(duration), int(rss) / 1024.0))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--variant']:
+        run_variant(sys.argv[2], sys.argv[3])
+    elif sys.argv[1:2] == ['--make']:
+        make_archive(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(*sys.argv[1:])
@@ -0,0 +1,126 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+"""Runs the benchmarks and stores their results as JSON, so that changes
+to the timed functions can be compared run to run.
+
+Every benchmark runs offline: commands are local python processes and
+downloads come from a local HTTP server. Results are durations in seconds,
+keyed by benchmark and case, e.g. results['download']['large'].
+
+Usage:
+    python benchmarks/suite.py [-o FILE] [-c PREVIOUS] [BENCHMARK...]
+
+e.g. to compare a change against master:
+    git checkout master && python benchmarks/suite.py -o before.json
+    git checkout - && python benchmarks/suite.py -c before.json
+"""
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+
+# (name, module), in the order they run
+BENCHMARKS = [
+    ('parse_args', 'bench_parse_args'),
+    ('run', 'bench_run'),
+    ('download', 'bench_download'),
+    ('untar', 'bench_untar'),
+    ('startup', 'bench_startup'),
+]
+
+
+def run(names):
+    sys.path.insert(0, BENCHMARKS_DIR)
+    results = {}
+    for name, module in BENCHMARKS:
+        if names and name not in names:
+            continue
+        print('Running {0}...'.format(name))
+        results[name] = importlib.import_module(module).measure()
+    get_cloudify = importlib.import_module('get-cloudify')
+    return {
+        'created': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'script_version': get_cloudify.version_str,
+        'results': results,
+    }
+
+
+def compare(previous, current):
+    """Prints each result next to the previous one for the same case."""
+    print('{0:<24} {1:>12} {2:>12} {3:>8}'.format(
+        'case', 'previous (s)', 'current (s)', 'change'))
+    for name in sorted(current['results']):
+        for case, duration in sorted(current['results'][name].items()):
+            before = previous['results'].get(name, {}).get(case)
+            print('{0:<24} {1:>12} {2:>12.4f} {3:>8}'.format(
+                '{0}.{1}'.format(name, case),
+                '-' if before is None else '{0:.4f}'.format(before),
+                duration,
+                '-' if not before else '{0:+.1%}'.format(
+                    duration / before - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'benchmarks',
+        nargs='*',
+        help='The benchmarks to run: {0} (default: all).'.format(
+            ', '.join(name for name, _ in BENCHMARKS)))
+    parser.add_argument(
+        '-o', '--output',
+        help='Where to write the results (default: results/<time>.json).')
+    parser.add_argument(
+        '-c', '--compare',
+        help='Results of a previous run to compare with.')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(name for name, _ in BENCHMARKS)
+    if unknown:
+        parser.error('Unknown benchmarks: {0}'.format(
+            ', '.join(sorted(unknown))))
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    current = run(args.benchmarks)
+
+    output = args.output
+    if not output:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, '{0}.json'.format(
+            datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as f:
+        json.dump(current, f, indent=2, sort_keys=True)
+    print('Results written to {0}'.format(output))
+
+    if previous:
+        compare(previous, current)
+
+
+if __name__ == '__main__':
+    main()
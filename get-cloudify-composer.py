@@ -21,14 +21,16 @@ import argparse
 import json
 import platform
 import os
-import urllib
+import urllib2
+import httplib
 import tempfile
 import logging
 import shutil
-import time
 import tarfile
-from threading import Thread
-from contextlib import closing
+import time
+from threading import Thread, Lock, current_thread
+from contextlib import closing, contextmanager
+from functools import wraps
 
 
 DESCRIPTION = '''This script installs Cloudify's Composer on Linux and OS X.
@@ -42,6 +44,29 @@ IS_VIRTUALENV = hasattr(sys, 'real_prefix')
 
 REQUIREMENT_FILE_NAMES = ['dev-requirements.txt', 'requirements.txt']
 
+# os-release IDs whose platform.linux_distribution names are used instead
+DISTRO_ALIASES = {
+    'rhel': 'redhat',
+    'arch': 'archlinux',
+    'sles': 'suse',
+}
+# Distributions platform.linux_distribution recognized by their own name.
+# It named derivatives (Oracle Linux, Rocky, Mint, Raspbian, ...) after
+# the release file they share with their base, which is kept by mapping
+# their os-release ID_LIKE entries to these.
+KNOWN_DISTROS = ('ubuntu', 'debian', 'centos', 'fedora', 'redhat',
+                 'archlinux', 'suse')
+DISTRO_FAMILIES = {
+    'rhel': 'redhat',
+    'centos': 'redhat',
+    'fedora': 'redhat',
+    'debian': 'debian',
+    'ubuntu': 'debian',
+    'arch': 'archlinux',
+    'suse': 'suse',
+    'opensuse': 'suse',
+}
+
 LINUX_NODEJS_SOURCE = 'http://nodejs.org/dist/v{0}/node-v{0}-linux-x64.tar.gz'.format('4.4.3')  # NOQA
 OSX_NODEJS_SOURCE = 'https://nodejs.org/download/release/v{0}/node-v{0}-darwin-x64.tar.gz'.format('4.4.3')  # NOQA
 DSL_PARSER_CLI_SOURCE = 'https://github.com/cloudify-cosmo/cloudify-dsl-parser-cli/archive/3.4.zip'  # NOQA
@@ -53,10 +78,19 @@ IS_WIN = (PLATFORM.startswith('win32'))
 IS_DARWIN = (PLATFORM == 'darwin')
 IS_LINUX = (PLATFORM.startswith('linux'))
 
-PROCESS_POLLING_INTERVAL = 0.1
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# How many times an interrupted download is resumed before giving up.
+DOWNLOAD_RETRIES = 5
+# Files smaller than this are never downloaded in segments.
+MIN_SEGMENTED_SIZE = 4 * 1024 * 1024
+# Seconds between checks while waiting for other threads. On Python 2 a
+# wait without a timeout can't be interrupted, e.g. by Ctrl+C.
+WAIT_INTERVAL = 1
 
 # defined below
 lgr = None
+# set by get_os_props
+os_props = None
 
 if not (IS_LINUX or IS_DARWIN):
     sys.exit('Platform {0} not supported.'.format(PLATFORM))
@@ -80,29 +114,99 @@ def init_logger(logger_name):
     return logger
 
 
+class Profiler(object):
+    """Records how long installation phases, commands and downloads take.
+    See get-cloudify.py's _Profiler.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self._lock = Lock()
+
+    @contextmanager
+    def measure(self, kind, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self._lock:
+                self.records.append({
+                    'kind': kind,
+                    'name': name,
+                    'start': start - self.started,
+                    'duration': end - start,
+                    'thread': current_thread().name,
+                })
+
+    def report(self):
+        """Returns a human readable table of the records."""
+        lines = ['Profile ({0:.1f}s in total):'.format(
+            time.time() - self.started),
+            '{0:>9} {1:>9}  {2:<10} {3}'.format(
+                'start', 'duration', 'kind', 'name')]
+        for record in sorted(self.records, key=lambda r: r['start']):
+            name = record['name']
+            lines.append('{0:>8.2f}s {1:>8.2f}s  {2:<10} {3}'.format(
+                record['start'], record['duration'], record['kind'],
+                name if len(name) <= 60 else name[:57] + '...'))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Writes the records to `path` as JSON."""
+        with open(path, 'w') as f:
+            json.dump({
+                'platform': PLATFORM,
+                'started': self.started,
+                'total': time.time() - self.started,
+                'records': sorted(self.records, key=lambda r: r['start']),
+            }, f, indent=2)
+
+
+profiler = Profiler()
+
+
+def join(thread):
+    """Waits for `thread` to finish, interruptibly (see WAIT_INTERVAL)."""
+    while thread.is_alive():
+        thread.join(WAIT_INTERVAL)
+
+
+def timed(kind):
+    """Decorates a function so that its calls are recorded by profiler."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiler.measure(kind, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def run(cmd, suppress_errors=False):
     """Executes a command
     """
     lgr.debug('Executing: {0}...'.format(cmd))
+    with profiler.measure('command', cmd):
+        return run_command(cmd, suppress_errors)
+
+
+def run_command(cmd, suppress_errors):
     pipe = subprocess.PIPE
     proc = subprocess.Popen(
         cmd, shell=True, stdout=pipe, stderr=pipe)
 
     stderr_log_level = logging.NOTSET if suppress_errors else logging.ERROR
 
-    stdout_thread = PipeReader(proc.stdout, proc, lgr, logging.DEBUG)
-    stderr_thread = PipeReader(proc.stderr, proc, lgr, stderr_log_level)
-
-    stdout_thread.start()
+    # Blocking reads until EOF; see get-cloudify.py's _run.
+    stderr_thread = PipeReader(proc.stderr, lgr, stderr_log_level)
     stderr_thread.start()
-
-    while proc.poll() is None:
-        time.sleep(PROCESS_POLLING_INTERVAL)
-
-    stdout_thread.join()
+    stdout_reader = PipeReader(proc.stdout, lgr, logging.DEBUG)
+    stdout_reader.run()
     stderr_thread.join()
+    proc.wait()
 
-    proc.aggr_stdout = stdout_thread.aggr
+    proc.aggr_stdout = stdout_reader.aggr
     proc.aggr_stderr = stderr_thread.aggr
 
     return proc
@@ -187,19 +291,246 @@ def untar_requirement_files(archive, destination):
         tar.extractall(path=destination, members=req_files)
 
 
-def download_file(url, destination):
+def download_file(url, destination, segments=1):
+    """Downloads `url` to `destination`.
+
+    The file is first written to `<destination>.part`. If the connection
+    drops, the download is resumed from where it stopped using a range
+    request, and a `.part` file left by a previous attempt is resumed too,
+    unless the file changed since (checked with If-Range against the ETag or
+    Last-Modified date recorded in `<destination>.part.validator`).
+    With `segments` > 1, large files served by a server that accepts range
+    requests are downloaded in that many parallel segments.
+    """
+    with profiler.measure('download', url):
+        fetch_file(url, destination, segments)
+
+
+def fetch_file(url, destination, segments):
     lgr.info('Downloading {0} to {1}'.format(url, destination))
-    final_url = urllib.urlopen(url).geturl()
+    partial = '{0}.part'.format(destination)
+    offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+    validator = read_partial_validator(partial) if offset else None
+    if offset and not validator:
+        # Without a validator there is no telling whether the file changed
+        # since the partial file was written, so it can't be resumed
+        lgr.debug('Discarding {0}, which can not be validated.'.format(
+            partial))
+        remove_partial(partial)
+        offset = 0
+    try:
+        response = open_url(url, offset, validator=validator)
+    except urllib2.HTTPError as ex:
+        if ex.code == 416 and offset:
+            # The partial file is not a prefix of the current file
+            remove_partial(partial)
+            return fetch_file(url, destination, segments)
+        raise
+
+    started = time.time()
+    final_url = response.geturl()
     if final_url != url:
         lgr.debug('Redirected to {0}'.format(final_url))
-    f = urllib.URLopener()
-    f.retrieve(final_url, destination)
+    headers = response.info()
+    if response.getcode() == 206:
+        lgr.info('Resuming download from byte {0}...'.format(offset))
+        size = int(headers.getheader('Content-Range').split('/')[-1])
+    else:
+        offset = 0
+        size = int(headers.getheader('Content-Length') or 0) or None
+        validator = get_validator(headers)
+        write_partial_validator(partial, validator)
+
+    if segments > 1 and not offset and (size or 0) >= MIN_SEGMENTED_SIZE \
+            and headers.getheader('Accept-Ranges') == 'bytes':
+        response.close()
+        download_segments(final_url, partial, size, segments, validator)
+    else:
+        with open(partial, 'r+b' if offset else 'wb') as f:
+            copy_response(final_url, response, f, offset,
+                          size - 1 if size else None, validator=validator)
+    if os.path.exists(destination):
+        os.remove(destination)
+    os.rename(partial, destination)
+    remove_partial(partial)
+
+    elapsed = max(time.time() - started, 0.001)
+    size = os.path.getsize(destination) - offset
+    lgr.info('Downloaded {0} in {1:.1f}s ({2}/s).'.format(
+        format_size(size), elapsed, format_size(size / elapsed)))
+
+
+def get_validator(headers):
+    """Returns a validator of the file in a response usable with If-Range,
+    which takes a strong ETag or a Last-Modified date, or None.
+    """
+    etag = headers.getheader('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.getheader('Last-Modified')
+
+
+def read_partial_validator(partial):
+    try:
+        with open('{0}.validator'.format(partial)) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def write_partial_validator(partial, validator):
+    path = '{0}.validator'.format(partial)
+    if validator:
+        with open(path, 'w') as f:
+            f.write(validator)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+
+def remove_partial(partial):
+    for path in (partial, '{0}.validator'.format(partial)):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def open_url(url, start=0, end=None, validator=None):
+    """Requests `url`, from byte `start` to byte `end` if either is set.
+
+    With a `validator`, the range is only honoured if the file still
+    matches it.
+    """
+    headers = {}
+    if start or end is not None:
+        headers['Range'] = 'bytes={0}-{1}'.format(
+            start, '' if end is None else end)
+        if validator:
+            headers['If-Range'] = validator
+    return urllib2.urlopen(urllib2.Request(url, headers=headers))
+
+
+def copy_response(url, response, f, position, end, segment=False,
+                  validator=None):
+    """Writes `response`, holding `url` from byte `position`, to `f`.
+
+    `end` is the last byte expected (None if unknown). If the transfer is
+    cut short, it is resumed with a range request from where it stopped, up
+    to DOWNLOAD_RETRIES times. Unless this is a `segment` of a file, the
+    download is restarted if the server doesn't support range requests.
+    Resumed requests carry `validator` as If-Range, so that a file that
+    changed meanwhile is not resumed.
+    """
+    retries = DOWNLOAD_RETRIES
+    while True:
+        try:
+            if response is None:
+                response = open_url(url, position, end, validator)
+                if response.getcode() != 206:
+                    if segment:
+                        raise IOError('The file changed or range requests '
+                                      'are not supported.')
+                    # The whole file is being sent again
+                    position = 0
+                    f.truncate(0)
+            f.seek(position)
+            with closing(response):
+                for chunk in iter(
+                        lambda: response.read(DOWNLOAD_CHUNK_SIZE), ''):
+                    f.write(chunk)
+                    position += len(chunk)
+            if end is None or position > end:
+                return
+            error = 'connection closed at byte {0}'.format(position)
+        except (IOError, httplib.HTTPException) as ex:
+            error = str(ex) or repr(ex)
+        if not retries:
+            raise IOError('Download of {0} failed ({1})'.format(url, error))
+        retries -= 1
+        response = None
+        lgr.warning('Download of {0} interrupted ({1}), resuming from '
+                    'byte {2}...'.format(url, error, position))
+
+
+def download_segments(url, destination, size, segments, validator=None):
+    """Downloads `url`, which is `size` bytes long, in parallel segments."""
+    lgr.debug('Downloading {0} in {1} segments...'.format(url, segments))
+    with open(destination, 'wb') as f:
+        f.truncate(size)
+    errors = []
+
+    def download_segment(start, end):
+        try:
+            with open(destination, 'r+b') as f:
+                copy_response(url, None, f, start, end, segment=True,
+                              validator=validator)
+        except Exception as ex:
+            errors.append(ex)
+
+    bounds = [size * i // segments for i in range(segments + 1)]
+    threads = [Thread(target=download_segment, args=(start, end - 1))
+               for start, end in zip(bounds, bounds[1:])]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        join(thread)
+    if errors:
+        raise errors[0]
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{0:.1f}{1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f}GB'.format(size)
 
 
 def get_os_props():
-    distro, _, release = platform.linux_distribution(
-        full_distribution_name=False)
-    return distro, release
+    """Returns the (distro, release) of the running Linux distribution,
+    detected once per process. See get-cloudify.py's _get_os_props.
+    """
+    global os_props
+    if os_props is None:
+        os_props = detect_os_props()
+    return os_props
+
+
+def detect_os_props(root=os.sep):
+    """Detects the distribution and release from the os-release file under
+    `root`, falling back to platform.linux_distribution.
+    """
+    if not IS_LINUX:
+        return '', ''
+    for path in (os.path.join(root, 'etc', 'os-release'),
+                 os.path.join(root, 'usr', 'lib', 'os-release')):
+        fields = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    key, _, value = line.strip().partition('=')
+                    fields[key] = value.strip('"\'').replace('\\', '')
+        except IOError:
+            continue
+        if fields.get('ID'):
+            return get_distro_id(fields), fields.get('VERSION_ID', '')
+    if root == os.sep and hasattr(platform, 'linux_distribution'):
+        distro, release, _ = platform.linux_distribution(
+            full_distribution_name=False)
+        return distro.lower(), release
+    return '', ''
+
+
+def get_distro_id(fields):
+    """Returns the distribution ID of parsed os-release `fields`. See
+    get-cloudify.py's _get_distro_id.
+    """
+    distro = fields['ID'].lower()
+    distro = DISTRO_ALIASES.get(distro, distro)
+    if distro not in KNOWN_DISTROS:
+        for like in fields.get('ID_LIKE', '').lower().split():
+            if like in DISTRO_FAMILIES:
+                return DISTRO_FAMILIES[like]
+    return distro
 
 
 def _get_env_bin_path(env_path):
@@ -217,31 +548,87 @@ def _get_env_bin_path(env_path):
 
 
 class PipeReader(Thread):
-    def __init__(self, fd, proc, logger, log_level):
+    def __init__(self, fd, logger, log_level):
         Thread.__init__(self)
         self.fd = fd
-        self.proc = proc
         self.logger = logger
         self.log_level = log_level
         self.aggr = ''
 
     def run(self):
-        while self.proc.poll() is None:
-            output = self.fd.readline()
-            if len(output) > 0:
-                self.aggr += output
-                self.logger.log(self.log_level, output)
-            else:
-                time.sleep(PROCESS_POLLING_INTERVAL)
+        for output in iter(self.fd.readline, ''):
+            self.aggr += output
+            self.logger.log(self.log_level, output)
+        self.fd.close()
 
 
-def untar(archive, destination):
+def strip_leading_components(members, count):
+    """Yields tar members with the first `count` components removed from
+    their paths (and from the targets of hard links), like tar's
+    --strip-components. Members left without a path are skipped.
+    """
+    def strip(name):
+        if name.startswith('./'):
+            name = name[2:]
+        return '/'.join(name.split('/')[count:])
+
+    for member in members:
+        name = strip(member.name)
+        if not name:
+            continue
+        member.name = name
+        if member.islnk():
+            member.linkname = strip(member.linkname)
+        yield member
+
+
+@timed('extraction')
+def untar(archive, destination, strip_components=0):
     """Extracts files from an archive to a destination folder.
     """
     lgr.debug('Extracting tar.gz {0} to {1}...'.format(archive, destination))
     with closing(tarfile.open(name=archive)) as tar:
         files = [f for f in tar.getmembers()]
-        tar.extractall(path=destination, members=files)
+        tar.extractall(path=destination, members=strip_leading_components(
+            files, strip_components))
+
+
+@timed('extraction')
+def stream_untar(url, destination, strip_components=0):
+    """Extracts the archive at `url` to a destination folder as it is
+    being downloaded, without writing the archive itself to disk.
+    """
+    lgr.info('Downloading and extracting {0} to {1}...'.format(
+        url, destination))
+    with closing(urllib2.urlopen(url)) as response:
+        with closing(tarfile.open(fileobj=response, mode='r|*')) as tar:
+            tar.extractall(path=destination, members=strip_leading_components(
+                tar, strip_components))
+
+
+def run_concurrently(funcs):
+    """Calls each of `funcs` in its own thread and waits for all of them.
+
+    Returns a (func, exc_info) tuple for each call that failed, including
+    calls that exited with sys.exit.
+    """
+    failures = []
+
+    def call(func):
+        try:
+            func()
+        except BaseException:
+            failures.append((func, sys.exc_info()))
+
+    threads = [Thread(target=call, args=(func,), name=func.__name__)
+               for func in funcs]
+    for thread in threads:
+        # Not left running if the wait below is interrupted
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        join(thread)
+    return failures
 
 
 class ComposerInstaller():
@@ -256,7 +643,8 @@ class ComposerInstaller():
                  nightly=False,
                  nodejs_source=LINUX_NODEJS_SOURCE if IS_LINUX
                  else OSX_NODEJS_SOURCE,
-                 dsl_cli_source=DSL_PARSER_CLI_SOURCE):
+                 dsl_cli_source=DSL_PARSER_CLI_SOURCE,
+                 download_segments=1):
         if IS_WIN:
             sys.exit('This installer does not currently support installing '
                      'the composer on Windows.')
@@ -265,6 +653,7 @@ class ComposerInstaller():
         self.nodejs_source = nodejs_source
         self.dsl_cli_source = dsl_cli_source
         self.composer_source = composer_source
+        self.download_segments = download_segments
 
     def execute(self):
         if not self._find_pip:
@@ -288,9 +677,21 @@ class ComposerInstaller():
                 shutil.rmtree(self.HOME)
             else:
                 sys.exit(lgr.info('Installation aborted.'))
-        self.install_nodejs()
-        self.install_composer()
-        self.install_dsl_parser()
+        os.makedirs(self.HOME)
+        # The components are installed in separate directories, so they
+        # can be installed at the same time.
+        failures = run_concurrently([self.install_nodejs,
+                                     self.install_composer,
+                                     self.install_dsl_parser])
+        if failures:
+            for func, exc_info in failures:
+                lgr.error('{0} failed: {1}'.format(
+                    func.__name__, exc_info[1]))
+            lgr.info('Removing the partial installation in {0}...'.format(
+                self.HOME))
+            shutil.rmtree(self.HOME, ignore_errors=True)
+            exc_info = failures[0][1]
+            raise exc_info[0], exc_info[1], exc_info[2]
         self.inject_dsl_parser_configuration()
         lgr.info(
             'You can now run: '
@@ -315,6 +716,7 @@ class ComposerInstaller():
             lgr.error('Source {0} could not be found'.format(source))
             sys.exit(1)
 
+    @timed('phase')
     def inject_dsl_parser_configuration(self):
         """inject DSL parser configuration into Composer installation
         """
@@ -326,47 +728,55 @@ class ComposerInstaller():
         with open(conf_path, 'w') as conf_file:
             json.dump(conf, conf_file)
 
-    def install_nodejs(self):
-        def extract(archive, destination):
-            untar(archive, destination)
-            source = os.path.join(
-                td, [d for d in os.walk(destination).next()[1]][0])
-            for obj in os.listdir(source):
-                shutil.move(os.path.join(source, obj), self.NODEJS_HOME)
-
-        td = tempfile.mkdtemp()
-        if self.is_url(self.nodejs_source):
-            fd, tf = tempfile.mkstemp()
-            os.close(fd)
-            if not os.path.isdir(self.NODEJS_HOME):
-                os.makedirs(self.NODEJS_HOME)
+    def extract_source(self, source, destination, strip_components=0):
+        """Extracts the archive at `source`, a URL or a local path, to
+        `destination`, removing `strip_components` leading components from
+        the paths in it.
+
+        URLs are extracted while they are being downloaded, unless segmented
+        downloads were requested or the stream breaks, in which case the
+        archive is downloaded (resuming as required) and then extracted.
+        """
+        if not os.path.isdir(destination):
+            os.makedirs(destination)
+        if not self.is_url(source):
+            untar(source, destination, strip_components)
+            return
+        if self.download_segments <= 1:
             try:
-                download_file(self.nodejs_source, tf)
-                extract(tf, td)
-            finally:
-                shutil.rmtree(td)
-                os.remove(tf)
-        else:
-            untar(self.nodejs_source, td)
+                stream_untar(source, destination, strip_components)
+                return
+            except urllib2.HTTPError:
+                raise
+            except (IOError, EOFError, httplib.HTTPException,
+                    tarfile.TarError) as ex:
+                lgr.warning('Could not extract {0} while downloading it '
+                            '({1}). Downloading it first...'.format(
+                                source, ex))
+        fd, tf = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            download_file(source, tf, self.download_segments)
+            untar(tf, destination, strip_components)
+        finally:
+            os.remove(tf)
 
+    @timed('phase')
+    def install_nodejs(self):
+        # node.js archives hold a single top level directory, whose contents
+        # are extracted directly into NODEJS_HOME.
+        self.extract_source(self.nodejs_source, self.NODEJS_HOME,
+                            strip_components=1)
+
+    @timed('phase')
     def install_dsl_parser(self):
         make_virtualenv(self.DSL_PARSER_HOME)
         install_module(
             self.dsl_cli_source, virtualenv_path=self.DSL_PARSER_HOME)
 
+    @timed('phase')
     def install_composer(self):
-        if self.is_url(self.composer_source):
-            fd, tf = tempfile.mkstemp()
-            os.close(fd)
-            if not os.path.isdir(self.COMPOSER_HOME):
-                os.makedirs(self.COMPOSER_HOME)
-            try:
-                download_file(self.composer_source, tf)
-                untar(tf, self.COMPOSER_HOME)
-            finally:
-                os.remove(tf)
-        else:
-            untar(self.composer_source, self.COMPOSER_HOME)
+        self.extract_source(self.composer_source, self.COMPOSER_HOME)
 
     def remove_all(self):
         action = raw_input(
@@ -429,6 +839,17 @@ def parse_args(args=None):
     parser.add_argument(
         '--dsl-cli-source', type=str, default=DSL_PARSER_CLI_SOURCE,
         help='A URL or local path to the cloudify-dsl-parser-cli archive.')
+    parser.add_argument(
+        '--download-segments', type=int, default=1,
+        help='Download large archives in this many parallel segments if '
+        'the server supports range requests.')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Print how long each installation phase, download and '
+        'command took.')
+    parser.add_argument(
+        '--profile-output', type=str,
+        help='Write the timings printed by --profile to this path as JSON.')
 
     return parser.parse_args(args)
 
@@ -445,11 +866,19 @@ if __name__ == '__main__':
     else:
         lgr.setLevel(logging.INFO)
 
-    xargs = ['quiet', 'verbose']
+    xargs = ['quiet', 'verbose', 'profile', 'profile_output']
+    profile, profile_output = args.profile, args.profile_output
     args = {arg: v for arg, v in vars(args).items() if arg not in xargs}
     if not _is_root():
         lgr.error('Composer installation requires sudo privileges. '
                   'Please rerun the script with elevated privileges.')
         sys.exit()
-    installer = ComposerInstaller(**args)
-    installer.execute()
+    try:
+        installer = ComposerInstaller(**args)
+        installer.execute()
+    finally:
+        if profile:
+            lgr.info(profiler.report())
+        if profile_output:
+            profiler.dump(profile_output)
+            lgr.info('Profile written to {0}'.format(profile_output))
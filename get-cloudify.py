@@ -43,18 +43,23 @@
 
 
 import sys
-import subprocess
-import argparse
-import platform
 import os
-import urllib
-import struct
-import tempfile
 import logging
 import shutil
+import hashlib
+import json
 import time
-import tarfile
-from threading import Thread
+from StringIO import StringIO
+from collections import deque
+from threading import Thread, Lock, Condition, Event, current_thread
+from contextlib import closing, contextmanager
+from functools import wraps
+# argparse and the network, archive and process modules (urllib2, tarfile,
+# subprocess, tempfile, ...) are imported by the functions that use them,
+# so that runs that need few of them don't pay for importing the rest: a
+# bare --get-version imports none of them, and a run that finds Cloudify
+# already installed as requested only imports argparse, to parse its
+# arguments.
 
 # Future proofing for python 3.4+ - imp is being deprecated, but importlib
 # does not have all required functions in 2.7
@@ -106,6 +111,35 @@ will not cause it to be used while sudo is in use.
 The script will use the interpreter that the script was run with as the path,
 e.g. for creating virtualenvs, etc.
 
+Downloaded files (e.g. get-pip.py or a --source archive) are kept in a local
+cache (see --cache-dir). Cached files are revalidated with the server and
+used as they are if they did not change or if the server can't be reached.
+Use --no-cache to disable this.
+
+After installing in a virtualenv, the request (source, version, requirement
+file hashes, python path, etc.) is recorded in the virtualenv. Running the
+script again with the same request does nothing, and running it with a
+different request updates the installation without requiring --upgrade.
+
+Several versions can be installed side by side, each in its own virtualenv,
+with --batch. They are installed concurrently (see --batch-workers) and share
+the download cache.
+
+Downloads can be checked against pinned SHA-256 digests (see --sha256 and
+--verify-downloads). They are hashed as they are written, and rejected
+before anything is extracted or installed from them.
+
+One host can serve its download cache and wheelhouse to others with
+--serve-mirror, and others can use it with --mirror.
+
+The script can also be run on many hosts at once over SSH with --fleet. The
+script and any local or --source archives are uploaded to each host, and the
+output of each host is logged, prefixed with its name.
+
+To set up many machines quickly, a finished --virtualenv can be packed with
+--snapshot-out and unpacked on machines of the same platform with
+--snapshot-in, which rewrites its scripts for the new path.
+
 Please refer to Cloudify's documentation at http://getcloudify.org for
 additional information.'''
 
@@ -113,6 +147,34 @@ IS_VIRTUALENV = hasattr(sys, 'real_prefix')
 
 REQUIREMENT_FILE_NAMES = ['dev-requirements.txt', 'requirements.txt']
 
+# os-release IDs whose platform.linux_distribution names are used instead
+DISTRO_ALIASES = {
+    'rhel': 'redhat',
+    'arch': 'archlinux',
+    'sles': 'suse',
+}
+# Distributions platform.linux_distribution recognized by their own name.
+# It named derivatives (Oracle Linux, Rocky, Mint, Raspbian, ...) after
+# the release file they share with their base, which is kept by mapping
+# their os-release ID_LIKE entries to these.
+KNOWN_DISTROS = ('ubuntu', 'debian', 'centos', 'fedora', 'redhat',
+                 'archlinux', 'suse')
+DISTRO_FAMILIES = {
+    'rhel': 'redhat',
+    'centos': 'redhat',
+    'fedora': 'redhat',
+    'debian': 'debian',
+    'ubuntu': 'debian',
+    'arch': 'archlinux',
+    'suse': 'suse',
+    'opensuse': 'suse',
+}
+
+# Stored as the first member of virtualenv snapshots (see --snapshot-out)
+SNAPSHOT_MANIFEST = '.get-cloudify-snapshot.json'
+# Written to the virtualenv after a successful installation
+STATE_FILE = '.get-cloudify-state.json'
+
 # TODO: put these in a private storage
 repo = 'http://repository.cloudifysource.org/org/cloudify3/components'
 PIP_URL = '{repo}/get-pip.py'.format(repo=repo)
@@ -125,10 +187,37 @@ IS_LINUX = (PLATFORM.startswith('linux'))
 # Using os.name to allow cygwin to be detected as windows as well
 IS_WIN = (os.name == 'nt')
 
-PROCESS_POLLING_INTERVAL = 0.1
+# Upper bound, in bytes, on the output kept in memory for each stream of a
+# command run with _run. Everything is still logged as it is read.
+MAX_CAPTURED_OUTPUT = 8 * 1024 * 1024
+# Seconds between checks while waiting for other threads. On Python 2 a
+# wait without a timeout can't be interrupted, e.g. by Ctrl+C.
+WAIT_INTERVAL = 1
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'get-cloudify')
+# The least recently used files are evicted beyond this size (in bytes).
+CACHE_MAX_SIZE = 1024 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# How many times an interrupted download is resumed before giving up.
+DOWNLOAD_RETRIES = 5
+# Files smaller than this are never downloaded in segments.
+MIN_SEGMENTED_SIZE = 4 * 1024 * 1024
+# How many virtualenvs --batch installs into at a time.
+DEFAULT_BATCH_WORKERS = 4
+# How many hosts --fleet installs on at a time.
+DEFAULT_FLEET_WORKERS = 10
+# Where --fleet uploads the script and artifacts, relative to the home
+# directory on each host.
+FLEET_REMOTE_DIR = '.get-cloudify-fleet'
+DEFAULT_SSH_COMMAND = 'ssh -o BatchMode=yes'
+DEFAULT_SCP_COMMAND = 'scp -o BatchMode=yes -q'
+DEFAULT_MIRROR_ADDRESS = '0.0.0.0:8080'
 
 # defined below
 logger = None
+# set by _get_os_props
+_os_props = None
 
 
 def _init_logger(logger_name):
@@ -151,36 +240,125 @@ def _exit(message, status):
         'dependency_extraction_failure': 221,
         'dependency_installation_failure': 222,
         'dependency_unsupported_on_distribution': 223,
+        'wheel_build_failure': 224,
         'cloudify_already_installed': 230,
+        'batch_installation_failure': 240,
+        'fleet_installation_failure': 241,
     }
 
     logger.error(message)
     sys.exit(exit_codes[status])
 
 
-def _run(cmd, suppress_errors=False):
+class _Profiler(object):
+    """Records how long installation phases, commands and downloads take.
+
+    Records are always collected, as doing so is cheap. They are only
+    reported when requested with --profile or --profile-output.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self._lock = Lock()
+
+    @contextmanager
+    def measure(self, kind, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self._lock:
+                self.records.append({
+                    'kind': kind,
+                    'name': name,
+                    'start': start - self.started,
+                    'duration': end - start,
+                    'thread': current_thread().name,
+                })
+
+    def report(self):
+        """Returns a human readable table of the records."""
+        lines = ['Profile ({0:.1f}s in total):'.format(
+            time.time() - self.started),
+            '{0:>9} {1:>9}  {2:<10} {3}'.format(
+                'start', 'duration', 'kind', 'name')]
+        for record in sorted(self.records, key=lambda r: r['start']):
+            name = record['name']
+            lines.append('{0:>8.2f}s {1:>8.2f}s  {2:<10} {3}'.format(
+                record['start'], record['duration'], record['kind'],
+                name if len(name) <= 60 else name[:57] + '...'))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Writes the records to `path` as JSON."""
+        with open(path, 'w') as f:
+            json.dump({
+                'version': version_str,
+                'platform': PLATFORM,
+                'started': self.started,
+                'total': time.time() - self.started,
+                'records': sorted(self.records, key=lambda r: r['start']),
+            }, f, indent=2)
+
+
+_profiler = _Profiler()
+
+
+def _timed(kind):
+    """Decorates a function so that its calls are recorded by _profiler."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _profiler.measure(kind, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _join(thread):
+    """Waits for `thread` to finish, interruptibly (see WAIT_INTERVAL)."""
+    while thread.is_alive():
+        thread.join(WAIT_INTERVAL)
+
+
+def _run(cmd, suppress_errors=False, max_output=MAX_CAPTURED_OUTPUT,
+         keep='tail'):
     """Executes a command
+
+    At most `max_output` bytes (None for no limit) of each of stdout and
+    stderr are kept in `aggr_stdout` and `aggr_stderr`. `keep` selects
+    whether the 'tail' (the default, which is where errors usually are)
+    or the 'head' of the output is retained once that limit is reached.
     """
     logger.debug('Executing: {0}...'.format(cmd))
+    with _profiler.measure('command', cmd):
+        return _run_command(cmd, suppress_errors, max_output, keep)
+
+
+def _run_command(cmd, suppress_errors, max_output, keep):
+    import subprocess
     pipe = subprocess.PIPE
     proc = subprocess.Popen(
         cmd, shell=True, stdout=pipe, stderr=pipe)
 
     stderr_log_level = logging.NOTSET if suppress_errors else logging.ERROR
 
-    stdout_thread = _PipeReader(proc.stdout, proc, logger, logging.DEBUG)
-    stderr_thread = _PipeReader(proc.stderr, proc, logger, stderr_log_level)
-
-    stdout_thread.start()
+    # Both pipes are read with blocking reads until EOF, so we return as soon
+    # as the process has exited and all of its output was consumed instead of
+    # waking up on a timer. stderr gets its own thread so that a process
+    # filling one pipe can never deadlock on the other; stdout is drained
+    # in the calling thread.
+    stderr_thread = _PipeReader(proc.stderr, logger, stderr_log_level,
+                                max_size=max_output, keep=keep)
     stderr_thread.start()
-
-    while proc.poll() is None:
-        time.sleep(PROCESS_POLLING_INTERVAL)
-
-    stdout_thread.join()
+    stdout_reader = _PipeReader(proc.stdout, logger, logging.DEBUG,
+                                max_size=max_output, keep=keep)
+    stdout_reader.run()
     stderr_thread.join()
+    proc.wait()
 
-    proc.aggr_stdout = stdout_thread.aggr
+    proc.aggr_stdout = stdout_reader.aggr
     proc.aggr_stderr = stderr_thread.aggr
 
     return proc
@@ -207,6 +385,28 @@ def _drop_root_privileges():
     os.seteuid(int(os.environ.get('SUDO_UID', 0)))
 
 
+def _chown_to_sudo_user(path):
+    """Gives `path` to the user who ran sudo, if running as root via sudo.
+
+    This keeps files created before dropping root privileges usable after.
+    """
+    if _is_root() and 'SUDO_UID' in os.environ:
+        os.chown(path, int(os.environ['SUDO_UID']),
+                 int(os.environ.get('SUDO_GID', -1)))
+
+
+def _make_dirs(path):
+    """Creates `path` and its missing parents, giving each of them to the
+    user who ran sudo, if running as root via sudo.
+    """
+    parent = os.path.dirname(os.path.normpath(path))
+    if parent and parent != path and not os.path.isdir(parent):
+        _make_dirs(parent)
+    os.mkdir(path)
+    _chown_to_sudo_user(path)
+
+
+@_timed('phase')
 def _make_virtualenv(virtualenv_dir, python_path):
     """This will create a virtualenv. If no `python_path` is supplied,
     will assume that `python` is in path. This default assumption is provided
@@ -230,9 +430,11 @@ def _make_virtualenv(virtualenv_dir, python_path):
         )
 
 
+@_timed('phase')
 def _install_package(package, version=False, pre=False, virtualenv_path=False,
                      requirement_files=None, upgrade=False,
-                     pip_args=''):
+                     pip_args='', wheels_path=False, mirror=None,
+                     force_reinstall=False):
     """This will install a Python package.
 
     Can specify a specific version.
@@ -240,7 +442,9 @@ def _install_package(package, version=False, pre=False, virtualenv_path=False,
     Can specify a virtualenv to install in.
     Can specify a list of paths or urls to requirement txt files.
     Can specify a local wheels path to use for offline installation.
-    Can request an upgrade.
+    Can specify a mirror (see --serve-mirror) to look for wheels in.
+    Can request an upgrade, and a reinstall of the package and its
+    dependencies even if they are installed already.
     """
     logger.info('Installing {0}...'.format(package))
     pip_cmd = ['pip', 'install']
@@ -256,10 +460,17 @@ def _install_package(package, version=False, pre=False, virtualenv_path=False,
             pip_cmd.extend(['-r', req_file])
     package = '{0}=={1}'.format(package, version) if version else package
     pip_cmd.append(package)
+    if wheels_path:
+        pip_cmd.extend(['--no-index', '--find-links', wheels_path])
+    elif mirror:
+        pip_cmd.extend(['--find-links',
+                        '{0}/wheels/'.format(mirror.rstrip('/'))])
     if pre:
         pip_cmd.append('--pre')
     if upgrade:
         pip_cmd.append('--upgrade')
+    if force_reinstall:
+        pip_cmd.append('--force-reinstall')
     result = _run(' '.join(pip_cmd))
     if not result.returncode == 0:
         logger.error(result.aggr_stdout)
@@ -269,29 +480,695 @@ def _install_package(package, version=False, pre=False, virtualenv_path=False,
         )
 
 
+@_timed('phase')
+def _build_wheels(package, wheels_path, version=False, pre=False,
+                  virtualenv_path=False, requirement_files=None,
+                  pip_args=''):
+    """This will build wheels for a Python package and all of its
+    dependencies into `wheels_path`.
+
+    Takes the same arguments as _install_package, so that the wheels can
+    later be installed offline by passing `wheels_path` to it.
+    """
+    logger.info('Building wheels for {0} in {1}...'.format(
+        package, wheels_path))
+    pip_cmd = ['pip', 'wheel', '--wheel-dir', wheels_path]
+    if pip_args is not None:
+        pip_cmd.extend(pip_args.split())
+    if virtualenv_path:
+        pip_cmd[0] = os.path.join(
+            _get_env_bin_path(virtualenv_path), pip_cmd[0])
+    if requirement_files:
+        for req_file in requirement_files:
+            pip_cmd.extend(['-r', req_file])
+    package = '{0}=={1}'.format(package, version) if version else package
+    pip_cmd.append(package)
+    if pre:
+        pip_cmd.append('--pre')
+    result = _run(' '.join(pip_cmd))
+    if not result.returncode == 0:
+        logger.error(result.aggr_stdout)
+        _exit(
+            message='Could not build wheels for package: {0}.'.format(
+                package),
+            status='wheel_build_failure',
+        )
+
+
+@_timed('extraction')
 def _untar_requirement_files(archive, destination):
     """This will extract requirement files from an archive.
+
+    Only requirement files at the root of the archive, or right under its
+    top level directory (as in GitHub archives), are extracted. The archive
+    is read once as a stream, and reading stops as soon as all requirement
+    files were found.
+    """
+    import tarfile
+    missing = set(REQUIREMENT_FILE_NAMES)
+    with closing(tarfile.open(name=archive, mode='r|*')) as tar:
+        for member in tar:
+            name = member.name[2:] if member.name.startswith('./') \
+                else member.name
+            path = name.split('/')
+            if member.isfile() and len(path) <= 2 and path[-1] in missing:
+                tar.extract(member, path=destination)
+                missing.remove(path[-1])
+                if not missing:
+                    break
+
+
+@_timed('phase')
+def _pack_virtualenv(virtualenv_path, archive):
+    """This will pack a virtualenv into a gzipped tar archive, which can be
+    unpacked elsewhere with _unpack_virtualenv.
+
+    The archive starts with a manifest describing the virtualenv. Compiled
+    python files are left out, as they hold the original path, and so is
+    the state file of the installation.
+    """
+    import tarfile
+    logger.info('Packing Virtualenv {0} into {1}...'.format(
+        virtualenv_path, archive))
+    virtualenv_path = os.path.abspath(virtualenv_path)
+    manifest = {
+        'format': 1,
+        'created': time.time(),
+        'script_version': version_str,
+        'prefix': virtualenv_path,
+        'platform': PLATFORM,
+        'python': [os.path.basename(os.path.dirname(path))
+                   for path in _get_env_site_packages(virtualenv_path)],
+        'cloudify_version': _find_installed_version(
+            virtualenv_path, 'cloudify')[1],
+    }
+    data = json.dumps(manifest, indent=2)
+    info = tarfile.TarInfo(SNAPSHOT_MANIFEST)
+    info.size = len(data)
+    info.mtime = manifest['created']
+
+    def exclude(member):
+        if member.name.endswith(('.pyc', '.pyo')) or \
+                member.name == STATE_FILE:
+            return None
+        return member
+
+    with closing(tarfile.open(name=archive, mode='w:gz')) as tar:
+        tar.addfile(info, StringIO(data))
+        for name in sorted(os.listdir(virtualenv_path)):
+            tar.add(os.path.join(virtualenv_path, name), arcname=name,
+                    filter=exclude)
+    return manifest
+
+
+@_timed('phase')
+def _unpack_virtualenv(archive, virtualenv_path):
+    """This will unpack a virtualenv packed by _pack_virtualenv into
+    `virtualenv_path`, and relocate it there.
+
+    Returns the snapshot's manifest.
+    """
+    import tarfile
+    logger.info('Unpacking Virtualenv snapshot {0} into {1}...'.format(
+        archive, virtualenv_path))
+    virtualenv_path = os.path.abspath(virtualenv_path)
+    manifest = None
+    with closing(tarfile.open(name=archive, mode='r|*')) as tar:
+        for member in tar:
+            if manifest is None:
+                if member.name != SNAPSHOT_MANIFEST:
+                    _exit(
+                        message='{0} is not a Virtualenv snapshot.'.format(
+                            archive),
+                        status='dependency_extraction_failure',
+                    )
+                manifest = json.loads(tar.extractfile(member).read())
+                continue
+            if not _is_safe_snapshot_member(member, virtualenv_path,
+                                            manifest['prefix']):
+                _exit(
+                    message='Unsafe path in Virtualenv snapshot: '
+                            '{0}'.format(member.name),
+                    status='dependency_extraction_failure',
+                )
+            tar.extract(member, path=virtualenv_path)
+    if manifest is None:
+        _exit(
+            message='{0} is not a Virtualenv snapshot.'.format(archive),
+            status='dependency_extraction_failure',
+        )
+    if manifest['platform'] != PLATFORM:
+        logger.warning('The snapshot was created on {0}, not on {1}.'.format(
+            manifest['platform'], PLATFORM))
+    _relocate_virtualenv(virtualenv_path, manifest['prefix'])
+    return manifest
+
+
+def _is_safe_snapshot_member(member, virtualenv_path, old_path):
+    """Returns whether extracting a snapshot member can only write inside
+    `virtualenv_path`.
+
+    The member's path may not be absolute, contain `..` or lead through a
+    symlink extracted earlier to outside the virtualenv. Links must point
+    inside the virtualenv, except that symlinks may point into the python
+    installation the virtualenv is based on, as virtualenv links the
+    standard library. Absolute symlinks into `old_path`, where the snapshot
+    was created, count as inside, as they are relocated.
+    """
+    name = member.name
+    if os.path.isabs(name) or '..' in name.split('/'):
+        return False
+    if not _is_within(os.path.realpath(os.path.join(virtualenv_path, name)),
+                      virtualenv_path):
+        return False
+    if member.islnk():
+        return _is_within(
+            os.path.realpath(os.path.join(virtualenv_path, member.linkname)),
+            virtualenv_path)
+    if member.issym():
+        target = member.linkname
+        if target == old_path or target.startswith(old_path + os.sep):
+            target = virtualenv_path + target[len(old_path):]
+        target = os.path.realpath(os.path.join(
+            virtualenv_path, os.path.dirname(name), target))
+        return any(_is_within(target, root) for root in
+                   [virtualenv_path] + _get_base_prefixes())
+    return True
+
+
+def _is_within(path, directory):
+    directory = os.path.realpath(directory)
+    return path == directory or path.startswith(directory.rstrip(os.sep) +
+                                                os.sep)
+
+
+def _get_base_prefixes():
+    """Returns the installation prefixes of the python that the running
+    interpreter (or the virtualenv it runs in) is based on.
     """
-    with tarfile.open(name=archive) as tar:
-        req_files = [req_file for req_file in tar.getmembers()
-                     if os.path.basename(req_file.name)
-                     in REQUIREMENT_FILE_NAMES]
-        tar.extractall(path=destination, members=req_files)
+    prefixes = set()
+    for name in ('real_prefix', 'base_prefix', 'base_exec_prefix'):
+        if getattr(sys, name, None):
+            prefixes.add(getattr(sys, name))
+    if not IS_VIRTUALENV:
+        prefixes.update([sys.prefix, sys.exec_prefix])
+    return sorted(prefixes)
+
+
+def _relocate_virtualenv(virtualenv_path, old_path):
+    """This will rewrite references to `old_path` left in a virtualenv
+    moved to `virtualenv_path`: script shebangs, activate scripts,
+    .pth and .egg-link files, and absolute symlinks.
+    """
+    # The prefix read from the manifest is unicode. Files (and links) are
+    # rewritten as bytes, which mixed with unicode would be decoded as
+    # ASCII.
+    encoding = sys.getfilesystemencoding() or 'utf-8'
+    if isinstance(old_path, unicode):
+        old_path = old_path.encode(encoding)
+    if isinstance(virtualenv_path, unicode):
+        virtualenv_path = virtualenv_path.encode(encoding)
+    if os.path.abspath(old_path) == os.path.abspath(virtualenv_path):
+        return
+    logger.debug('Relocating Virtualenv from {0} to {1}...'.format(
+        old_path, virtualenv_path))
+    bin_path = os.path.normcase(_get_env_bin_path(virtualenv_path))
+    site_packages = [os.path.normcase(path)
+                     for path in _get_env_site_packages(virtualenv_path)]
+    for root, dirs, files in os.walk(virtualenv_path):
+        for name in files + dirs:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                target = os.readlink(path)
+                if target == old_path or \
+                        target.startswith(old_path + os.sep):
+                    os.remove(path)
+                    os.symlink(virtualenv_path + target[len(old_path):], path)
+            elif name in files and (
+                    os.path.normcase(root) == bin_path or
+                    (os.path.normcase(root) in site_packages and
+                     name.endswith(('.pth', '.egg-link')))):
+                _replace_in_file(path, old_path, virtualenv_path)
+
+
+def _replace_in_file(path, old, new):
+    """Replaces `old` with `new` in a text file, leaving binaries alone."""
+    with open(path, 'rb') as f:
+        content = f.read()
+    if '\0' in content[:DOWNLOAD_CHUNK_SIZE] or old not in content:
+        return
+    with open(path, 'wb') as f:
+        f.write(content.replace(old, new))
+
+
+def _download_file(url, destination, cache=None, segments=1, mirror=None,
+                   sha256=None):
+    """Downloads `url` to `destination`.
+
+    The response is streamed to `destination` from the same connection used
+    to follow any redirects, so each download costs a single request.
+    The file is first written to `<destination>.part`. If the connection
+    drops, the download is resumed from where it stopped using a range
+    request, and a `.part` file left by a previous attempt is resumed too,
+    unless the file changed on the server since (as told by its ETag or
+    Last-Modified date, recorded next to the `.part` file).
+
+    With `segments` > 1, files of at least MIN_SEGMENTED_SIZE bytes served
+    by a server that accepts range requests are downloaded in that many
+    parallel segments.
+
+    If a `_DownloadCache` is provided, a cached copy of the file is
+    revalidated with the server and used if it did not change (or if the
+    server could not be reached), and new downloads are added to the cache.
+
+    If the URL of a mirror served with --serve-mirror is provided, the file
+    is first requested from the mirror, and from `url` if that fails.
 
+    If a `sha256` digest is provided, the file is hashed as it is written
+    and a mismatch raises _IntegrityError, leaving nothing at
+    `destination` or in the cache.
+    """
+    with _profiler.measure('download', url):
+        if mirror and '://' in url and _fetch_from_mirror(
+                mirror, url, destination, cache, sha256):
+            return
+        _fetch_file(url, destination, cache, segments, sha256)
+
+
+class _IntegrityError(IOError):
+    pass
 
-def _download_file(url, destination):
+
+def _check_sha256(url, expected, actual):
+    if expected and expected.lower() != actual:
+        raise _IntegrityError(
+            'SHA-256 of {0} is {1}, expected {2}'.format(
+                url, actual, expected))
+
+
+def _get_sidecar_sha256(url):
+    """Returns the digest published at `url`.sha256, or None if there is
+    none. Both sha256sum's format and a bare digest are accepted.
+    """
+    import urllib2
+    try:
+        with closing(_open_url('{0}.sha256'.format(url))) as response:
+            content = response.read(1024).split()
+    except urllib2.HTTPError as ex:
+        if ex.code == 404:
+            return None
+        raise
+    digest = content[0].lower() if content else ''
+    if len(digest) != 64 or digest.strip('0123456789abcdef'):
+        raise _IntegrityError('Invalid digest in {0}.sha256'.format(url))
+    return digest
+
+
+def _get_mirror_url(mirror, url):
+    import urllib
+    return '{0}/cache/{1}'.format(mirror.rstrip('/'), urllib.quote(url, ''))
+
+
+def _fetch_from_mirror(mirror, url, destination, cache, sha256=None):
+    """Downloads `url` from a mirror. Returns whether it succeeded."""
+    import httplib
+    import urllib2
+    try:
+        digest = _fetch_file(_get_mirror_url(mirror, url), destination,
+                             None, 1, sha256)
+    except (urllib2.URLError, httplib.HTTPException, IOError) as ex:
+        logger.info('Could not get {0} from mirror {1} ({2}), downloading '
+                    'it directly.'.format(url, mirror, ex))
+        _remove_partial('{0}.part'.format(destination))
+        return False
+    if cache:
+        cache.store(url, destination, digest)
+    return True
+
+
+def _fetch_file(url, destination, cache, segments, sha256=None):
+    """Does the work of _download_file, returning the SHA-256 digest of
+    the file.
+    """
+    import urllib2
     logger.info('Downloading {0} to {1}'.format(url, destination))
-    final_url = urllib.urlopen(url).geturl()
+    if '://' not in url and os.path.isfile(url):
+        # Local paths are accepted wherever URLs are (e.g. --source)
+        digest = hashlib.sha256()
+        with open(url, 'rb') as source:
+            with open(destination, 'wb') as f:
+                for chunk in iter(
+                        lambda: source.read(DOWNLOAD_CHUNK_SIZE), ''):
+                    digest.update(chunk)
+                    f.write(chunk)
+        try:
+            _check_sha256(url, sha256, digest.hexdigest())
+        except _IntegrityError:
+            os.remove(destination)
+            raise
+        return digest.hexdigest()
+
+    partial = '{0}.part'.format(destination)
+    offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+    validator = _read_partial_validator(partial) if offset else None
+    if offset and not validator:
+        # Without a validator there is no telling whether the file changed
+        # since the partial file was written, so it can't be resumed
+        logger.debug('Discarding {0}, which can not be validated.'.format(
+            partial))
+        _remove_partial(partial)
+        offset = 0
+    entry = cache.lookup(url) if cache else None
+    headers = dict(_DownloadCache.validators(entry))
+    if validator:
+        # The server sends the whole file instead if it changed
+        headers['If-Range'] = validator
+    try:
+        response = _open_url(url, offset, headers=headers)
+    except urllib2.HTTPError as ex:
+        if ex.code == 304 and entry:
+            logger.debug('{0} was not modified, using cached copy.'.format(
+                url))
+            _check_sha256(url, sha256, entry['sha256'])
+            cache.fetch(url, destination)
+            return entry['sha256']
+        if ex.code == 416 and offset:
+            # The partial file is not a prefix of the current file
+            _remove_partial(partial)
+            return _fetch_file(url, destination, cache, segments, sha256)
+        raise
+    except (urllib2.URLError, IOError) as ex:
+        if entry:
+            logger.warning('Could not reach {0} ({1}), using cached '
+                           'copy.'.format(url, ex))
+            _check_sha256(url, sha256, entry['sha256'])
+            cache.fetch(url, destination)
+            return entry['sha256']
+        raise
+
+    started = time.time()
+    final_url = response.geturl()
     if final_url != url:
         logger.debug('Redirected to {0}'.format(final_url))
-    f = urllib.URLopener()
-    f.retrieve(final_url, destination)
+    headers = response.info()
+    digest = hashlib.sha256()
+    if response.getcode() == 206:
+        logger.info('Resuming download from byte {0}...'.format(offset))
+        _update_digest(digest, partial)
+        size = int(headers.getheader('Content-Range').split('/')[-1])
+    else:
+        offset = 0
+        size = int(headers.getheader('Content-Length') or 0) or None
+        validator = _get_validator(headers)
+        _write_partial_validator(partial, validator)
+
+    if segments > 1 and not offset and (size or 0) >= MIN_SEGMENTED_SIZE and \
+            headers.getheader('Accept-Ranges') == 'bytes':
+        response.close()
+        _download_segments(final_url, partial, size, segments, validator)
+        digest = hashlib.sha256()
+        _update_digest(digest, partial)
+    else:
+        with open(partial, 'r+b' if offset else 'wb') as f:
+            digest = _copy_response(final_url, response, f, offset,
+                                    size - 1 if size else None, digest,
+                                    validator=validator)
+    try:
+        _check_sha256(url, sha256, digest.hexdigest())
+    except _IntegrityError:
+        # Neither resumed nor cached
+        _remove_partial(partial)
+        raise
+    _replace_file(partial, destination)
+    _remove_partial(partial)
+
+    elapsed = max(time.time() - started, 0.001)
+    size = os.path.getsize(destination) - offset
+    logger.info('Downloaded {0} in {1:.1f}s ({2}/s).'.format(
+        _format_size(size), elapsed, _format_size(size / elapsed)))
+    if cache:
+        cache.store(url, destination, digest.hexdigest(),
+                    etag=headers.getheader('ETag'),
+                    last_modified=headers.getheader('Last-Modified'))
+    return digest.hexdigest()
+
+
+def _get_validator(headers):
+    """Returns a validator of the file in a response usable with If-Range,
+    which takes a strong ETag or a Last-Modified date, or None.
+    """
+    etag = headers.getheader('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.getheader('Last-Modified')
+
+
+def _read_partial_validator(partial):
+    try:
+        with open('{0}.validator'.format(partial)) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def _write_partial_validator(partial, validator):
+    """Records the validator of the file being downloaded to `partial`,
+    so that a later attempt can tell whether it may be resumed.
+    """
+    path = '{0}.validator'.format(partial)
+    if validator:
+        with open(path, 'w') as f:
+            f.write(validator)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+
+def _remove_partial(partial):
+    for path in (partial, '{0}.validator'.format(partial)):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _open_url(url, start=0, end=None, headers=None):
+    """Requests `url`, from byte `start` to byte `end` if either is set."""
+    import urllib2
+    headers = dict(headers or {})
+    if start or end is not None:
+        headers['Range'] = 'bytes={0}-{1}'.format(
+            start, '' if end is None else end)
+    return urllib2.urlopen(urllib2.Request(url, headers=headers))
+
+
+def _copy_response(url, response, f, position, end, digest=None,
+                   segment=False, validator=None):
+    """Writes `response`, holding `url` from byte `position`, to `f`.
+
+    `end` is the last byte expected (None if unknown). If the transfer is
+    cut short, it is resumed with a range request from where it stopped, up
+    to DOWNLOAD_RETRIES times. Unless this is a `segment` of a file, the
+    download is restarted if the server doesn't support range requests.
+    If a `digest` is provided it is updated with everything written to `f`
+    and returned. Resumed requests carry `validator` as If-Range, so that
+    a file that changed meanwhile is not resumed.
+    """
+    import httplib
+    retries = DOWNLOAD_RETRIES
+    while True:
+        try:
+            if response is None:
+                response = _open_url(
+                    url, position, end,
+                    headers={'If-Range': validator} if validator else None)
+                if response.getcode() != 206:
+                    if segment:
+                        raise IOError('The file changed or range requests '
+                                      'are not supported.')
+                    # The whole file is being sent again
+                    position = 0
+                    f.truncate(0)
+                    if digest is not None:
+                        digest = hashlib.sha256()
+            f.seek(position)
+            with closing(response):
+                for chunk in iter(
+                        lambda: response.read(DOWNLOAD_CHUNK_SIZE), ''):
+                    f.write(chunk)
+                    position += len(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+            if end is None or position > end:
+                return digest
+            error = 'connection closed at byte {0}'.format(position)
+        except (IOError, httplib.HTTPException) as ex:
+            error = str(ex) or repr(ex)
+        if not retries:
+            raise IOError('Download of {0} failed ({1})'.format(url, error))
+        retries -= 1
+        response = None
+        logger.warning('Download of {0} interrupted ({1}), resuming from '
+                       'byte {2}...'.format(url, error, position))
+
+
+def _download_segments(url, destination, size, segments, validator=None):
+    """Downloads `url`, which is `size` bytes long, in parallel segments.
+
+    `validator` identifies the file, as for _copy_response.
+    """
+    logger.debug('Downloading {0} in {1} segments...'.format(url, segments))
+    with open(destination, 'wb') as f:
+        f.truncate(size)
+    errors = []
+
+    def download_segment(start, end):
+        try:
+            with open(destination, 'r+b') as f:
+                _copy_response(url, None, f, start, end, segment=True,
+                               validator=validator)
+        except Exception as ex:
+            errors.append(ex)
+
+    bounds = [size * i // segments for i in range(segments + 1)]
+    threads = [Thread(target=download_segment, args=(start, end - 1))
+               for start, end in zip(bounds, bounds[1:])]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        _join(thread)
+    if errors:
+        raise errors[0]
+
+
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{0:.1f}{1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f}GB'.format(size)
+
+
+def _replace_file(source, destination):
+    """Renames `source` to `destination`, replacing it if it exists."""
+    # os.rename won't replace an existing file on Windows
+    if IS_WIN and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+def _update_digest(digest, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), ''):
+            digest.update(chunk)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    _update_digest(digest, path)
+    return digest.hexdigest()
 
 
 def _get_os_props():
-    distro, _, release = platform.linux_distribution(
-        full_distribution_name=False)
-    return distro, release
+    """Returns the (distro, release) of the running Linux distribution.
+
+    Detection runs once per process, as it is the same for every
+    CloudifyInstaller.
+    """
+    global _os_props
+    if _os_props is None:
+        _os_props = _detect_os_props()
+        logger.debug('Detected distribution: {0} {1}'.format(*_os_props))
+    return _os_props
+
+
+def _detect_os_props(root=os.sep):
+    """Detects the distribution and release from the files under `root`.
+
+    /etc/os-release is used when present, then older distribution specific
+    files, and platform.linux_distribution as a last resort. Distribution
+    IDs are lowercase and named as platform.linux_distribution names them,
+    e.g. redhat rather than rhel. Returns empty strings when not on Linux
+    or if the distribution is unknown.
+    """
+    if not IS_LINUX:
+        return '', ''
+
+    def path(*parts):
+        return os.path.join(root, 'etc', *parts)
+
+    for os_release in (path('os-release'),
+                       os.path.join(root, 'usr', 'lib', 'os-release')):
+        fields = _parse_release_file(os_release)
+        if fields.get('ID'):
+            return _get_distro_id(fields), fields.get('VERSION_ID', '')
+
+    fields = _parse_release_file(path('lsb-release'))
+    if fields.get('DISTRIB_ID'):
+        return fields['DISTRIB_ID'].lower(), fields.get('DISTRIB_RELEASE', '')
+
+    for name in ('centos-release', 'fedora-release', 'redhat-release'):
+        try:
+            with open(path(name)) as f:
+                # e.g. CentOS release 6.7 (Final)
+                words = f.readline().split()
+        except IOError:
+            continue
+        release = ([w for w in words if w[:1].isdigit()] or [''])[0]
+        distro = 'redhat' if words[:2] == ['Red', 'Hat'] else \
+            (words[0].lower() if words else name.split('-')[0])
+        if distro not in KNOWN_DISTROS:
+            # A derivative, e.g. Rocky Linux release 8.5 (Green Obsidian)
+            distro = name.split('-')[0]
+        return distro, release
+
+    try:
+        with open(path('debian_version')) as f:
+            return 'debian', f.read().strip()
+    except IOError:
+        pass
+    if os.path.isfile(path('arch-release')):
+        return 'archlinux', ''
+
+    import platform
+    if root == os.sep and hasattr(platform, 'linux_distribution'):
+        distro, release, _ = platform.linux_distribution(
+            full_distribution_name=False)
+        return distro.lower(), release
+    return '', ''
+
+
+def _get_distro_id(fields):
+    """Returns the distribution ID of parsed os-release `fields`, named
+    after the distribution it derives from (see DISTRO_FAMILIES) if it is
+    not a known one.
+    """
+    distro = fields['ID'].lower()
+    distro = DISTRO_ALIASES.get(distro, distro)
+    if distro not in KNOWN_DISTROS:
+        for like in fields.get('ID_LIKE', '').lower().split():
+            if like in DISTRO_FAMILIES:
+                return DISTRO_FAMILIES[like]
+    return distro
+
+
+def _parse_release_file(path):
+    """Parses the KEY=value lines of an os-release style file. Returns an
+    empty dict if the file can't be read.
+    """
+    fields = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, separator, value = line.strip().partition('=')
+                if not separator or key.startswith('#'):
+                    continue
+                value = value.strip()
+                if len(value) > 1 and value[0] == value[-1] and \
+                        value[0] in '"\'':
+                    value = value[1:-1]
+                fields[key] = value.replace('\\', '')
+    except IOError:
+        pass
+    return fields
 
 
 def _get_env_bin_path(env_path):
@@ -302,25 +1179,593 @@ def _get_env_bin_path(env_path):
     return os.path.join(env_path, 'scripts' if IS_WIN else 'bin')
 
 
+def _get_env_site_packages(env_path):
+    """returns the existing site-packages directories of a virtualenv
+    """
+    candidates = [os.path.join(env_path, 'Lib', 'site-packages'),
+                  os.path.join(env_path, 'site-packages')]
+    for lib in ('lib', 'lib64'):
+        lib_path = os.path.join(env_path, lib)
+        if os.path.isdir(lib_path):
+            candidates.extend(
+                os.path.join(lib_path, name, 'site-packages')
+                for name in sorted(os.listdir(lib_path))
+                if name.startswith(('python', 'pypy')))
+    found = []
+    for path in candidates:
+        if os.path.isdir(path) and os.path.realpath(path) not in \
+                [os.path.realpath(p) for p in found]:
+            found.append(path)
+    return found
+
+
+def _find_installed_version(env_path, distribution):
+    """Looks up a distribution in the site-packages of a virtualenv by
+    its dist-info/egg-info metadata, without starting the virtualenv's
+    interpreter.
+
+    Returns a tuple of (installed, version). `installed` is None when the
+    metadata can't tell, e.g. when no site-packages directory was found or
+    the distribution was installed in develop mode.
+    """
+    site_packages = _get_env_site_packages(env_path)
+    if not site_packages:
+        return None, None
+    return _Inventory(site_packages).find(distribution)
+
+
+class _Inventory(object):
+    """An index of the distributions and top-level modules in a set of
+    directories, built by listing each directory once.
+
+    Distributions are found by their dist-info/egg-info metadata and
+    egg-links, modules by their packages (directories with an __init__
+    module) and module files. Where a name is
+    found in several directories the first one wins, as it does on import.
+    """
+    METADATA_EXTENSIONS = ('.dist-info', '.egg-info', '.egg', '.egg-link')
+    MODULE_EXTENSIONS = ('.py', '.pyc', '.pyo', '.so', '.pyd')
+    PACKAGE_INIT_FILES = ('__init__.py', '__init__.pyc')
+
+    def __init__(self, paths):
+        self.paths = paths
+        # Both keyed by normalized name
+        self.distributions = {}
+        self.modules = {}
+        for path in paths:
+            self._scan(path)
+
+    @classmethod
+    def for_env(cls, env_path):
+        return cls(_get_env_site_packages(env_path))
+
+    @classmethod
+    def for_interpreter(cls):
+        """Returns the inventory of the import path of the running
+        interpreter.
+        """
+        return cls([path for path in sys.path if path and os.path.isdir(path)])
+
+    @staticmethod
+    def normalize(name):
+        return name.lower().replace('-', '_')
+
+    def _scan(self, path):
+        try:
+            entries = sorted(os.listdir(path))
+        except OSError as ex:
+            logger.debug('Could not list {0}: {1}'.format(path, ex))
+            return
+        for entry in entries:
+            base, ext = os.path.splitext(entry)
+            if ext in self.METADATA_EXTENSIONS:
+                name, _, version = base.partition('-')
+                # Strip the python tag of eggs, e.g. 3.4-py2.7. Egg-links
+                # point at a develop mode checkout, so carry no version.
+                version = version.split('-py')[0] \
+                    if ext != '.egg-link' else ''
+                self.distributions.setdefault(self.normalize(name), {
+                    'name': name,
+                    'version': version or None,
+                    'location': path,
+                })
+            elif ext in self.MODULE_EXTENSIONS or (
+                    not ext and self._is_package(os.path.join(path, entry))):
+                # Extension modules may carry an ABI tag, e.g.
+                # _speedups.cpython-36m-x86_64-linux-gnu.so
+                self.modules.setdefault(self.normalize(entry.split('.')[0]),
+                                        path)
+
+    def _is_package(self, path):
+        # Other directories (data, leftovers of uninstalled packages) can't
+        # be imported
+        return any(os.path.isfile(os.path.join(path, init))
+                   for init in self.PACKAGE_INIT_FILES)
+
+    def find(self, distribution):
+        """Returns a tuple of (installed, version) of a distribution, with
+        the same meaning as `_find_installed_version`.
+        """
+        name = self.normalize(distribution)
+        found = self.distributions.get(name)
+        if found and found['version']:
+            return True, found['version']
+        if found or name in self.modules:
+            return None, None
+        return False, None
+
+    def has_module(self, module):
+        return self.normalize(module) in self.modules
+
+    def format(self):
+        """Returns a table of the distributions in the inventory."""
+        dists = sorted(self.distributions.values(),
+                       key=lambda dist: dist['name'].lower())
+        rows = [('Name', 'Version', 'Location')] + [
+            (dist['name'], dist['version'] or '-', dist['location'])
+            for dist in dists]
+        widths = [max(len(row[i]) for row in rows) for i in range(2)]
+        return '\n'.join(
+            '{0}  {1}  {2}'.format(row[0].ljust(widths[0]),
+                                   row[1].ljust(widths[1]), row[2])
+            for row in rows)
+
+
 # Underscored as not part of public interface
 # Looks ugly, but is at least explicit
 class _PipeReader(Thread):
-    def __init__(self, fd, proc, logger, log_level):
+    """Reads a pipe until EOF, logging each line and aggregating the output.
+
+    Lines are kept as a list of chunks and only joined when `aggr` is
+    accessed, so the cost of capturing is linear in the size of the output.
+    When `max_size` is set, only the first ('head') or last ('tail') bytes
+    of the output are kept, according to `keep`, and `truncated` is set.
+    """
+    def __init__(self, fd, logger, log_level, max_size=None, keep='tail'):
         Thread.__init__(self)
+        if keep not in ('head', 'tail'):
+            raise ValueError('keep must be either head or tail.')
         self.fd = fd
-        self.proc = proc
         self.logger = logger
         self.log_level = log_level
-        self.aggr = ''
+        self.max_size = max_size
+        self.keep = keep
+        self.truncated = False
+        self._chunks = deque()
+        self._size = 0
+
+    @property
+    def aggr(self):
+        return ''.join(self._chunks)
 
     def run(self):
-        while self.proc.poll() is None:
-            output = self.fd.readline()
-            if len(output) > 0:
-                self.aggr += output
-                self.logger.log(self.log_level, output)
+        for output in iter(self.fd.readline, ''):
+            self._store(output)
+            self.logger.log(self.log_level, output)
+        self.fd.close()
+
+    def _store(self, output):
+        if self.max_size is None:
+            self._chunks.append(output)
+            return
+
+        if self.keep == 'head':
+            room = self.max_size - self._size
+            if len(output) > room:
+                self.truncated = True
+                output = output[:room]
+            if output:
+                self._chunks.append(output)
+                self._size += len(output)
+            return
+
+        self._chunks.append(output)
+        self._size += len(output)
+        while self._size > self.max_size:
+            self.truncated = True
+            excess = self._size - self.max_size
+            oldest = self._chunks.popleft()
+            if len(oldest) > excess:
+                self._chunks.appendleft(oldest[excess:])
+                self._size -= excess
             else:
-                time.sleep(PROCESS_POLLING_INTERVAL)
+                self._size -= len(oldest)
+
+
+class _DownloadCache(object):
+    """A content addressed cache of downloaded files.
+
+    Files are stored under their SHA-256 digest. An index maps each URL to
+    the digest of its last download, along with the ETag and Last-Modified
+    headers it was served with, so that it can be revalidated using a
+    conditional request. Once the cache grows beyond `max_size` bytes, the
+    least recently used files are evicted.
+
+    Failing to read or write the cache is never fatal; the file will simply
+    be downloaded again.
+    """
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, path, max_size=CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._lock = Lock()
+
+    def lookup(self, url):
+        """Returns the index entry for `url` if its file is intact."""
+        with self._lock:
+            entry = self._load_index().get(url)
+            if entry is None:
+                return None
+            try:
+                if _file_sha256(self._blob_path(entry['sha256'])) == \
+                        entry['sha256']:
+                    return entry
+            except (IOError, OSError):
+                pass
+            logger.debug('Discarding invalid cache entry for {0}'.format(
+                url))
+            return None
+
+    @staticmethod
+    def validators(entry):
+        """Returns the headers to revalidate a cache entry with."""
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def get_path(self, entry):
+        """Returns the path of the cached file of an index entry."""
+        return self._blob_path(entry['sha256'])
+
+    def fetch(self, url, destination):
+        """Copies the cached file for `url` to `destination`."""
+        with self._lock:
+            index = self._load_index()
+            shutil.copyfile(self._blob_path(index[url]['sha256']),
+                            destination)
+            index[url]['last_used'] = time.time()
+            self._save_index(index)
+
+    def store(self, url, path, sha256, etag=None, last_modified=None):
+        """Adds the file at `path`, downloaded from `url`, to the cache."""
+        with self._lock:
+            try:
+                if not os.path.isdir(self.path):
+                    # The cache is in the home of the user who ran sudo,
+                    # who has to be able to use it without sudo later
+                    _make_dirs(self.path)
+                blob = self._blob_path(sha256)
+                if not os.path.isfile(blob):
+                    partial = '{0}.{1}.part'.format(blob, os.getpid())
+                    shutil.copyfile(path, partial)
+                    _chown_to_sudo_user(partial)
+                    _replace_file(partial, blob)
+                index = self._load_index()
+                index[url] = {
+                    'sha256': sha256,
+                    'size': os.path.getsize(blob),
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'last_used': time.time(),
+                }
+                self._evict(index)
+                self._save_index(index)
+            except (IOError, OSError) as ex:
+                logger.debug('Could not cache {0} ({1})'.format(url, ex))
+
+    def _evict(self, index):
+        def size(entries):
+            return sum(dict((entry['sha256'], entry['size'])
+                            for entry in entries).values())
+
+        by_age = sorted(index.items(), key=lambda item: item[1]['last_used'])
+        while by_age and size(index.values()) > self.max_size:
+            url, entry = by_age.pop(0)
+            del index[url]
+            # A file can be shared by several URLs
+            if entry['sha256'] not in [e['sha256'] for e in index.values()]:
+                logger.debug('Evicting {0} from the cache.'.format(url))
+                os.remove(self._blob_path(entry['sha256']))
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.path, sha256)
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.path, self.INDEX_FILE)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        path = os.path.join(self.path, self.INDEX_FILE)
+        partial = '{0}.{1}.part'.format(path, os.getpid())
+        try:
+            with open(partial, 'w') as f:
+                json.dump(index, f)
+            _chown_to_sudo_user(partial)
+            _replace_file(partial, path)
+        except (IOError, OSError) as ex:
+            logger.debug('Could not update the cache index ({0})'.format(ex))
+
+
+def _make_mirror_server(address, cache=None, wheelhouse=None):
+    """Returns an HTTP server serving `cache` and `wheelhouse` on `address`.
+
+    The server classes are defined here, as their bases are only imported
+    when a mirror is actually served.
+    """
+    import BaseHTTPServer
+    import SocketServer
+    import urllib
+    import urlparse
+
+    class MirrorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """Serves the download cache under /cache/<quoted URL>, and the files
+        of a wheelhouse under /wheels/, with an index pip can use with
+        --find-links.
+        """
+        def do_GET(self):
+            self.respond(send_body=True)
+
+        def do_HEAD(self):
+            self.respond(send_body=False)
+
+        def respond(self, send_body):
+            path = urlparse.urlparse(self.path).path
+            cache, wheelhouse = self.server.cache, self.server.wheelhouse
+            if path.startswith('/cache/') and cache:
+                entry = cache.lookup(urllib.unquote(path[len('/cache/'):]))
+                if entry:
+                    return self.send_file(cache.get_path(entry), send_body,
+                                          etag=entry['sha256'])
+            elif path in ('/wheels', '/wheels/') and wheelhouse:
+                return self.send_wheel_index(send_body)
+            elif path.startswith('/wheels/') and wheelhouse:
+                name = urllib.unquote(path[len('/wheels/'):])
+                if '/' not in name and name not in ('', '.', '..') and \
+                        os.path.isfile(os.path.join(wheelhouse, name)):
+                    return self.send_file(os.path.join(wheelhouse, name),
+                                          send_body)
+            self.send_error(404)
+
+        def send_wheel_index(self, send_body):
+            links = ''.join(
+                '<a href="{0}">{1}</a><br>\n'.format(urllib.quote(name), name)
+                for name in sorted(os.listdir(self.server.wheelhouse)))
+            body = '<html><body>\n{0}</body></html>\n'.format(links)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+        def send_file(self, path, send_body, etag=None):
+            with open(path, 'rb') as f:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length',
+                                 str(os.fstat(f.fileno()).st_size))
+                if etag:
+                    self.send_header('ETag', '"{0}"'.format(etag))
+                self.end_headers()
+                if send_body:
+                    shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK_SIZE)
+
+        def log_message(self, format, *args):
+            logger.debug('Mirror: {0} - {1}'.format(
+                self.address_string(), format % args))
+
+    class MirrorServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = MirrorServer(address, MirrorRequestHandler)
+    server.cache = cache
+    server.wheelhouse = wheelhouse
+    return server
+
+
+def _parse_address(address):
+    """Parses [HOST:]PORT into a (host, port) tuple."""
+    host, _, port = address.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def _serve_mirror(address, cache, wheelhouse=None):
+    """Serves the download cache and a wheelhouse to other hosts running
+    this script with --mirror, until interrupted.
+    """
+    server = _make_mirror_server(_parse_address(address), cache, wheelhouse)
+    host, port = server.server_address[:2]
+    logger.info('Serving the download cache{0} on http://{1}:{2}/. Use '
+                '--mirror http://<this host>:{2} on other hosts. Press '
+                'Ctrl+C to stop.'.format(
+                    ' and {0}'.format(wheelhouse) if wheelhouse else '',
+                    host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class _DownloadManager(object):
+    """Downloads files in the background, so that they are ready by the
+    time they are needed.
+
+    prefetch() starts downloading a URL to a temporary directory. fetch()
+    then moves it to where it is needed, waiting for it if it is still
+    being downloaded. URLs that were not prefetched are downloaded by
+    fetch() itself.
+
+    Downloads are checked against the SHA-256 `digests` pinned for their
+    URL. With `verify`, URLs without a pinned digest are checked against
+    the digest published next to them as <URL>.sha256, and rejected if
+    there is none.
+    """
+    def __init__(self, cache=None, mirror=None, digests=None, verify=False):
+        self.cache = cache
+        self.mirror = mirror
+        self.digests = digests or {}
+        self.verify = verify
+        self.path = None
+        self._downloads = {}
+        self._lock = Lock()
+
+    def prefetch(self, url):
+        import tempfile
+        import urlparse
+        with self._lock:
+            if url in self._downloads:
+                return
+            if self.path is None:
+                self.path = tempfile.mkdtemp()
+                _chown_to_sudo_user(self.path)
+            download = {
+                'path': os.path.join(self.path, '{0}-{1}'.format(
+                    len(self._downloads),
+                    os.path.basename(urlparse.urlparse(url).path))),
+                'done': Event(),
+                'error': None,
+            }
+            self._downloads[url] = download
+        logger.debug('Prefetching {0}...'.format(url))
+        thread = Thread(target=self._download, args=(url, download),
+                        name='prefetch-{0}'.format(len(self._downloads)))
+        thread.daemon = True
+        thread.start()
+
+    def get_sha256(self, url):
+        """Returns the digest `url` must match, if any."""
+        if url in self.digests:
+            return self.digests[url]
+        if self.verify and '://' in url:
+            digest = _get_sidecar_sha256(url)
+            if not digest:
+                raise _IntegrityError(
+                    'No SHA-256 digest is pinned or published for '
+                    '{0}'.format(url))
+            return digest
+        return None
+
+    def _download(self, url, download):
+        try:
+            _download_file(url, download['path'], cache=self.cache,
+                           mirror=self.mirror, sha256=self.get_sha256(url))
+        except Exception:
+            download['error'] = sys.exc_info()
+        finally:
+            download['done'].set()
+
+    def fetch(self, url, destination):
+        """Downloads `url` to `destination`, or moves it there if it was
+        prefetched. Download errors are raised here.
+        """
+        with self._lock:
+            download = self._downloads.pop(url, None)
+        if download is None:
+            return _download_file(url, destination, cache=self.cache,
+                                  mirror=self.mirror,
+                                  sha256=self.get_sha256(url))
+        while not download['done'].wait(WAIT_INTERVAL):
+            pass
+        if download['error']:
+            raise download['error'][0], download['error'][1], \
+                download['error'][2]
+        shutil.move(download['path'], destination)
+
+    def cleanup(self):
+        """Removes prefetched files that were not fetched."""
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+
+class _StepScheduler(object):
+    """Runs steps in threads, each as soon as the steps it requires are done.
+
+    If a step fails (this includes calling _exit), no further steps are
+    started and, once the running ones are done, its error is raised by
+    `run`.
+    """
+    def __init__(self):
+        self._steps = []
+        self._requires = {}
+        self.timings = {}
+
+    def add(self, name, func, requires=()):
+        """Adds a step. Required steps that were never added are ignored."""
+        self._steps.append((name, func))
+        self._requires[name] = set(requires)
+
+    def run(self):
+        names = set(name for name, _ in self._steps)
+        pending = list(self._steps)
+        done = set()
+        running = set()
+        errors = []
+        condition = Condition()
+        started = time.time()
+
+        def run_step(name, func):
+            step_start = time.time() - started
+            try:
+                func()
+            except BaseException:
+                logger.debug('Step {0} failed.'.format(name), exc_info=True)
+                errors.append(sys.exc_info())
+            with condition:
+                self.timings[name] = (step_start, time.time() - started)
+                running.remove(name)
+                done.add(name)
+                condition.notify()
+
+        with condition:
+            while pending or running:
+                for name, func in list(pending):
+                    if errors:
+                        pending = []
+                        break
+                    if self._requires[name] & names <= done:
+                        pending.remove((name, func))
+                        running.add(name)
+                        thread = Thread(target=run_step, args=(name, func))
+                        thread.daemon = True
+                        thread.start()
+                if running:
+                    condition.wait(WAIT_INTERVAL)
+        if errors:
+            # Raised with the traceback of the step that failed
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def critical_path(self):
+        """Returns the chain of steps that determined the total duration."""
+        path = []
+        candidates = list(self.timings)
+        while candidates:
+            name = max(candidates, key=lambda step: self.timings[step][1])
+            path.insert(0, name)
+            candidates = [step for step in self._requires[name]
+                          if step in self.timings]
+        return path
+
+    def log_summary(self):
+        critical_path = self.critical_path()
+        logger.info('Step timings (* marks the critical path):')
+        for name, _ in self._steps:
+            if name in self.timings:
+                start, end = self.timings[name]
+                logger.info('  {0} {1:<12} {2:>7.1f}s (started at {3:.1f}s)'
+                            .format('*' if name in critical_path else ' ',
+                                    name, end - start, start))
 
 
 class ArgumentNotValidForOS(Exception):
@@ -346,6 +1791,15 @@ class CloudifyInstaller():
                  install_virtualenv=False,
                  install_pythondev=False,
                  install_pycrypto=False,
+                 cache_dir=DEFAULT_CACHE_DIR,
+                 no_cache=False,
+                 wheelhouse=None,
+                 build_wheelhouse=None,
+                 snapshot_in=None,
+                 snapshot_out=None,
+                 mirror=None,
+                 sha256_digests=None,
+                 verify_downloads=False,
                  os_distro=None,
                  os_release=None):
         self.force = force
@@ -361,6 +1815,23 @@ class CloudifyInstaller():
         self.install_virtualenv = install_virtualenv
         self.install_pythondev = install_pythondev
         self.install_pycrypto = install_pycrypto
+        self.cache = None if no_cache else _DownloadCache(cache_dir)
+        self.wheelhouse = wheelhouse
+        self.build_wheelhouse = build_wheelhouse
+        self.snapshot_in = snapshot_in
+        self.snapshot_out = snapshot_out
+        self.mirror = mirror
+        self.downloads = _DownloadManager(self.cache, mirror,
+                                          digests=sha256_digests,
+                                          verify=verify_downloads)
+        # Set by check_cloudify_installed when the metadata tells
+        self.installed_version = None
+        # The state recorded by the last successful installation, if any
+        self.state = None
+        # Set by handle_upgrade when that installation has to be updated
+        self.reinstall = False
+        # Built on first use by get_inventory
+        self.inventory = None
 
         # When using the command line it should be impossible to reach these.
         # However, if importing this class to use elsewhere they can be, so
@@ -384,6 +1855,22 @@ class CloudifyInstaller():
                 'Setting more than one of version, pre, and source '
                 'is not supported.'
             )
+        if wheelhouse and build_wheelhouse:
+            raise ArgumentCombinationInvalid(
+                'Setting both wheelhouse and build_wheelhouse '
+                'is not supported.'
+            )
+        if (snapshot_in or snapshot_out) and not virtualenv:
+            raise ArgumentCombinationInvalid(
+                'Snapshots can only be used with a virtualenv.'
+            )
+        if snapshot_in and (snapshot_out or version or pre or source or
+                            with_requirements or wheelhouse or
+                            build_wheelhouse):
+            raise ArgumentCombinationInvalid(
+                'Installing from a snapshot can not be combined with '
+                'other installation sources.'
+            )
 
         os_props = _get_os_props()
         self.distro = os_distro or os_props[0].lower()
@@ -400,53 +1887,193 @@ class CloudifyInstaller():
 
         package = self.source or 'cloudify'
 
+        self.state = self.load_state()
+        if self.state and not self.upgrade and self.is_satisfied(self.state):
+            logger.info('Cloudify {0}is already installed as requested, '
+                        'nothing to do. Use the --upgrade flag to '
+                        'reinstall it.'.format(
+                            '{0} '.format(self.state['installed_version'])
+                            if self.state['installed_version'] else ''))
+            if self.virtualenv:
+                self.log_activate_command()
+            return
+
         self.handle_upgrade()
 
+        if self.snapshot_in:
+            self.install_snapshot()
+            self.save_state()
+            self.log_activate_command()
+            return
+
+        # if with_requirements is not provided, this will be False.
+        # if it's provided without a value, it will be a list.
+        find_requirements = isinstance(self.with_requirements, list) \
+            and not self.with_requirements
+        download_source = find_requirements and self.source and \
+            not os.path.exists(self.source)
+        self.prefetch_downloads(download_source)
+
+        # Steps that don't depend on each other, e.g. installing python-dev
+        # and downloading the source, are run concurrently.
+        steps = _StepScheduler()
         if self.force or self.install_pip:
-            self.get_pip()
+            steps.add('pip', self.get_pip)
 
         if self.virtualenv:
             if self.force or self.install_virtualenv:
-                self.get_virtualenv()
+                steps.add('virtualenv', self.get_virtualenv,
+                          requires=['pip'])
             env_bin_path = _get_env_bin_path(self.virtualenv)
 
         if IS_LINUX and (self.force or self.install_pythondev):
-            self.get_pythondev(self.distro)
-        if (IS_VIRTUALENV or self.virtualenv) and not IS_WIN:
-            # drop root permissions so that installation is done using the
-            # current user.
-            _drop_root_privileges()
-        if self.virtualenv:
-            if not os.path.isfile(os.path.join(
-                    env_bin_path, ('activate.bat' if IS_WIN else 'activate'))):
-                _make_virtualenv(self.virtualenv, self.python_path)
+            steps.add('pythondev',
+                      lambda: self.get_pythondev(self.distro))
+        drop_root = (IS_VIRTUALENV or self.virtualenv) and not IS_WIN
+
+        def make_environment():
+            if drop_root:
+                # drop root permissions so that installation is done using
+                # the current user.
+                _drop_root_privileges()
+            if self.virtualenv:
+                if not os.path.isfile(os.path.join(
+                        env_bin_path,
+                        ('activate.bat' if IS_WIN else 'activate'))):
+                    _make_virtualenv(self.virtualenv, self.python_path)
+        # Requires every step that may need root privileges
+        steps.add('environment', make_environment,
+                  requires=['pip', 'virtualenv', 'pythondev'])
 
         if IS_WIN and (self.force or self.install_pycrypto):
-            self.get_pycrypto(self.virtualenv)
+            steps.add('pycrypto', lambda: self.get_pycrypto(self.virtualenv),
+                      requires=['environment'])
+
+        source_dir = None
+        if download_source:
+            # Download the source once, both to look for requirement
+            # files in it and for pip to install it from.
+            import tempfile
+            source_dir = tempfile.mkdtemp()
+            if drop_root:
+                _chown_to_sudo_user(source_dir)
+            source = {}
+
+            def get_source():
+                source['archive'] = self._download_source(
+                    self.source, source_dir, downloads=self.downloads)
+            steps.add('source', get_source)
+
+        try:
+            steps.run()
+            steps.log_summary()
+            if source_dir:
+                package = source['archive']
+            # Kept apart from self.with_requirements, which is part of the
+            # recorded request, as the files found are temporary
+            requirement_files = self.with_requirements
+            if find_requirements:
+                requirement_files = self._get_default_requirement_files(
+                    package, downloads=self.downloads)
+
+            wheelhouse = self.wheelhouse
+            if self.build_wheelhouse:
+                _build_wheels(package=package,
+                              wheels_path=self.build_wheelhouse,
+                              version=self.version,
+                              pre=self.pre,
+                              pip_args=self.pip_args,
+                              virtualenv_path=self.virtualenv,
+                              requirement_files=requirement_files)
+                # Install from the new wheelhouse, which also verifies
+                # that it is enough for installing offline.
+                wheelhouse = self.build_wheelhouse
+                package = 'cloudify'
+                requirement_files = None
+
+            _install_package(package=package,
+                             version=self.version,
+                             pre=self.pre,
+                             pip_args=self.pip_args,
+                             virtualenv_path=self.virtualenv,
+                             requirement_files=requirement_files,
+                             upgrade=self.upgrade or self.reinstall,
+                             force_reinstall=self.reinstall,
+                             wheels_path=wheelhouse,
+                             mirror=self.mirror)
+        finally:
+            if source_dir:
+                shutil.rmtree(source_dir)
+            self.downloads.cleanup()
+
+        self.save_state()
+        if self.snapshot_out:
+            _pack_virtualenv(self.virtualenv, self.snapshot_out)
+        if self.virtualenv:
+            self.log_activate_command()
 
-        # if with_requirements is not provided, this will be False.
-        # if it's provided without a value, it will be a list.
-        if isinstance(self.with_requirements, list):
-            self.with_requirements = self.with_requirements \
-                or self._get_default_requirement_files(self.source)
-
-        _install_package(package=package,
-                         version=self.version,
-                         pre=self.pre,
-                         pip_args=self.pip_args,
-                         virtualenv_path=self.virtualenv,
-                         requirement_files=self.with_requirements,
-                         upgrade=self.upgrade)
+    def prefetch_downloads(self, download_source):
+        """Starts downloading everything the installation will need, so
+        that downloads overlap each other and the other steps.
+        """
+        if (self.force or self.install_pip) and not self.is_installed('pip'):
+            self.downloads.prefetch(PIP_URL)
+        if IS_WIN and (self.force or self.install_pycrypto):
+            self.downloads.prefetch(self.get_pycrypto_url())
+        if download_source:
+            self.downloads.prefetch(self.source)
+
+    def log_activate_command(self):
+        activate_path = os.path.join(
+            _get_env_bin_path(self.virtualenv), 'activate')
+        activate_command = \
+            '{0}.bat'.format(activate_path) if IS_WIN \
+            else 'source {0}'.format(activate_path)
+        logger.info('You can now run: "{0}" to activate '
+                    'the Virtualenv.'.format(activate_command))
+
+    @_timed('phase')
+    def install_snapshot(self):
+        """Installs by unpacking a virtualenv snapshot instead of creating
+        the virtualenv and running pip.
+        """
+        import tempfile
+        if not IS_WIN:
+            _drop_root_privileges()
+        snapshot = self.snapshot_in
+        tempdir = None
+        if not os.path.isfile(snapshot):
+            tempdir = tempfile.mkdtemp()
+            snapshot = os.path.join(tempdir, 'snapshot.tar.gz')
+            try:
+                self.downloads.fetch(self.snapshot_in, snapshot)
+            except Exception as ex:
+                shutil.rmtree(tempdir)
+                _exit(
+                    message='Could not download snapshot {0}: {1}'.format(
+                        self.snapshot_in, ex),
+                    status='dependency_download_failure',
+                )
+        try:
+            manifest = _unpack_virtualenv(snapshot, self.virtualenv)
+        finally:
+            if tempdir:
+                shutil.rmtree(tempdir)
+        logger.info('Installed Cloudify {0} from snapshot.'.format(
+            manifest['cloudify_version'] or ''))
 
-        if self.virtualenv:
-            activate_path = os.path.join(env_bin_path, 'activate')
-            activate_command = \
-                '{0}.bat'.format(activate_path) if IS_WIN \
-                else 'source {0}'.format(activate_path)
-            logger.info('You can now run: "{0}" to activate '
-                        'the Virtualenv.'.format(activate_command))
+    def get_inventory(self):
+        """Returns the inventory of the running interpreter, scanning its
+        import path on the first call.
+        """
+        if self.inventory is None:
+            self.inventory = _Inventory.for_interpreter()
+        return self.inventory
 
     def is_installed(self, module):
+        if self.get_inventory().has_module(module):
+            return True
+        # Builtin modules and modules in zip archives aren't indexed
         if hasattr(importlib, 'find_loader'):
             found = importlib.find_loader(module)
         else:
@@ -460,21 +2087,25 @@ class CloudifyInstaller():
         else:
             return False
 
+    @_timed('phase')
     def get_virtualenv(self):
         if not self.is_installed('virtualenv'):
             logger.info('Installing virtualenv...')
             _install_package('virtualenv', pip_args=self.pip_args)
+            self.inventory = None
         else:
             logger.info('virtualenv is already installed in the path.')
 
+    @_timed('phase')
     def get_pip(self):
+        import tempfile
         if not self.is_installed('pip'):
             logger.info('Installing pip...')
             try:
                 tempdir = tempfile.mkdtemp()
                 get_pip_path = os.path.join(tempdir, 'get-pip.py')
                 try:
-                    _download_file(PIP_URL, get_pip_path)
+                    self.downloads.fetch(PIP_URL, get_pip_path)
                 except StandardError as e:
                     _exit(
                         message='Failed pip download from {0}. ({1})'.format(
@@ -489,28 +2120,55 @@ class CloudifyInstaller():
                         message='Could not install pip',
                         status='dependency_installation_failure',
                     )
+                self.inventory = None
             finally:
                 shutil.rmtree(tempdir)
         else:
             logger.info('pip is already installed in the path.')
 
     @staticmethod
-    def _get_default_requirement_files(source):
+    @_timed('phase')
+    def _download_source(source, destination_dir, downloads=None):
+        """Downloads a source archive to `destination_dir`.
+
+        The archive keeps its file name, as pip needs the extension to
+        recognise it as an archive it can install from.
+        """
+        import urlparse
+        name = os.path.basename(urlparse.urlparse(source).path) \
+            or 'cli_source.tar.gz'
+        archive = os.path.join(destination_dir, name)
+        try:
+            (downloads or _DownloadManager()).fetch(source, archive)
+        except Exception as ex:
+            _exit(
+                message='Could not download {0} ({1})'.format(
+                    source, str(ex)),
+                status='dependency_download_failure',
+            )
+        return archive
+
+    @staticmethod
+    def _get_default_requirement_files(source, downloads=None):
+        import tempfile
         if os.path.isdir(source):
             return [os.path.join(source, f) for f in REQUIREMENT_FILE_NAMES
                     if os.path.isfile(os.path.join(source, f))]
         else:
             tempdir = tempfile.mkdtemp()
-            archive = os.path.join(tempdir, 'cli_source')
             # TODO: need to handle deletion of the temp source dir
-            try:
-                _download_file(source, archive)
-            except Exception as ex:
-                _exit(
-                    message='Could not download {0} ({1})'.format(
-                        source, str(ex)),
-                    status='dependency_download_failure',
-                )
+            if os.path.isfile(source):
+                archive = source
+            else:
+                archive = os.path.join(tempdir, 'cli_source')
+                try:
+                    (downloads or _DownloadManager()).fetch(source, archive)
+                except Exception as ex:
+                    _exit(
+                        message='Could not download {0} ({1})'.format(
+                            source, str(ex)),
+                        status='dependency_download_failure',
+                    )
             try:
                 _untar_requirement_files(archive, tempdir)
             except Exception as ex:
@@ -520,7 +2178,8 @@ class CloudifyInstaller():
                     status='dependency_extraction_failure',
                 )
             finally:
-                os.remove(archive)
+                if archive != source:
+                    os.remove(archive)
             # GitHub always adds a single parent directory to the tree.
             # TODO: look in parent dir, then one level underneath.
             # the GitHub style tar assumption isn't a very good one.
@@ -528,6 +2187,7 @@ class CloudifyInstaller():
             return [os.path.join(req_dir, f) for f in REQUIREMENT_FILE_NAMES
                     if os.path.isfile(os.path.join(req_dir, f))]
 
+    @_timed('phase')
     def get_pythondev(self, distro):
         """Installs python-dev and gcc
 
@@ -553,7 +2213,15 @@ class CloudifyInstaller():
             )
         _run(cmd)
 
+    @staticmethod
+    def get_pycrypto_url():
+        import struct
+        # check 32/64bit to choose the correct PyCrypto installation
+        is_pyx32 = True if struct.calcsize("P") == 4 else False
+        return PYCR32_URL if is_pyx32 else PYCR64_URL
+
     # Windows only
+    @_timed('phase')
     def get_pycrypto(self, virtualenv_path):
         """This will install PyCrypto to be used by Fabric.
         PyCrypto isn't compiled with Fabric on Windows by default thus it needs
@@ -561,23 +2229,46 @@ class CloudifyInstaller():
         It will attempt to install the 32 or 64 bit version according to the
         Python version installed.
         """
-        # check 32/64bit to choose the correct PyCrypto installation
-        is_pyx32 = True if struct.calcsize("P") == 4 else False
-
+        import tempfile
+        url = self.get_pycrypto_url()
         logger.info('Installing PyCrypto {0}bit...'.format(
-            '32' if is_pyx32 else '64'))
-        # easy install is used instead of pip as pip doesn't handle windows
-        # executables.
-        cmd = 'easy_install {0}'.format(PYCR32_URL if is_pyx32 else PYCR64_URL)
-        if virtualenv_path:
-            cmd = os.path.join(_get_env_bin_path(virtualenv_path), cmd)
-        _run(cmd)
-
+            '32' if url == PYCR32_URL else '64'))
+        tempdir = tempfile.mkdtemp()
+        try:
+            installer = os.path.join(tempdir, url.split('/')[-1])
+            try:
+                self.downloads.fetch(url, installer)
+            except Exception as ex:
+                _exit(
+                    message='Could not download {0} ({1})'.format(
+                        url, str(ex)),
+                    status='dependency_download_failure',
+                )
+            # easy install is used instead of pip as pip doesn't handle
+            # windows executables.
+            cmd = 'easy_install {0}'.format(installer)
+            if virtualenv_path:
+                cmd = os.path.join(_get_env_bin_path(virtualenv_path), cmd)
+            _run(cmd)
+        finally:
+            shutil.rmtree(tempdir)
+
+    @_timed('phase')
     def handle_upgrade(self):
         if self.check_cloudify_installed():
-            logger.info('Cloudify is already installed in the path.')
+            logger.info('Cloudify {0}is already installed in the path.'.format(
+                '{0} '.format(self.installed_version)
+                if self.installed_version else ''))
             if self.upgrade:
                 logger.info('Upgrading...')
+            elif self.state:
+                # A previous run completed, so this is not a partial
+                # installation. Bring it up to date with the request.
+                logger.info('The requested installation differs from the '
+                            'previous one. Updating...')
+                # Otherwise pip finds Cloudify installed already and leaves
+                # it as it is, e.g. when only --pre or --pip-args changed
+                self.reinstall = True
             else:
                 logger.warn('If your previous attempt to install failed, '
                             'cloudify may be partially installed. You can '
@@ -588,17 +2279,512 @@ class CloudifyInstaller():
                 )
 
     def check_cloudify_installed(self):
+        self.installed_version = None
         if self.virtualenv:
+            installed, self.installed_version = _find_installed_version(
+                self.virtualenv, 'cloudify')
+            if installed is not None:
+                return installed
+            env_bin_path = _get_env_bin_path(self.virtualenv)
+            if not os.path.isfile(os.path.join(
+                    env_bin_path, 'python.exe' if IS_WIN else 'python')):
+                # Usually a virtualenv that is yet to be created
+                return False
+            # The metadata can't tell, so ask the virtualenv's interpreter
             result = _run(
-                os.path.join(_get_env_bin_path(self.virtualenv),
-                             'python -c "import cloudify"'),
+                os.path.join(env_bin_path, 'python -c "import cloudify"'),
                 suppress_errors=True)
             return result.returncode == 0
         else:
-            return self.is_installed('cloudify')
+            installed, self.installed_version = \
+                self.get_inventory().find('cloudify')
+            return bool(installed) or self.is_installed('cloudify')
+
+    def get_state_path(self):
+        """Returns the path of the state file of the environment Cloudify
+        is installed in, or None for the system python, which isn't tracked.
+        """
+        env_path = self.virtualenv or (IS_VIRTUALENV and sys.prefix)
+        return os.path.join(env_path, STATE_FILE) if env_path else None
+
+    def get_requested_state(self):
+        """Returns everything about the requested installation that a
+        previous installation must match to be reused.
+
+        Local source archives and requirement files are compared by their
+        hashes. Remote ones are only compared by their URLs.
+        """
+        requirement_files = {}
+        for req_file in self.with_requirements or []:
+            requirement_files[req_file] = _file_sha256(req_file) \
+                if os.path.isfile(req_file) else None
+        return {
+            'python_path': self.python_path,
+            'source': self.source,
+            'source_sha256': _file_sha256(self.source)
+            if self.source and os.path.isfile(self.source) else None,
+            'version': self.version,
+            'pre': self.pre,
+            'pip_args': self.pip_args,
+            'requirement_files': requirement_files,
+            'find_requirements': self.with_requirements == [],
+            'wheelhouse': self.wheelhouse or self.build_wheelhouse,
+            'snapshot_in': self.snapshot_in,
+        }
+
+    def load_state(self):
+        state_path = self.get_state_path()
+        if not state_path or not os.path.isfile(state_path):
+            return None
+        try:
+            with open(state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError) as ex:
+            logger.warning('Ignoring unreadable state file {0}: {1}'.format(
+                state_path, ex))
+            return None
+
+    def save_state(self):
+        """Records the installation that just completed, so that reruns
+        with the same request can be skipped.
+        """
+        state_path = self.get_state_path()
+        if not state_path:
+            return
+        state = self.get_requested_state()
+        state['installed_version'] = _find_installed_version(
+            os.path.dirname(state_path), 'cloudify')[1]
+        state['installed_at'] = time.time()
+        state['script_version'] = version_str
+        try:
+            with open(state_path, 'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+        except IOError as ex:
+            logger.warning('Could not write state file {0}: {1}'.format(
+                state_path, ex))
+
+    def is_satisfied(self, state):
+        """Returns whether `state`, recorded by a previous installation,
+        matches the requested installation and Cloudify is still installed.
+        """
+        requested = self.get_requested_state()
+        changed = [key for key in requested
+                   if requested[key] != state.get(key)]
+        if changed:
+            logger.debug('Changed since the last installation: {0}'.format(
+                ', '.join(sorted(changed))))
+            return False
+        if not self.check_cloudify_installed():
+            return False
+        version = self.installed_version
+        return version is None or version == state['installed_version']
+
+
+def _run_pool(func, items, workers, name='worker'):
+    """Calls `func` on each of `items` in up to `workers` threads.
+
+    Returns the results in the order of `items`. `func` is expected to
+    handle its own errors.
+    """
+    from Queue import Queue, Empty
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+    results = [None] * len(items)
+
+    def work():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Empty:
+                return
+            results[index] = func(item)
+
+    threads = [Thread(target=work, name='{0}-{1}'.format(name, i))
+               for i in range(min(max(1, workers), len(items)))]
+    for thread in threads:
+        # Not left running if the wait below is interrupted
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        _join(thread)
+    return results
+
+
+class BatchInstaller(object):
+    """Installs Cloudify in several virtualenvs concurrently.
+
+    `targets` is a list of dicts of CloudifyInstaller arguments, each with
+    at least a `virtualenv`, and usually a `version` or `source`. `options`
+    are CloudifyInstaller arguments shared by all targets.
+
+    Prerequisites (pip, virtualenv, python-dev) are installed once, before
+    the targets. Up to `workers` targets are then installed at a time,
+    sharing one download cache; pip's own wheel cache is per user, so it
+    is shared as well.
+    """
+    def __init__(self, targets, workers=DEFAULT_BATCH_WORKERS,
+                 cache_dir=DEFAULT_CACHE_DIR, no_cache=False, **options):
+        if not targets:
+            raise ArgumentCombinationInvalid('No batch targets were given.')
+        for target in targets:
+            if not target.get('virtualenv'):
+                raise ArgumentCombinationInvalid(
+                    'Every batch target requires a virtualenv.')
+        self.targets = targets
+        self.workers = max(1, workers)
+        self.cache = None if no_cache else _DownloadCache(cache_dir)
+        self.force = options.pop('force', False)
+        self.install_pip = options.pop('install_pip', False)
+        self.install_virtualenv = options.pop('install_virtualenv', False)
+        self.install_pythondev = options.pop('install_pythondev', False)
+        self.options = options
+        self.results = []
+
+    @_timed('phase')
+    def install_prerequisites(self):
+        installer = self.make_installer({})
+        if self.force or self.install_pip:
+            installer.get_pip()
+        if self.force or self.install_virtualenv:
+            installer.get_virtualenv()
+        if IS_LINUX and (self.force or self.install_pythondev):
+            installer.get_pythondev(installer.distro)
+
+    def make_installer(self, target):
+        kwargs = dict(self.options)
+        kwargs.update(target)
+        if not kwargs.get('source'):
+            # Requirement files are only looked up in sources
+            kwargs.pop('with_requirements', None)
+        if IS_WIN and self.force:
+            kwargs['install_pycrypto'] = True
+        installer = CloudifyInstaller(no_cache=True, **kwargs)
+        # All targets share a single cache (and its lock)
+        installer.cache = installer.downloads.cache = self.cache
+        return installer
+
+    def install_target(self, target):
+        result = {
+            'virtualenv': target['virtualenv'],
+            'version': target.get('version'),
+            'source': target.get('source'),
+            'status': 'installed',
+            'exit_code': 0,
+            'error': None,
+        }
+        logger.info('Installing Cloudify in {0}...'.format(
+            target['virtualenv']))
+        start = time.time()
+        try:
+            self.make_installer(target).execute()
+        except SystemExit as ex:
+            # _exit already logged the reason
+            result.update(status='failed', exit_code=ex.code,
+                          error='exited with {0}'.format(ex.code))
+        except Exception as ex:
+            logger.error('Installing in {0} failed: {1}'.format(
+                target['virtualenv'], ex))
+            result.update(status='failed', exit_code=1, error=str(ex))
+        result['duration'] = time.time() - start
+        return result
+
+    def execute(self):
+        """Installs all targets, and returns a result for each, in the
+        order of the targets.
+        """
+        self.install_prerequisites()
+        results = _run_pool(self.install_target, self.targets, self.workers,
+                            name='batch')
+        self.results = results
+        return results
+
+    def log_summary(self):
+        logger.info('Batch results:')
+        for result in self.results:
+            logger.info('  {0:<8} {1:>7.1f}s  {2} ({3}){4}'.format(
+                result['status'], result['duration'], result['virtualenv'],
+                result['source'] or result['version'] or 'latest',
+                ': {0}'.format(result['error']) if result['error'] else ''))
+
+
+class FleetInstaller(object):
+    """Runs this script on several hosts over SSH.
+
+    `hosts` is a list of dicts with a `host` (anything ssh and scp accept,
+    e.g. user@host) and optional extra script `args` for that host.
+    `script_args` are passed to the script on every host.
+
+    Local files given to --source, --snapshot-in, --wheelhouse or
+    --with-requirements, and --source or --snapshot-in URLs (which are
+    downloaded once, through the download cache and the `mirror`, and
+    checked against `sha256_digests` and, with `verify_downloads`, the
+    published digests), are uploaded along with the script to each host, so
+    that hosts don't download them again. Artifacts in a host's own `args`
+    are only uploaded to that host.
+    The output of each host is logged as it arrives, prefixed with the host.
+    """
+    # Options whose values are files to upload, and whether they take more
+    # than one value
+    ARTIFACT_OPTIONS = {
+        '--source': False,
+        '--snapshot-in': False,
+        '--wheelhouse': False,
+        '-r': True,
+        '--with-requirements': True,
+        '--withrequirements': True,
+    }
+    # Options whose URL values are downloaded once rather than on each host
+    PREFETCHED_OPTIONS = ('--source', '--snapshot-in')
+
+    def __init__(self, hosts, script_args=(), workers=DEFAULT_FLEET_WORKERS,
+                 ssh_command=DEFAULT_SSH_COMMAND,
+                 scp_command=DEFAULT_SCP_COMMAND,
+                 remote_python='python', script_path=None,
+                 cache_dir=DEFAULT_CACHE_DIR, no_cache=False, mirror=None,
+                 sha256_digests=None, verify_downloads=False):
+        if not hosts:
+            raise ArgumentCombinationInvalid('No fleet hosts were given.')
+        self.hosts = hosts
+        self.script_args = list(script_args)
+        self.workers = workers
+        self.ssh_command = ssh_command
+        self.scp_command = scp_command
+        self.remote_python = remote_python
+        self.script_path = os.path.abspath(
+            script_path or __file__.replace('.pyc', '.py'))
+        self.cache = None if no_cache else _DownloadCache(cache_dir)
+        self.downloads = _DownloadManager(self.cache, mirror,
+                                          digests=sha256_digests,
+                                          verify=verify_downloads)
+        # Uploaded to every host; each host's own artifacts are kept in
+        # the `uploads` of its spec
+        self.uploads = [self.script_path]
+        self.staging_dir = None
+        # The staged path of each downloaded URL
+        self.staged = {}
+        self.results = []
+
+    def stage_artifacts(self, args, uploads):
+        """Returns `args` with the artifacts in them replaced by their path
+        on the hosts, adding the artifacts to `uploads`.
+        """
+        staged = []
+        option = None
+        for arg in args:
+            if arg.startswith('-'):
+                name, separator, value = arg.partition('=')
+                option = name if name in self.ARTIFACT_OPTIONS else None
+                if option and separator:
+                    arg = '{0}={1}'.format(
+                        name, self.stage(name, value, uploads))
+                    option = None
+            elif option:
+                arg = self.stage(option, arg, uploads)
+                if not self.ARTIFACT_OPTIONS[option]:
+                    option = None
+            staged.append(arg)
+        return staged
+
+    def stage(self, option, value, uploads):
+        if os.path.exists(value):
+            path = os.path.abspath(value)
+        elif '://' in value and option in self.PREFETCHED_OPTIONS:
+            path = self.staged.get(value) or self.download(value)
+        else:
+            return value
+        if path not in uploads:
+            uploads.append(path)
+        return os.path.basename(path.rstrip(os.sep))
+
+    def download(self, url):
+        """Downloads `url` to a directory of its own in the staging
+        directory, as URLs of different hosts may share a file name.
+        """
+        import tempfile
+        import urlparse
+        if not self.staging_dir:
+            self.staging_dir = tempfile.mkdtemp()
+        directory = os.path.join(self.staging_dir, str(len(self.staged)))
+        os.mkdir(directory)
+        path = os.path.join(
+            directory,
+            os.path.basename(urlparse.urlparse(url).path) or 'artifact')
+        try:
+            self.downloads.fetch(url, path)
+        except Exception as ex:
+            raise IOError('Could not download {0} ({1})'.format(url, ex))
+        self.staged[url] = path
+        return path
+
+    def run_remote(self, host, cmd):
+        """Runs a command, logging its output prefixed with `host`."""
+        import subprocess
+        logger.debug('[{0}] Executing: {1}'.format(host, cmd))
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        for line in iter(proc.stdout.readline, ''):
+            logger.info('[{0}] {1}'.format(host, line.rstrip()))
+        return proc.wait()
+
+    def ssh(self, host, command):
+        import pipes
+        return self.run_remote(host, '{0} {1} {2}'.format(
+            self.ssh_command, host, pipes.quote(command)))
+
+    def install_host(self, spec):
+        import pipes
+        host = spec['host']
+        result = {'host': host, 'status': 'installed', 'exit_code': 0,
+                  'error': None}
+        start = time.time()
+        if spec.get('error'):
+            # Staging its artifacts failed
+            logger.error('[{0}] stage failed: {1}'.format(
+                host, spec['error']))
+            result.update(status='failed', exit_code=1,
+                          error='stage {0}'.format(spec['error']),
+                          duration=time.time() - start)
+            return result
+        uploads = ' '.join(
+            pipes.quote(path) for path in self.uploads +
+            [path for path in spec.get('uploads', [])
+             if path not in self.uploads])
+        script_args = self.script_args + list(spec.get('args', []))
+        steps = [
+            ('prepare', lambda: self.ssh(host, 'mkdir -p {0}'.format(
+                FLEET_REMOTE_DIR))),
+            ('upload', lambda: self.run_remote(host, '{0} -r {1} {2}'.format(
+                self.scp_command, uploads,
+                pipes.quote('{0}:{1}/'.format(host, FLEET_REMOTE_DIR))))),
+            ('install', lambda: self.ssh(host, 'cd {0} && {1} {2} {3}'.format(
+                FLEET_REMOTE_DIR, self.remote_python,
+                os.path.basename(self.script_path),
+                ' '.join(pipes.quote(arg) for arg in script_args)))),
+        ]
+        for step, run in steps:
+            try:
+                returncode = run()
+            except Exception as ex:
+                returncode, error = 1, str(ex)
+            else:
+                error = 'exited with {0}'.format(returncode)
+            if returncode != 0:
+                logger.error('[{0}] {1} failed: {2}'.format(host, step, error))
+                result.update(status='failed', exit_code=returncode,
+                              error='{0} {1}'.format(step, error))
+                break
+        result['duration'] = time.time() - start
+        return result
+
+    def execute(self):
+        """Installs on all hosts, and returns a result for each, in the
+        order of the hosts.
+        """
+        try:
+            try:
+                self.script_args = self.stage_artifacts(self.script_args,
+                                                        self.uploads)
+            except Exception as ex:
+                _exit(message=str(ex),
+                      status='dependency_download_failure')
+            for spec in self.hosts:
+                spec['uploads'] = []
+                spec.pop('error', None)
+                try:
+                    spec['args'] = self.stage_artifacts(
+                        spec.get('args', []), spec['uploads'])
+                except Exception as ex:
+                    spec['error'] = str(ex)
+            self.results = _run_pool(self.install_host, self.hosts,
+                                     self.workers, name='fleet')
+        finally:
+            if self.staging_dir:
+                shutil.rmtree(self.staging_dir)
+        return self.results
+
+    def log_summary(self):
+        logger.info('Fleet results:')
+        for result in self.results:
+            logger.info('  {0:<8} {1:>7.1f}s  {2}{3}'.format(
+                result['status'], result['duration'], result['host'],
+                ': {0}'.format(result['error']) if result['error'] else ''))
+
+
+def _parse_inventory(path):
+    """Parses a fleet inventory file into FleetInstaller hosts.
+
+    Each line holds a host (e.g. user@host), optionally followed by
+    arguments for the script on that host. Empty lines and lines starting
+    with # are ignored.
+    """
+    import shlex
+    hosts = []
+    with open(path) as f:
+        for line in f:
+            fields = shlex.split(line, comments=True)
+            if fields:
+                hosts.append({'host': fields[0], 'args': fields[1:]})
+    return hosts
+
+
+def _get_fleet_script_args(argv):
+    """Returns the command line arguments to pass on to fleet hosts,
+    leaving out the ones that only apply locally.
+    """
+    # Local options, and whether they take a value
+    local_options = {
+        '--fleet': True,
+        '--fleet-workers': True,
+        '--fleet-python': True,
+        '--ssh-command': True,
+        '--scp-command': True,
+        '--cache-dir': True,
+        '--profile-output': True,
+        '--profile': False,
+    }
+    script_args = []
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+            continue
+        name, separator, _ = arg.partition('=')
+        if name in local_options:
+            skip_value = local_options[name] and not separator
+            continue
+        script_args.append(arg)
+    return script_args
+
+
+def _parse_batch_file(path):
+    """Parses a batch file into BatchInstaller targets.
+
+    Each line holds a virtualenv path, optionally followed by a version or
+    a source (URL or archive path). Empty lines and lines starting with #
+    are ignored.
+    """
+    targets = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            target = {'virtualenv': fields[0]}
+            if len(fields) > 1:
+                spec = fields[1]
+                if '/' in spec or os.sep in spec or \
+                        spec.endswith(('.tar.gz', '.tgz', '.zip')):
+                    target['source'] = spec
+                else:
+                    target['version'] = spec
+            targets.append(target)
+    return targets
 
 
 def parse_args(args=None):
+    import argparse
+
     class VerifySource(argparse.Action):
         def __call__(self, parser, args, values, option_string=None):
             if not args.source and not args.use_branch:
@@ -727,6 +2913,149 @@ def parse_args(args=None):
              'bootstrapping cloudify. You will likely need to quote this if '
              'you are using more than one argument.',
     )
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument(
+        '--cache-dir',
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help='Directory in which downloaded files are cached. '
+             'Defaults to {0}'.format(DEFAULT_CACHE_DIR),
+    )
+    cache_group.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not use or populate the download cache.',
+    )
+    wheelhouse_group = parser.add_mutually_exclusive_group()
+    wheelhouse_group.add_argument(
+        '--build-wheelhouse',
+        type=str,
+        metavar='DIR',
+        help='Build wheels for Cloudify and its requirements in DIR, then '
+             'install Cloudify from them. DIR can be used with --wheelhouse '
+             'to install on machines without network access or compilers.',
+    )
+    wheelhouse_group.add_argument(
+        '--wheelhouse',
+        type=str,
+        metavar='DIR',
+        help='Install Cloudify and its requirements only from wheels in '
+             'DIR, without accessing the package index.',
+    )
+    snapshot_group = parser.add_mutually_exclusive_group()
+    snapshot_group.add_argument(
+        '--snapshot-out',
+        type=str,
+        metavar='ARCHIVE',
+        help='Once installed, pack the --virtualenv into ARCHIVE, to be '
+             'installed elsewhere with --snapshot-in.',
+    )
+    snapshot_group.add_argument(
+        '--snapshot-in',
+        type=str,
+        metavar='ARCHIVE',
+        help='Install by unpacking a snapshot created with --snapshot-out '
+             '(a path or URL) into the --virtualenv, without running pip. '
+             'The snapshot must come from the same platform and Python.',
+    )
+    parser.add_argument(
+        '--batch',
+        type=str,
+        metavar='FILE',
+        help='Install in several virtualenvs concurrently. Each line of FILE '
+             'holds a virtualenv path, optionally followed by a version or '
+             'a source. Other arguments apply to all of them.',
+    )
+    parser.add_argument(
+        '--batch-workers',
+        type=int,
+        default=DEFAULT_BATCH_WORKERS,
+        metavar='N',
+        help='How many virtualenvs --batch installs into at a time. '
+             'Defaults to {0}'.format(DEFAULT_BATCH_WORKERS),
+    )
+    parser.add_argument(
+        '--sha256',
+        action='append',
+        dest='sha256_digests',
+        metavar='URL=DIGEST',
+        help='Reject the download of URL unless its SHA-256 digest is '
+             'DIGEST. Can be given more than once.',
+    )
+    parser.add_argument(
+        '--verify-downloads',
+        action='store_true',
+        help='Reject downloads whose SHA-256 digest is neither given with '
+             '--sha256 nor published next to them, as <URL>.sha256.',
+    )
+    parser.add_argument(
+        '--mirror',
+        type=str,
+        metavar='URL',
+        help='Get downloads and wheels from a mirror served with '
+             '--serve-mirror first, falling back to their origin.',
+    )
+    parser.add_argument(
+        '--serve-mirror',
+        nargs='?',
+        const=DEFAULT_MIRROR_ADDRESS,
+        metavar='[HOST:]PORT',
+        help='Instead of installing, serve the download cache, and the '
+             '--wheelhouse if provided, to hosts using --mirror. '
+             'Listens on {0} by default.'.format(DEFAULT_MIRROR_ADDRESS),
+    )
+    parser.add_argument(
+        '--fleet',
+        type=str,
+        metavar='INVENTORY',
+        help='Run this script over SSH on the hosts listed in INVENTORY, '
+             'one per line, optionally followed by arguments for that host. '
+             'Other arguments are passed on to every host.',
+    )
+    parser.add_argument(
+        '--fleet-workers',
+        type=int,
+        default=DEFAULT_FLEET_WORKERS,
+        metavar='N',
+        help='How many hosts --fleet installs on at a time. '
+             'Defaults to {0}'.format(DEFAULT_FLEET_WORKERS),
+    )
+    parser.add_argument(
+        '--fleet-python',
+        type=str,
+        default='python',
+        help='The python used to run this script on --fleet hosts, '
+             'e.g. "sudo python" to install prerequisites.',
+    )
+    parser.add_argument(
+        '--ssh-command',
+        type=str,
+        default=DEFAULT_SSH_COMMAND,
+        help='The command used by --fleet to run commands on hosts.',
+    )
+    parser.add_argument(
+        '--scp-command',
+        type=str,
+        default=DEFAULT_SCP_COMMAND,
+        help='The command used by --fleet to upload files to hosts.',
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Print how long each installation phase, download and '
+             'command took.',
+    )
+    parser.add_argument(
+        '--profile-output',
+        type=str,
+        help='Write the timings printed by --profile to this path as JSON.',
+    )
+    parser.add_argument(
+        '--inventory',
+        action='store_true',
+        help='Print the distributions installed in the virtualenv given by\n'
+             '--virtualenv, or else in this python, and exit.',
+    )
     parser.add_argument(
         '--get-version',
         action='version',
@@ -843,6 +3172,24 @@ def parse_args(args=None):
     # use_branch should be discarded now as it is just used to set source
     parsed_args.pop('use_branch')
 
+    if parsed_args['sha256_digests']:
+        digests = {}
+        for pin in parsed_args['sha256_digests']:
+            url, _, digest = pin.rpartition('=')
+            if not url or len(digest) != 64:
+                parser.error('--sha256 should be specified as URL=DIGEST, '
+                             'with a hex SHA-256 digest. Got {0}'.format(pin))
+            digests[url] = digest.lower()
+        parsed_args['sha256_digests'] = digests
+
+    if parsed_args['batch'] and (
+            parsed_args['virtualenv'] or parsed_args['version'] or
+            parsed_args['source'] or parsed_args['snapshot_in'] or
+            parsed_args['snapshot_out']):
+        parser.error('--batch sets the virtualenvs and versions to install, '
+                     'and can not be used with --virtualenv, --version, '
+                     '--source, --use-branch or snapshots.')
+
     if parsed_args['source'] and not parsed_args['with_requirements']:
         logger.warning(
             'A source URL or branch was specified, but '
@@ -858,6 +3205,12 @@ def main():
             message='Platform {0} not supported.'.format(PLATFORM),
             status='unsupported_platform',
         )
+    if sys.argv[1:] == ['--get-version']:
+        # Configuration management tools ask for this on every run, so it
+        # is answered without building the argument parser. Like argparse's
+        # version action, this prints to stderr.
+        sys.stderr.write('{0}\n'.format(version_str))
+        sys.exit(0)
 
     args = parse_args()
     if args['quiet']:
@@ -871,8 +3224,74 @@ def main():
     for arg in excluded_args:
         if arg in args:
             args.pop(arg)
-    installer = CloudifyInstaller(**args)
-    installer.execute()
+    profile = args.pop('profile', False)
+    profile_output = args.pop('profile_output', None)
+    serve_mirror = args.pop('serve_mirror', None)
+    batch = args.pop('batch', None)
+    batch_workers = args.pop('batch_workers', DEFAULT_BATCH_WORKERS)
+    fleet = args.pop('fleet', None)
+    fleet_options = dict(
+        workers=args.pop('fleet_workers', DEFAULT_FLEET_WORKERS),
+        remote_python=args.pop('fleet_python', 'python'),
+        ssh_command=args.pop('ssh_command', DEFAULT_SSH_COMMAND),
+        scp_command=args.pop('scp_command', DEFAULT_SCP_COMMAND),
+        cache_dir=args.get('cache_dir', DEFAULT_CACHE_DIR),
+        no_cache=args.get('no_cache', False),
+        mirror=args.get('mirror'),
+        sha256_digests=args.get('sha256_digests'),
+        verify_downloads=args.get('verify_downloads', False),
+    )
+    if args.pop('inventory', False):
+        inventory = _Inventory.for_env(args['virtualenv']) \
+            if args['virtualenv'] else _Inventory.for_interpreter()
+        logger.info('Distributions installed in {0}:\n{1}'.format(
+            args['virtualenv'] or sys.executable, inventory.format()))
+        return
+    if serve_mirror:
+        return _serve_mirror(
+            serve_mirror,
+            None if args['no_cache'] else _DownloadCache(args['cache_dir']),
+            wheelhouse=args['wheelhouse'] or args['build_wheelhouse'])
+    try:
+        if fleet:
+            installer = FleetInstaller(
+                _parse_inventory(fleet),
+                script_args=_get_fleet_script_args(sys.argv[1:]),
+                **fleet_options)
+            results = installer.execute()
+            installer.log_summary()
+            failed = [r for r in results if r['status'] != 'installed']
+            if failed:
+                _exit(
+                    message='Installation failed on {0} of {1} '
+                            'hosts.'.format(len(failed), len(results)),
+                    status='fleet_installation_failure',
+                )
+        elif batch:
+            for arg in ('virtualenv', 'version', 'source'):
+                args.pop(arg, None)
+            installer = BatchInstaller(_parse_batch_file(batch),
+                                       workers=batch_workers, **args)
+            results = installer.execute()
+            installer.log_summary()
+            failed = [r for r in results if r['status'] != 'installed']
+            if failed:
+                _exit(
+                    message='Installation failed in {0} of {1} '
+                            'virtualenvs.'.format(len(failed), len(results)),
+                    status='batch_installation_failure',
+                )
+        else:
+            installer = CloudifyInstaller(**args)
+            installer.execute()
+    finally:
+        # Report even if the installation failed; that is when it is
+        # usually the most interesting.
+        if profile:
+            logger.info(_profiler.report())
+        if profile_output:
+            _profiler.dump(profile_output)
+            logger.info('Profile written to {0}'.format(profile_output))
 
 logger = _init_logger(__file__)
 
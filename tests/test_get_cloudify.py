@@ -13,24 +13,130 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 ############
+import BaseHTTPServer
 from copy import copy
+import hashlib
 import importlib
+import inspect
+import json
 import logging
 import mock
 import os
+import pipes
 import shutil
+import signal
+import SocketServer
 from StringIO import StringIO
 import sys
 import tarfile
 import tempfile
 import testtools
+import threading
+import time
+import traceback
 import urllib
+import urllib2
 
 sys.path.append("../")
 
 get_cloudify = importlib.import_module('get-cloudify')
 
 
+class _FileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves `server.files` ({path: content}) with an ETag per file.
+
+    Paths in `server.redirects` ({path: path}) are redirected. Range requests
+    are supported if `server.ranges` is set (and ignored if an If-Range
+    header doesn't match the ETag), and the connection is dropped
+    after `server.truncate` ({path: size}) bytes the first time a path
+    is served.
+    """
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path in self.server.redirects:
+            self.send_response(302)
+            self.send_header('Location', self.server.redirects[self.path])
+            self.end_headers()
+            return
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        content = self.server.files[self.path]
+        etag = '"{0}"'.format(hashlib.sha256(content).hexdigest())
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        requested_range = self.headers.getheader('Range')
+        if_range = self.headers.getheader('If-Range')
+        if requested_range and self.server.ranges and \
+                if_range in (None, etag):
+            start, end = requested_range.split('=')[1].split('-')
+            start = int(start)
+            end = int(end) if end else len(content) - 1
+            if start >= len(content):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(content)))
+            body = content[start:end + 1]
+        else:
+            self.send_response(200)
+            body = content
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        truncate = self.server.truncate.pop(self.path, None)
+        self.wfile.write(body if truncate is None else body[:truncate])
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections early is expected
+        pass
+
+
+class LocalHTTPServer(object):
+    """A local HTTP server to download test files from."""
+    def __init__(self, files=None, redirects=None, ranges=False,
+                 truncate=None, handler=_FileRequestHandler):
+        self.server = _ThreadedHTTPServer(('127.0.0.1', 0), handler)
+        self.server.files = files or {}
+        self.server.redirects = redirects or {}
+        self.server.ranges = ranges
+        self.server.truncate = truncate or {}
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def url(self, path):
+        return 'http://127.0.0.1:{0}{1}'.format(
+            self.server.server_address[1], path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 class CliBuilderUnitTests(testtools.TestCase):
     """Unit tests for functions in get_cloudify.py"""
 
@@ -83,6 +189,62 @@ class CliBuilderUnitTests(testtools.TestCase):
         self.assertIsNot(proc.returncode, 0, 'command \'{}\' execution was '
                                              'expected to fail'.format(cmd))
 
+    def test_run_captures_output(self):
+        proc = self.get_cloudify._run('echo out&& echo err 1>&2')
+        self.assertEqual(0, proc.returncode)
+        self.assertEqual('out', proc.aggr_stdout.strip())
+        self.assertEqual('err', proc.aggr_stderr.strip())
+
+    def test_run_captures_output_of_quick_exit(self):
+        """Output written right before exiting must not be dropped."""
+        proc = self.get_cloudify._run(
+            '{0} -c "import sys; sys.stdout.write(\'x\' * 100000)"'.format(
+                sys.executable))
+        self.assertEqual(100000, len(proc.aggr_stdout))
+
+    def test_run_limits_captured_output(self):
+        cmd = '{0} -c "import sys; sys.stdout.write(\'a\' * 1000 + \'b\')"'
+        proc = self.get_cloudify._run(cmd.format(sys.executable),
+                                      max_output=10)
+        self.assertEqual('a' * 9 + 'b', proc.aggr_stdout)
+
+    def _read_pipe(self, data, **kwargs):
+        reader = self.get_cloudify._PipeReader(
+            StringIO(data), mock.Mock(), logging.DEBUG, **kwargs)
+        reader.run()
+        return reader
+
+    def test_pipe_reader_unlimited(self):
+        reader = self._read_pipe('one\ntwo\nthree\n')
+        self.assertEqual('one\ntwo\nthree\n', reader.aggr)
+        self.assertFalse(reader.truncated)
+        self.assertEqual(3, reader.logger.log.call_count)
+
+    def test_pipe_reader_keeps_tail(self):
+        reader = self._read_pipe('one\ntwo\nthree\n', max_size=8)
+        self.assertEqual('o\nthree\n', reader.aggr)
+        self.assertTrue(reader.truncated)
+        # Everything is still logged
+        self.assertEqual(3, reader.logger.log.call_count)
+
+    def test_pipe_reader_keeps_head(self):
+        reader = self._read_pipe('one\ntwo\nthree\n', max_size=6,
+                                 keep='head')
+        self.assertEqual('one\ntw', reader.aggr)
+        self.assertTrue(reader.truncated)
+
+    def test_pipe_reader_within_limit(self):
+        reader = self._read_pipe('one\ntwo\n', max_size=8)
+        self.assertEqual('one\ntwo\n', reader.aggr)
+        self.assertFalse(reader.truncated)
+
+    def test_pipe_reader_invalid_keep(self):
+        self.assertRaises(
+            ValueError,
+            self.get_cloudify._PipeReader,
+            StringIO(''), mock.Mock(), logging.DEBUG, keep='middle',
+        )
+
     def test_installer_init_unexpected_argument(self):
         """Make sure typos in parse_args don't go un-noticed with **kwargs."""
         self.assertRaises(
@@ -757,6 +919,73 @@ class CliBuilderUnitTests(testtools.TestCase):
                 self.fail('distro prop \'{0}\' should be equal to one of: '
                           '{1}'.format(distro, distros))
 
+    def _make_release_root(self, files):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.mkdir(os.path.join(root, 'etc'))
+        for name, content in files.items():
+            with open(os.path.join(root, 'etc', name), 'w') as f:
+                f.write(content)
+        return root
+
+    @mock.patch('get-cloudify.IS_LINUX', True)
+    def test_detect_os_props(self):
+        releases = [
+            ({'os-release': 'NAME="Red Hat Enterprise Linux Server"\n'
+                            'ID="rhel"\nVERSION_ID="7.2"\n',
+              'redhat-release': 'Red Hat Enterprise Linux Server release '
+                                '7.2 (Maipo)\n'},
+             ('redhat', '7.2')),
+            ({'os-release': "ID=arch\n# comment\nPRETTY_NAME='Arch Linux'"},
+             ('archlinux', '')),
+            ({'lsb-release': 'DISTRIB_ID=Ubuntu\nDISTRIB_RELEASE=12.04\n'},
+             ('ubuntu', '12.04')),
+            ({'centos-release': 'CentOS release 6.7 (Final)\n',
+              'redhat-release': 'CentOS release 6.7 (Final)\n'},
+             ('centos', '6.7')),
+            ({'redhat-release': 'Red Hat Enterprise Linux Server release '
+                                '6.5 (Santiago)\n'},
+             ('redhat', '6.5')),
+            ({'os-release': 'ID="ol"\nID_LIKE="fedora"\nVERSION_ID="7.9"\n'},
+             ('redhat', '7.9')),
+            ({'os-release': 'ID="rocky"\nID_LIKE="rhel centos fedora"\n'
+                            'VERSION_ID="8.5"\n'},
+             ('redhat', '8.5')),
+            ({'os-release': 'ID="almalinux"\nID_LIKE="rhel centos fedora"\n'
+                            'VERSION_ID="8.5"\n'},
+             ('redhat', '8.5')),
+            ({'os-release': 'ID=linuxmint\nID_LIKE="ubuntu debian"\n'
+                            'VERSION_ID="20.3"\n'},
+             ('debian', '20.3')),
+            ({'os-release': 'ID=raspbian\nID_LIKE=debian\n'
+                            'VERSION_ID="10"\n'},
+             ('debian', '10')),
+            ({'os-release': 'ID=ubuntu\nID_LIKE=debian\n'
+                            'VERSION_ID="16.04"\n'},
+             ('ubuntu', '16.04')),
+            ({'os-release': 'ID=unknown\nID_LIKE=other\n'},
+             ('unknown', '')),
+            ({'redhat-release': 'Rocky Linux release 8.5 (Green Obsidian)\n'},
+             ('redhat', '8.5')),
+            ({'debian_version': '7.11\n'}, ('debian', '7.11')),
+            ({'arch-release': ''}, ('archlinux', '')),
+            ({}, ('', '')),
+        ]
+        for files, expected in releases:
+            root = self._make_release_root(files)
+            self.assertEqual(expected,
+                             self.get_cloudify._detect_os_props(root))
+
+    @mock.patch('get-cloudify._os_props', None)
+    @mock.patch('get-cloudify._detect_os_props',
+                return_value=('ubuntu', '14.04'))
+    def test_os_props_detected_once(self, mock_detect):
+        for _ in range(3):
+            installer = self.get_cloudify.CloudifyInstaller()
+        self.assertEqual(('ubuntu', '14.04'),
+                         (installer.distro, installer.release))
+        self.assertEqual(1, mock_detect.call_count)
+
     def test_download_file(self):
         self.get_cloudify.VERBOSE = True
         # We cannot use NamedTemporaryFile here as it will fail on Windows
@@ -771,6 +1000,283 @@ class CliBuilderUnitTests(testtools.TestCase):
             self.assertIsNotNone(content)
         shutil.rmtree(tmpdir)
 
+    def _make_cache(self, **kwargs):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        return self.get_cloudify._DownloadCache(cache_dir, **kwargs)
+
+    def _make_file(self, content):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, content)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def _cache_file(self, cache, url, content):
+        path = self._make_file(content)
+        cache.store(url, path, hashlib.sha256(content).hexdigest(),
+                    etag='"etag"')
+
+    def test_download_cache_store_and_fetch(self):
+        cache = self._make_cache()
+        self._cache_file(cache, 'http://example.com/a', 'content')
+
+        entry = cache.lookup('http://example.com/a')
+        self.assertEqual(hashlib.sha256('content').hexdigest(),
+                         entry['sha256'])
+        self.assertEqual({'If-None-Match': '"etag"'},
+                         cache.validators(entry))
+        destination = self._make_file('')
+        cache.fetch('http://example.com/a', destination)
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+
+    def test_download_cache_lookup_missing(self):
+        cache = self._make_cache()
+        self.assertIsNone(cache.lookup('http://example.com/a'))
+        self.assertEqual({}, cache.validators(None))
+
+    def test_download_cache_discards_corrupt_file(self):
+        cache = self._make_cache()
+        self._cache_file(cache, 'http://example.com/a', 'content')
+        entry = cache.lookup('http://example.com/a')
+        with open(os.path.join(cache.path, entry['sha256']), 'w') as f:
+            f.write('corrupt')
+
+        self.assertIsNone(cache.lookup('http://example.com/a'))
+
+    def test_download_cache_evicts_least_recently_used(self):
+        cache = self._make_cache(max_size=10)
+        self._cache_file(cache, 'http://example.com/a', 'aaaa')
+        self._cache_file(cache, 'http://example.com/b', 'bbbb')
+        cache.fetch('http://example.com/a', self._make_file(''))
+        self._cache_file(cache, 'http://example.com/c', 'cccc')
+
+        self.assertIsNotNone(cache.lookup('http://example.com/a'))
+        self.assertIsNone(cache.lookup('http://example.com/b'))
+        self.assertIsNotNone(cache.lookup('http://example.com/c'))
+        self.assertEqual(3, len(os.listdir(cache.path)))
+
+    def test_download_cache_shares_identical_files(self):
+        cache = self._make_cache(max_size=6)
+        self._cache_file(cache, 'http://example.com/a', 'aaaa')
+        self._cache_file(cache, 'http://example.com/b', 'aaaa')
+
+        self.assertIsNotNone(cache.lookup('http://example.com/a'))
+        self.assertIsNotNone(cache.lookup('http://example.com/b'))
+
+    @mock.patch('get-cloudify._is_root', return_value=True)
+    def test_download_cache_is_given_to_sudo_user(self, mock_root_check):
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+        cache_dir = os.path.join(home, '.cache', 'get-cloudify')
+        cache = self.get_cloudify._DownloadCache(cache_dir)
+        chowned = []
+        with mock.patch.dict(os.environ, {'SUDO_UID': '1000',
+                                          'SUDO_GID': '1001'}):
+            with mock.patch('os.chown',
+                            side_effect=lambda *args: chowned.append(args)):
+                self._cache_file(cache, 'http://example.com/a', 'aaaa')
+
+        sha256 = hashlib.sha256('aaaa').hexdigest()
+        self.assertEqual(
+            [(os.path.join(home, '.cache'), 1000, 1001),
+             (cache_dir, 1000, 1001)],
+            chowned[:2])
+        chowned_files = [os.path.basename(path) for path, _, _ in chowned[2:]]
+        self.assertEqual(2, len(chowned_files))
+        self.assertTrue(chowned_files[0].startswith(sha256))
+        self.assertTrue(chowned_files[1].startswith(
+            self.get_cloudify._DownloadCache.INDEX_FILE))
+
+    def test_download_file_single_request(self):
+        content = os.urandom(1024 * 1024)
+        destination = self._make_file('')
+        with LocalHTTPServer({'/file': content}) as server:
+            self.get_cloudify._download_file(server.url('/file'),
+                                             destination)
+
+        with open(destination, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(['/file'], [path for path, _ in server.requests])
+
+    def test_download_file_follows_redirect_once(self):
+        destination = self._make_file('')
+        with LocalHTTPServer({'/file': 'content'},
+                             redirects={'/old': '/file'}) as server:
+            self.get_cloudify._download_file(server.url('/old'),
+                                             destination)
+
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+        self.assertEqual(['/old', '/file'],
+                         [path for path, _ in server.requests])
+
+    def test_download_file_local_path(self):
+        source = self._make_file('content')
+        destination = self._make_file('')
+        self.get_cloudify._download_file(source, destination)
+
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+
+    def test_download_file_resumes_interrupted_download(self):
+        content = os.urandom(1024 * 1024)
+        destination = self._make_file('')
+        with LocalHTTPServer({'/file': content}, ranges=True,
+                             truncate={'/file': 1000}) as server:
+            self.get_cloudify._download_file(server.url('/file'),
+                                             destination)
+
+        with open(destination, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual('bytes=1000-1048575',
+                         server.requests[1][1]['range'])
+        self.assertFalse(os.path.exists(destination + '.part'))
+
+    def test_download_file_restarts_without_range_support(self):
+        destination = self._make_file('')
+        with LocalHTTPServer({'/file': 'content'},
+                             truncate={'/file': 3}) as server:
+            self.get_cloudify._download_file(server.url('/file'),
+                                             destination)
+
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+
+    def _make_partial_file(self, content, validator=None):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        destination = os.path.join(tempdir, 'file')
+        with open(destination + '.part', 'w') as f:
+            f.write(content)
+        if validator:
+            with open(destination + '.part.validator', 'w') as f:
+                f.write(validator)
+        return destination
+
+    def test_download_file_resumes_partial_file(self):
+        cache = self._make_cache()
+        etag = '"{0}"'.format(hashlib.sha256('content').hexdigest())
+        destination = self._make_partial_file('cont', validator=etag)
+        with LocalHTTPServer({'/file': 'content'}, ranges=True) as server:
+            self.get_cloudify._download_file(server.url('/file'),
+                                             destination, cache=cache)
+
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+        self.assertEqual('bytes=4-', server.requests[0][1]['range'])
+        self.assertEqual(etag, server.requests[0][1]['if-range'])
+        self.assertEqual(hashlib.sha256('content').hexdigest(),
+                         cache.lookup(server.url('/file'))['sha256'])
+        self.assertEqual(['file'], os.listdir(os.path.dirname(destination)))
+
+    def test_download_file_restarts_changed_partial_file(self):
+        cache = self._make_cache()
+        etag = '"{0}"'.format(hashlib.sha256('old content').hexdigest())
+        destination = self._make_partial_file('old c', validator=etag)
+        with LocalHTTPServer({'/file': 'new content'}, ranges=True) as server:
+            self.get_cloudify._download_file(server.url('/file'),
+                                             destination, cache=cache)
+
+        with open(destination) as f:
+            self.assertEqual('new content', f.read())
+        self.assertEqual(hashlib.sha256('new content').hexdigest(),
+                         cache.lookup(server.url('/file'))['sha256'])
+
+    def test_download_file_discards_unvalidated_partial_file(self):
+        destination = self._make_partial_file('old c')
+        with LocalHTTPServer({'/file': 'new content'}, ranges=True) as server:
+            self.get_cloudify._download_file(server.url('/file'),
+                                             destination)
+
+        with open(destination) as f:
+            self.assertEqual('new content', f.read())
+        self.assertNotIn('range', server.requests[0][1])
+
+    def test_download_file_records_partial_validator(self):
+        content = os.urandom(1024 * 1024)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        destination = os.path.join(tempdir, 'file')
+        with LocalHTTPServer({'/file': content}, ranges=True,
+                             truncate={'/file': 1000}) as server:
+            with mock.patch('get-cloudify.DOWNLOAD_RETRIES', 0):
+                self.assertRaises(IOError, self.get_cloudify._download_file,
+                                  server.url('/file'), destination)
+        with open(destination + '.part.validator') as f:
+            self.assertEqual(
+                '"{0}"'.format(hashlib.sha256(content).hexdigest()),
+                f.read())
+
+    @mock.patch('get-cloudify.MIN_SEGMENTED_SIZE', 1024)
+    def test_download_file_in_segments(self):
+        content = os.urandom(1024 * 1024 + 3)
+        destination = self._make_file('')
+        with LocalHTTPServer({'/file': content}, ranges=True) as server:
+            self.get_cloudify._download_file(server.url('/file'),
+                                             destination, segments=4)
+
+        with open(destination, 'rb') as f:
+            self.assertEqual(content, f.read())
+        ranges = sorted(headers.get('range') for _, headers
+                        in server.requests[1:])
+        self.assertEqual(5, len(server.requests))
+        self.assertEqual(
+            ['bytes=0-262143', 'bytes=262144-524288',
+             'bytes=524289-786433', 'bytes=786434-1048578'],
+            ranges,
+        )
+
+    @mock.patch('get-cloudify.MIN_SEGMENTED_SIZE', 1024)
+    def test_download_file_segments_need_range_support(self):
+        content = os.urandom(4096)
+        destination = self._make_file('')
+        with LocalHTTPServer({'/file': content}) as server:
+            self.get_cloudify._download_file(server.url('/file'),
+                                             destination, segments=4)
+
+        with open(destination, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(1, len(server.requests))
+
+    def test_download_file_with_cache(self):
+        cache = self._make_cache()
+        destination = self._make_file('')
+        with LocalHTTPServer({'/file': 'content'}) as server:
+            url = server.url('/file')
+            self.get_cloudify._download_file(url, destination, cache=cache)
+            os.remove(destination)
+            self.get_cloudify._download_file(url, destination, cache=cache)
+
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+        self.assertEqual(2, len(server.requests))
+        self.assertNotIn('if-none-match', server.requests[0][1])
+        self.assertIn('if-none-match', server.requests[1][1])
+
+    def test_download_file_with_cache_when_offline(self):
+        cache = self._make_cache()
+        destination = self._make_file('')
+        with LocalHTTPServer({'/file': 'content'}) as server:
+            url = server.url('/file')
+            self.get_cloudify._download_file(url, destination, cache=cache)
+        os.remove(destination)
+
+        self.get_cloudify._download_file(url, destination, cache=cache)
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+
+    def test_download_file_with_cache_not_found(self):
+        cache = self._make_cache()
+        with LocalHTTPServer() as server:
+            self.assertRaises(
+                urllib2.HTTPError,
+                self.get_cloudify._download_file,
+                server.url('/missing'), self._make_file(''), cache=cache,
+            )
+
     def test_check_cloudify_not_installed_in_venv(self):
         tmp_venv = tempfile.mkdtemp()
         # Handle windows and linux by using correct python path
@@ -789,6 +1295,193 @@ class CliBuilderUnitTests(testtools.TestCase):
         finally:
             shutil.rmtree(tmp_venv)
 
+    def _make_site_packages(self, entries):
+        env = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, env)
+        site_packages = os.path.join(
+            env, 'lib', 'python2.7', 'site-packages')
+        os.makedirs(site_packages)
+        for entry in entries:
+            os.mkdir(os.path.join(site_packages, entry))
+            if not os.path.splitext(entry)[1]:
+                # A package
+                open(os.path.join(site_packages, entry, '__init__.py'),
+                     'w').close()
+        return env
+
+    def test_find_installed_version_dist_info(self):
+        env = self._make_site_packages(
+            ['cloudify_plugins_common-3.4.dist-info',
+             'cloudify-4.0.1.dist-info'])
+        self.assertEqual(
+            (True, '4.0.1'),
+            self.get_cloudify._find_installed_version(env, 'cloudify'))
+
+    def test_find_installed_version_egg_info(self):
+        env = self._make_site_packages(['cloudify-3.4-py2.7.egg-info'])
+        self.assertEqual(
+            (True, '3.4'),
+            self.get_cloudify._find_installed_version(env, 'cloudify'))
+
+    def test_find_installed_version_not_installed(self):
+        env = self._make_site_packages(
+            ['cloudify_rest_client', 'cloudify_rest_client-3.4.dist-info'])
+        self.assertEqual(
+            (False, None),
+            self.get_cloudify._find_installed_version(env, 'cloudify'))
+
+    def test_find_installed_version_unknown(self):
+        env = self._make_site_packages(['cloudify'])
+        self.assertEqual(
+            (None, None),
+            self.get_cloudify._find_installed_version(env, 'cloudify'))
+        self.assertEqual(
+            (None, None),
+            self.get_cloudify._find_installed_version(
+                tempfile.gettempdir(), 'cloudify'))
+
+    def test_inventory(self):
+        env = self._make_site_packages(
+            ['cloudify-4.0.1.dist-info', 'cloudify', 'pip-9.0.1.dist-info',
+             'virtualenv-15.1.0-py2.7.egg', 'cloudify_dsl_parser.egg-link'])
+        site_packages = self.get_cloudify._get_env_site_packages(env)[0]
+        for module in ('six.py', '_speedups.cpython-36m-x86_64-linux-gnu.so'):
+            open(os.path.join(site_packages, module), 'w').close()
+        # Not a package, e.g. left behind by an uninstall
+        os.mkdir(os.path.join(site_packages, 'pip'))
+        inventory = self.get_cloudify._Inventory.for_env(env)
+        self.assertEqual({'name': 'cloudify', 'version': '4.0.1',
+                          'location': site_packages},
+                         inventory.distributions['cloudify'])
+        self.assertEqual((True, '15.1.0'), inventory.find('virtualenv'))
+        self.assertEqual((None, None), inventory.find('cloudify-dsl-parser'))
+        self.assertEqual((False, None), inventory.find('requests'))
+        for module in ('cloudify', 'six', '_speedups'):
+            self.assertTrue(inventory.has_module(module))
+        self.assertFalse(inventory.has_module('pip'))
+        self.assertEqual(
+            ['Name', 'cloudify', 'cloudify_dsl_parser', 'pip', 'virtualenv'],
+            [line.split()[0] for line in inventory.format().splitlines()])
+
+    def test_inventory_first_path_wins(self):
+        first = self._make_site_packages(['cloudify-4.0.dist-info'])
+        second = self._make_site_packages(['cloudify-3.4.dist-info'])
+        inventory = self.get_cloudify._Inventory(
+            self.get_cloudify._get_env_site_packages(first) +
+            self.get_cloudify._get_env_site_packages(second) +
+            [os.path.join(first, 'missing')])
+        self.assertEqual((True, '4.0'), inventory.find('cloudify'))
+
+    @mock.patch('get-cloudify._Inventory.for_interpreter')
+    def test_is_installed_scans_once(self, mock_for_interpreter):
+        mock_for_interpreter.return_value.has_module.return_value = True
+        installer = self.get_cloudify.CloudifyInstaller()
+        self.assertTrue(installer.is_installed('pip'))
+        self.assertTrue(installer.is_installed('virtualenv'))
+        self.assertEqual(1, mock_for_interpreter.call_count)
+
+    @mock.patch('get-cloudify.logger')
+    @mock.patch('get-cloudify.CloudifyInstaller')
+    @mock.patch('get-cloudify.parse_args')
+    def test_main_inventory(self, mock_parse_args, mock_installer,
+                            mock_logger):
+        env = self._make_site_packages(['cloudify-4.0.dist-info'])
+        mock_parse_args.return_value = {'quiet': False, 'verbose': False,
+                                        'inventory': True,
+                                        'virtualenv': env}
+        self.get_cloudify.main()
+        self.assertFalse(mock_installer.called)
+        self.assertIn('cloudify  4.0', mock_logger.info.call_args[0][0])
+
+    @mock.patch('get-cloudify.parse_args')
+    @mock.patch('sys.stderr', new_callable=StringIO)
+    def test_main_get_version_fast_path(self, mock_stderr, mock_parse_args):
+        with mock.patch('sys.argv', ['get-cloudify.py', '--get-version']):
+            self.assertRaises(SystemExit, self.get_cloudify.main)
+        self.assertEqual('{0}\n'.format(self.get_cloudify.version_str),
+                         mock_stderr.getvalue())
+        self.assertFalse(mock_parse_args.called)
+
+    def test_heavy_modules_imported_lazily(self):
+        # A fresh interpreter, as this one has imported everything already
+        check = (
+            'import importlib, sys\n'
+            'sys.path.insert(0, {0!r})\n'
+            'importlib.import_module("get-cloudify")\n'
+            'print(",".join(m for m in {1!r} if sys.modules.get(m)))'.format(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                ['argparse', 'urllib2', 'httplib', 'tarfile', 'subprocess',
+                 'tempfile', 'platform', 'BaseHTTPServer']))
+        result = self.get_cloudify._run('{0} -c {1}'.format(
+            sys.executable, pipes.quote(check)))
+        self.assertEqual(0, result.returncode)
+        self.assertEqual('', result.aggr_stdout.strip())
+
+    def test_noop_run_imports_only_argparse(self):
+        env = self._make_site_packages(['cloudify-4.0.dist-info'])
+        os.mkdir(os.path.join(env, 'bin'))
+        open(os.path.join(env, 'bin', 'activate'), 'w').close()
+        args = self.get_cloudify.parse_args(['--virtualenv', env])
+        params = inspect.getargspec(
+            self.get_cloudify.CloudifyInstaller.__init__)[0]
+        state = self.get_cloudify.CloudifyInstaller(
+            **dict((k, v) for k, v in args.items()
+                   if k in params)).get_requested_state()
+        state['installed_version'] = '4.0'
+        with open(os.path.join(env, self.get_cloudify.STATE_FILE), 'w') as f:
+            json.dump(state, f)
+        script = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            'get-cloudify.py')
+        check = (
+            'import runpy, sys\n'
+            'sys.argv = [{0!r}, "--virtualenv", {1!r}]\n'
+            'try:\n'
+            '    runpy.run_path(sys.argv[0], run_name="__main__")\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'sys.stderr.write(",".join(m for m in {2!r} '
+            'if sys.modules.get(m)))'.format(
+                script, env,
+                ['argparse', 'urllib2', 'httplib', 'tarfile', 'subprocess',
+                 'tempfile', 'platform', 'BaseHTTPServer']))
+        result = self.get_cloudify._run('{0} -c {1}'.format(
+            sys.executable, pipes.quote(check)))
+        self.assertEqual(0, result.returncode)
+        self.assertIn('nothing to do', result.aggr_stdout)
+        # Parsing the arguments still takes argparse
+        self.assertEqual('argparse', result.aggr_stderr.strip())
+
+    @mock.patch('get-cloudify._run')
+    def test_check_cloudify_installed_from_metadata(self, mock_run):
+        env = self._make_site_packages(['cloudify-4.0.dist-info'])
+        installer = self.get_cloudify.CloudifyInstaller(virtualenv=env)
+        self.assertTrue(installer.check_cloudify_installed())
+        self.assertEqual('4.0', installer.installed_version)
+        self.assertFalse(mock_run.called)
+
+    @mock.patch('get-cloudify._run')
+    def test_check_cloudify_installed_falls_back_to_python(self, mock_run):
+        mock_run.return_value.returncode = 0
+        env = self._make_site_packages(['cloudify.egg-link'])
+        bin_path = self.get_cloudify._get_env_bin_path(env)
+        os.mkdir(bin_path)
+        open(os.path.join(bin_path, 'python.exe'
+                          if self.get_cloudify.IS_WIN else 'python'),
+             'w').close()
+        installer = self.get_cloudify.CloudifyInstaller(virtualenv=env)
+        self.assertTrue(installer.check_cloudify_installed())
+        self.assertIsNone(installer.installed_version)
+        self.assertEqual(1, mock_run.call_count)
+
+    @mock.patch('get-cloudify._run')
+    def test_check_cloudify_installed_in_missing_venv(self, mock_run):
+        env = os.path.join(tempfile.mkdtemp(), 'env')
+        self.addCleanup(shutil.rmtree, os.path.dirname(env))
+        installer = self.get_cloudify.CloudifyInstaller(virtualenv=env)
+        self.assertFalse(installer.check_cloudify_installed())
+        self.assertFalse(mock_run.called)
+
     def test_check_cloudify_installed_in_venv(self):
         tmp_venv = tempfile.mkdtemp()
         # Handle windows and linux by using correct python path
@@ -808,10 +1501,56 @@ class CliBuilderUnitTests(testtools.TestCase):
         finally:
             shutil.rmtree(tmp_venv)
 
+    def _make_tar(self, names):
+        fd, archive = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, archive)
+        with tarfile.open(name=archive, mode='w:gz') as tar:
+            for name in names:
+                info = tarfile.TarInfo(name)
+                info.size = len(name)
+                tar.addfile(info, StringIO(name))
+        return archive
+
+    def test_untar_requirement_files(self):
+        archive = self._make_tar([
+            'cli-master/setup.py',
+            'cli-master/requirements.txt',
+            'cli-master/docs/requirements.txt',
+            'cli-master/dev-requirements.txt',
+            'cli-master/zzz/dev-requirements.txt',
+        ])
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+
+        self.get_cloudify._untar_requirement_files(archive, destination)
+
+        extracted = [os.path.relpath(os.path.join(root, f), destination)
+                     for root, _, files in os.walk(destination)
+                     for f in files]
+        self.assertEqual(
+            sorted([os.path.join('cli-master', 'requirements.txt'),
+                    os.path.join('cli-master', 'dev-requirements.txt')]),
+            sorted(extracted),
+        )
+        with open(os.path.join(destination, 'cli-master',
+                               'requirements.txt')) as f:
+            self.assertEqual('cli-master/requirements.txt', f.read())
+
+    def test_untar_requirement_files_at_root(self):
+        archive = self._make_tar(['./requirements.txt', './setup.py'])
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+
+        self.get_cloudify._untar_requirement_files(archive, destination)
+
+        self.assertEqual(['requirements.txt'], os.listdir(destination))
+
     def test_get_requirements_from_source_url(self):
-        def get(url, destination):
+        def get(url, destination, cache=None, mirror=None, sha256=None):
             return self._create_dummy_requirements_tar(url, destination)
 
+        download_file = self.get_cloudify._download_file
         self.get_cloudify._download_file = get
         try:
             installer = self.get_cloudify.CloudifyInstaller()
@@ -819,7 +1558,951 @@ class CliBuilderUnitTests(testtools.TestCase):
             self.assertEquals(len(req_list), 1)
             self.assertIn('dev-requirements.txt', req_list[0])
         finally:
-            self.get_cloudify._download_file = get_cloudify._download_file
+            self.get_cloudify._download_file = download_file
+
+    def test_get_requirements_from_source_archive(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        archive = self._create_dummy_requirements_tar(
+            None, os.path.join(tempdir, 'source.tar.gz'))
+
+        installer = self.get_cloudify.CloudifyInstaller()
+        req_list = installer._get_default_requirement_files(archive)
+        self.assertEquals(len(req_list), 1)
+        self.assertIn('dev-requirements.txt', req_list[0])
+        # The archive is the user's and must not be removed
+        self.assertTrue(os.path.isfile(archive))
+
+    @mock.patch('get-cloudify._install_package')
+    @mock.patch('get-cloudify.CloudifyInstaller.handle_upgrade')
+    def test_source_downloaded_once(self, mock_upgrade, mock_install):
+        downloads = []
+
+        def get(url, destination, cache=None, mirror=None, sha256=None):
+            downloads.append(url)
+            return self._create_dummy_requirements_tar(url, destination)
+
+        url = 'https://github.com/cloudify-cosmo/cloudify-cli/archive/' \
+              'master.tar.gz'
+        installer = self.get_cloudify.CloudifyInstaller(
+            source=url, with_requirements=[], no_cache=True)
+        with mock.patch('get-cloudify._download_file', side_effect=get):
+            installer.execute()
+
+        self.assertEqual([url], downloads)
+        kwargs = mock_install.call_args[1]
+        self.assertEqual('master.tar.gz',
+                         os.path.basename(kwargs['package']))
+        self.assertEqual(1, len(kwargs['requirement_files']))
+        self.assertIn('dev-requirements.txt',
+                      kwargs['requirement_files'][0])
+        # The downloaded archive is removed once installed
+        self.assertFalse(os.path.exists(kwargs['package']))
+
+    @mock.patch('get-cloudify._run')
+    def test_install_from_wheelhouse(self, mock_run):
+        type(mock_run.return_value).returncode = mock.PropertyMock(
+            return_value=0,
+        )
+        self.get_cloudify._install_package('test-package',
+                                           wheels_path='wheels')
+        mock_run.assert_called_once_with(
+            'pip install test-package --no-index --find-links wheels')
+
+    @mock.patch('get-cloudify._run')
+    def test_build_wheels(self, mock_run):
+        type(mock_run.return_value).returncode = mock.PropertyMock(
+            return_value=0,
+        )
+        self.get_cloudify._build_wheels('test-package', 'wheels',
+                                        version='1.0',
+                                        requirement_files=['req.txt'])
+        mock_run.assert_called_once_with(
+            'pip wheel --wheel-dir wheels -r req.txt test-package==1.0')
+
+    @mock.patch('get-cloudify._exit', side_effect=SystemExit)
+    @mock.patch('get-cloudify._run')
+    def test_build_wheels_failure(self, mock_run, mock_exit):
+        type(mock_run.return_value).returncode = mock.PropertyMock(
+            return_value=1,
+        )
+        self.assertRaises(SystemExit, self.get_cloudify._build_wheels,
+                          'test-package', 'wheels')
+        mock_exit.assert_called_once_with(
+            message='Could not build wheels for package: test-package.',
+            status='wheel_build_failure',
+        )
+
+    @mock.patch('get-cloudify._install_package')
+    @mock.patch('get-cloudify._build_wheels')
+    @mock.patch('get-cloudify.CloudifyInstaller.handle_upgrade')
+    def test_build_wheelhouse_then_install_from_it(self, mock_upgrade,
+                                                   mock_build, mock_install):
+        installer = self.get_cloudify.CloudifyInstaller(
+            source='cloudify-cli.tar.gz', with_requirements=['req.txt'],
+            build_wheelhouse='wheels', no_cache=True)
+        installer.execute()
+
+        build_kwargs = mock_build.call_args[1]
+        self.assertEqual('cloudify-cli.tar.gz', build_kwargs['package'])
+        self.assertEqual('wheels', build_kwargs['wheels_path'])
+        self.assertEqual(['req.txt'], build_kwargs['requirement_files'])
+        install_kwargs = mock_install.call_args[1]
+        self.assertEqual('cloudify', install_kwargs['package'])
+        self.assertEqual('wheels', install_kwargs['wheels_path'])
+        self.assertIsNone(install_kwargs['requirement_files'])
+
+    def test_wheelhouse_and_build_wheelhouse_invalid(self):
+        self.assertRaises(
+            self.get_cloudify.ArgumentCombinationInvalid,
+            self.get_cloudify.CloudifyInstaller,
+            wheelhouse='wheels', build_wheelhouse='wheels')
+
+    def _make_fake_virtualenv(self, path):
+        bin_path = os.path.join(path, 'bin')
+        site_packages = os.path.join(
+            path, 'lib', 'python2.7', 'site-packages')
+        os.makedirs(bin_path)
+        os.makedirs(os.path.join(site_packages, 'cloudify-4.0.dist-info'))
+        files = {
+            os.path.join(bin_path, 'activate'):
+                'VIRTUAL_ENV="{0}"\n'.format(path),
+            os.path.join(bin_path, 'cfy'):
+                '#!{0}/bin/python\n# -*- coding: utf-8 -*-\n'
+                '# Caf\xc3\xa9\nimport cloudify\n'.format(path),
+            os.path.join(bin_path, 'python'): '\0ELF{0}'.format(path),
+            os.path.join(site_packages, 'cloudify.egg-link'): path,
+            os.path.join(site_packages, 'cloudify.pyc'): '',
+        }
+        for file_path, content in files.items():
+            with open(file_path, 'w') as f:
+                f.write(content)
+        if not self.get_cloudify.IS_WIN:
+            os.chmod(os.path.join(bin_path, 'cfy'), 0o755)
+            os.mkdir(os.path.join(path, 'local'))
+            os.symlink(bin_path, os.path.join(path, 'local', 'bin'))
+
+    def test_virtualenv_snapshot_is_relocated(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        old = os.path.join(tempdir, 'old')
+        new = os.path.join(tempdir, 'new')
+        snapshot = os.path.join(tempdir, 'snapshot.tar.gz')
+        self._make_fake_virtualenv(old)
+
+        self.get_cloudify._pack_virtualenv(old, snapshot)
+        shutil.rmtree(old)
+        manifest = self.get_cloudify._unpack_virtualenv(snapshot, new)
+
+        self.assertEqual(old, manifest['prefix'])
+        self.assertEqual('4.0', manifest['cloudify_version'])
+        with open(os.path.join(new, 'bin', 'cfy')) as f:
+            self.assertEqual('#!{0}/bin/python\n'.format(new), f.readline())
+            # Non-ASCII text is kept as is
+            self.assertIn('# Caf\xc3\xa9\n', f.read())
+        with open(os.path.join(new, 'bin', 'activate')) as f:
+            self.assertIn(new, f.read())
+        # Binaries are left alone
+        with open(os.path.join(new, 'bin', 'python')) as f:
+            self.assertIn(old, f.read())
+        site_packages = os.path.join(new, 'lib', 'python2.7', 'site-packages')
+        with open(os.path.join(site_packages, 'cloudify.egg-link')) as f:
+            self.assertEqual(new, f.read())
+        self.assertFalse(
+            os.path.exists(os.path.join(site_packages, 'cloudify.pyc')))
+        if not self.get_cloudify.IS_WIN:
+            self.assertTrue(os.access(os.path.join(new, 'bin', 'cfy'),
+                                      os.X_OK))
+            self.assertEqual(os.path.join(new, 'bin'),
+                             os.readlink(os.path.join(new, 'local', 'bin')))
+
+    @mock.patch('get-cloudify._exit', side_effect=SystemExit)
+    def test_unpack_virtualenv_rejects_other_archives(self, mock_exit):
+        archive = self._make_tar(['requirements.txt'])
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+        self.assertRaises(SystemExit, self.get_cloudify._unpack_virtualenv,
+                          archive, destination)
+        self.assertEqual('dependency_extraction_failure',
+                         mock_exit.call_args[1]['status'])
+        self.assertEqual([], os.listdir(destination))
+
+    def _make_snapshot(self, members, prefix='/old/env'):
+        """Makes a snapshot of `members`, (name, type, linkname) tuples."""
+        fd, archive = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, archive)
+        manifest = json.dumps({'prefix': prefix,
+                               'platform': self.get_cloudify.PLATFORM})
+        with tarfile.open(name=archive, mode='w:gz') as tar:
+            info = tarfile.TarInfo(self.get_cloudify.SNAPSHOT_MANIFEST)
+            info.size = len(manifest)
+            tar.addfile(info, StringIO(manifest))
+            for name, member_type, linkname in members:
+                info = tarfile.TarInfo(name)
+                info.type = member_type
+                info.linkname = linkname
+                content = name if member_type == tarfile.REGTYPE else ''
+                info.size = len(content)
+                tar.addfile(info, StringIO(content))
+        return archive
+
+    @mock.patch('get-cloudify._exit', side_effect=SystemExit)
+    def test_unpack_virtualenv_rejects_symlink_escapes(self, mock_exit):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        snapshots = [
+            # Written through a symlink extracted earlier
+            [('evil', tarfile.SYMTYPE, outside),
+             ('evil/owned.txt', tarfile.REGTYPE, '')],
+            [('lib', tarfile.DIRTYPE, ''),
+             ('lib/evil', tarfile.SYMTYPE, '../..'),
+             ('lib/evil/owned.txt', tarfile.REGTYPE, '')],
+            # Links out of the virtualenv
+            [('evil', tarfile.SYMTYPE, outside)],
+            [('evil', tarfile.LNKTYPE,
+              os.path.join(outside, 'owned.txt'))],
+        ]
+        for members in snapshots:
+            destination = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, destination)
+            self.assertRaises(SystemExit,
+                              self.get_cloudify._unpack_virtualenv,
+                              self._make_snapshot(members), destination)
+            self.assertEqual('dependency_extraction_failure',
+                             mock_exit.call_args[1]['status'])
+            self.assertEqual([], os.listdir(outside))
+
+    @mock.patch('get-cloudify._relocate_virtualenv')
+    def test_unpack_virtualenv_allows_safe_links(self, mock_relocate):
+        stdlib = os.path.dirname(os.__file__)
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+        self.get_cloudify._unpack_virtualenv(self._make_snapshot([
+            ('bin', tarfile.DIRTYPE, ''),
+            ('bin/python', tarfile.REGTYPE, ''),
+            ('bin/python2', tarfile.SYMTYPE, 'python'),
+            ('bin/python2.7', tarfile.LNKTYPE, 'bin/python'),
+            ('local', tarfile.DIRTYPE, ''),
+            ('local/bin', tarfile.SYMTYPE, '/old/env/bin'),
+            ('os.py', tarfile.SYMTYPE, os.path.join(stdlib, 'os.py')),
+        ]), destination)
+        self.assertEqual(os.path.join(stdlib, 'os.py'),
+                         os.readlink(os.path.join(destination, 'os.py')))
+
+    @mock.patch('get-cloudify._install_package')
+    @mock.patch('get-cloudify._unpack_virtualenv')
+    def test_install_from_snapshot(self, mock_unpack, mock_install):
+        mock_unpack.return_value = {'cloudify_version': '4.0'}
+        snapshot = self._make_file('snapshot')
+        installer = self.get_cloudify.CloudifyInstaller(
+            virtualenv='venv', snapshot_in=snapshot)
+        installer.execute()
+
+        mock_unpack.assert_called_once_with(snapshot, 'venv')
+        self.assertFalse(mock_install.called)
+
+    def test_snapshot_requires_virtualenv(self):
+        self.assertRaises(
+            self.get_cloudify.ArgumentCombinationInvalid,
+            self.get_cloudify.CloudifyInstaller, snapshot_out='out.tar.gz')
+
+    def _make_state_virtualenv(self):
+        env = self._make_site_packages([])
+        os.mkdir(os.path.join(env, 'bin'))
+        open(os.path.join(env, 'bin', 'activate'), 'w').close()
+
+        def install(**kwargs):
+            dist_info = os.path.join(
+                env, 'lib', 'python2.7', 'site-packages',
+                'cloudify-{0}.dist-info'.format(kwargs['version'] or '4.0'))
+            if not os.path.isdir(dist_info):
+                os.mkdir(dist_info)
+        return env, install
+
+    @mock.patch('get-cloudify._install_package')
+    def test_rerun_with_same_request_is_skipped(self, mock_install):
+        env, mock_install.side_effect = self._make_state_virtualenv()
+        requirements = self._make_file('requests==2.7.0')
+        for _ in range(2):
+            self.get_cloudify.CloudifyInstaller(
+                virtualenv=env, with_requirements=[requirements],
+                source='cloudify-cli.tar.gz', no_cache=True).execute()
+
+        self.assertEqual(1, mock_install.call_count)
+        with open(os.path.join(env, self.get_cloudify.STATE_FILE)) as f:
+            state = json.load(f)
+        self.assertEqual('4.0', state['installed_version'])
+        self.assertEqual('cloudify-cli.tar.gz', state['source'])
+        self.assertEqual(
+            {requirements: self.get_cloudify._file_sha256(requirements)},
+            state['requirement_files'])
+
+    @mock.patch('get-cloudify._install_package')
+    def test_rerun_with_found_requirements_is_skipped(self, mock_install):
+        env, install = self._make_state_virtualenv()
+        requirement_files = []
+
+        def record_install(**kwargs):
+            requirement_files.append(kwargs['requirement_files'])
+            install(**kwargs)
+        mock_install.side_effect = record_install
+        with open(self._make_tar(['cli-master/requirements.txt']),
+                  'rb') as f:
+            archive = f.read()
+        with LocalHTTPServer(files={'/cli.tar.gz': archive}) as server:
+            for _ in range(3):
+                self.get_cloudify.CloudifyInstaller(
+                    virtualenv=env, with_requirements=[],
+                    source=server.url('/cli.tar.gz'),
+                    no_cache=True).execute()
+
+        self.assertEqual(1, mock_install.call_count)
+        self.assertEqual(['requirements.txt'],
+                         [os.path.basename(path)
+                          for path in requirement_files[0]])
+        with open(os.path.join(env, self.get_cloudify.STATE_FILE)) as f:
+            state = json.load(f)
+        self.assertTrue(state['find_requirements'])
+        self.assertEqual({}, state['requirement_files'])
+
+    @mock.patch('get-cloudify._install_package')
+    def test_rerun_with_changed_request_updates(self, mock_install):
+        env, mock_install.side_effect = self._make_state_virtualenv()
+        requirements = self._make_file('requests==2.7.0')
+        installer = self.get_cloudify.CloudifyInstaller(
+            virtualenv=env, with_requirements=[requirements],
+            source='cloudify-cli.tar.gz', no_cache=True)
+        installer.execute()
+        with open(requirements, 'w') as f:
+            f.write('requests==2.9.1')
+        mock_install.side_effect = None
+        # Does not exit even though cloudify is installed and --upgrade
+        # was not given, as the previous installation completed.
+        installer.execute()
+
+        self.assertEqual(2, mock_install.call_count)
+        self.assertFalse(mock_install.call_args_list[0][1]['force_reinstall'])
+        # pip would leave the installed package as it is otherwise
+        self.assertTrue(mock_install.call_args[1]['upgrade'])
+        self.assertTrue(mock_install.call_args[1]['force_reinstall'])
+
+    @mock.patch('get-cloudify._install_package')
+    def test_rerun_with_rebuilt_source_updates(self, mock_install):
+        env, mock_install.side_effect = self._make_state_virtualenv()
+        source = self._make_file('cli 4.0')
+        for content in ('cli 4.0', 'cli 4.0 rebuilt', 'cli 4.0 rebuilt'):
+            with open(source, 'w') as f:
+                f.write(content)
+            self.get_cloudify.CloudifyInstaller(
+                virtualenv=env, source=source, no_cache=True).execute()
+
+        self.assertEqual(2, mock_install.call_count)
+
+    @mock.patch('get-cloudify._exit', side_effect=SystemExit)
+    def test_installed_without_state_requires_upgrade(self, mock_exit):
+        env = self._make_site_packages(['cloudify-4.0.dist-info'])
+        installer = self.get_cloudify.CloudifyInstaller(virtualenv=env)
+        self.assertRaises(SystemExit, installer.execute)
+        mock_exit.assert_called_once_with(
+            message='Use the --upgrade flag to upgrade.',
+            status='cloudify_already_installed',
+        )
+
+    def test_parse_batch_file(self):
+        batch_file = self._make_file(
+            '# CLI versions\n'
+            'envs/3.3 3.3\n'
+            '\n'
+            'envs/master https://github.com/cloudify-cosmo/cloudify-cli/'
+            'archive/master.tar.gz\n'
+            'envs/latest\n')
+        self.assertEqual(
+            [{'virtualenv': 'envs/3.3', 'version': '3.3'},
+             {'virtualenv': 'envs/master',
+              'source': 'https://github.com/cloudify-cosmo/cloudify-cli/'
+                        'archive/master.tar.gz'},
+             {'virtualenv': 'envs/latest'}],
+            self.get_cloudify._parse_batch_file(batch_file))
+
+    def test_batch_installer(self):
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+        caches = []
+
+        def execute(installer):
+            with lock:
+                running.append(installer.virtualenv)
+                concurrency.append(len(running))
+                caches.append(installer.cache)
+            time.sleep(0.05)
+            with lock:
+                running.remove(installer.virtualenv)
+            if installer.version == 'bad':
+                self.get_cloudify._exit('Could not install package: bad.',
+                                        'dependency_installation_failure')
+
+        targets = [{'virtualenv': 'env{0}'.format(i),
+                    'version': '3.{0}'.format(i)} for i in range(5)]
+        targets.append({'virtualenv': 'env-bad', 'version': 'bad'})
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        batch = self.get_cloudify.BatchInstaller(
+            targets, workers=2, cache_dir=cache_dir, pip_args='--quiet')
+        with mock.patch('get-cloudify.CloudifyInstaller.execute', execute):
+            results = batch.execute()
+        batch.log_summary()
+
+        self.assertEqual([t['virtualenv'] for t in targets],
+                         [r['virtualenv'] for r in results])
+        self.assertEqual(['installed'] * 5 + ['failed'],
+                         [r['status'] for r in results])
+        self.assertEqual(222, results[-1]['exit_code'])
+        self.assertLessEqual(max(concurrency), 2)
+        self.assertTrue(all(cache is batch.cache for cache in caches))
+        self.assertTrue(all(r['duration'] > 0 for r in results))
+
+    def test_batch_requires_virtualenvs(self):
+        self.assertRaises(
+            self.get_cloudify.ArgumentCombinationInvalid,
+            self.get_cloudify.BatchInstaller, [{'version': '3.3'}])
+
+    def _make_fake_ssh(self, root):
+        """Returns ssh and scp commands that act on directories under
+        `root` instead of hosts. The host `unreachable` can't be reached.
+        """
+        ssh = os.path.join(root, 'ssh.py')
+        scp = os.path.join(root, 'scp.py')
+        with open(ssh, 'w') as f:
+            f.write(
+                'import os, subprocess, sys\n'
+                'host, command = sys.argv[1:]\n'
+                'if host == "unreachable":\n'
+                '    sys.exit("ssh: connect to host unreachable")\n'
+                'home = os.path.join({0!r}, host)\n'
+                'if not os.path.isdir(home):\n'
+                '    os.makedirs(home)\n'
+                'sys.exit(subprocess.call(command, shell=True, cwd=home))\n'
+                .format(root))
+        with open(scp, 'w') as f:
+            f.write(
+                'import os, shutil, sys\n'
+                'host, path = sys.argv[-1].split(":")\n'
+                'for source in sys.argv[2:-1]:\n'
+                '    shutil.copy(source, os.path.join({0!r}, host, path))\n'
+                .format(root))
+        return ('{0} {1}'.format(sys.executable, ssh),
+                '{0} {1}'.format(sys.executable, scp))
+
+    def test_fleet_installer(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        ssh, scp = self._make_fake_ssh(root)
+        source = self._make_file('source')
+        hosts = [{'host': 'host1'},
+                 {'host': 'unreachable'},
+                 {'host': 'host2', 'args': ['-q']}]
+        fleet = self.get_cloudify.FleetInstaller(
+            hosts, script_args=['--source', source, '--get-version'],
+            ssh_command=ssh, scp_command=scp, no_cache=True,
+            remote_python=sys.executable, workers=2)
+        with mock.patch('get-cloudify.logger') as mock_log:
+            results = fleet.execute()
+            fleet.log_summary()
+
+        self.assertEqual(['installed', 'failed', 'installed'],
+                         [r['status'] for r in results])
+        self.assertEqual('prepare exited with 1', results[1]['error'])
+        for host in ('host1', 'host2'):
+            remote_dir = os.path.join(
+                root, host, self.get_cloudify.FLEET_REMOTE_DIR)
+            self.assertEqual(
+                sorted(['get-cloudify.py', os.path.basename(source)]),
+                sorted(os.listdir(remote_dir)))
+        mock_log.info.assert_any_call('[host1] {0}'.format(
+            self.get_cloudify.version_str))
+        mock_log.info.assert_any_call('[host2] {0}'.format(
+            self.get_cloudify.version_str))
+
+    def test_fleet_stages_artifacts(self):
+        source = self._make_file('source')
+        fleet = self.get_cloudify.FleetInstaller([{'host': 'host1'}],
+                                                 no_cache=True)
+        self.assertEqual(
+            ['--version', '3.3', '-r', os.path.basename(source),
+             'https://example.com/requirements.txt', '-u',
+             '--source={0}'.format(os.path.basename(source))],
+            fleet.stage_artifacts(
+                ['--version', '3.3', '-r', source,
+                 'https://example.com/requirements.txt', '-u',
+                 '--source={0}'.format(source)], fleet.uploads))
+        self.assertEqual([fleet.script_path, source], fleet.uploads)
+
+    def test_fleet_stages_verified_downloads(self):
+        url_path = '/cli.tar.gz'
+        with LocalHTTPServer({url_path: 'source'}) as server:
+            for options in ({'sha256_digests': {server.url(url_path):
+                                                'a' * 64}},
+                            {'verify_downloads': True}):
+                fleet = self.get_cloudify.FleetInstaller(
+                    [{'host': 'host1'}], no_cache=True, **options)
+                ex = self.assertRaises(IOError, fleet.stage, '--source',
+                                       server.url(url_path), [])
+                self.assertIn('SHA-256', str(ex))
+                shutil.rmtree(fleet.staging_dir)
+
+    def test_fleet_stages_from_mirror(self):
+        url = 'https://example.com/cli.tar.gz'
+        fleet = self.get_cloudify.FleetInstaller(
+            [{'host': 'host1'}], no_cache=True, mirror='http://mirror:8000')
+        with mock.patch('get-cloudify._download_file') as mock_download:
+            self.assertEqual('cli.tar.gz',
+                             fleet.stage('--source', url, []))
+        self.addCleanup(shutil.rmtree, fleet.staging_dir)
+        self.assertEqual('http://mirror:8000',
+                         mock_download.call_args[1]['mirror'])
+
+    def test_fleet_uploads_host_artifacts_to_their_host(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        ssh, scp = self._make_fake_ssh(root)
+        shared = self._make_file('shared')
+        with LocalHTTPServer({'/a/cli.tar.gz': 'a',
+                              '/b/cli.tar.gz': 'b'}) as server:
+            hosts = [
+                {'host': 'host1',
+                 'args': ['--source', server.url('/a/cli.tar.gz')]},
+                {'host': 'host2',
+                 'args': ['--source', server.url('/b/cli.tar.gz')]},
+                {'host': 'host3',
+                 'args': ['--source', server.url('/missing.tar.gz')]},
+            ]
+            fleet = self.get_cloudify.FleetInstaller(
+                hosts, script_args=['--wheelhouse', shared, '--get-version'],
+                ssh_command=ssh, scp_command=scp, no_cache=True,
+                remote_python=sys.executable)
+            with mock.patch('get-cloudify.logger'):
+                results = fleet.execute()
+
+        self.assertEqual(['installed', 'installed', 'failed'],
+                         [r['status'] for r in results])
+        self.assertIn('Could not download', results[2]['error'])
+        for host, content in (('host1', 'a'), ('host2', 'b')):
+            remote_dir = os.path.join(
+                root, host, self.get_cloudify.FLEET_REMOTE_DIR)
+            self.assertEqual(
+                sorted(['get-cloudify.py', os.path.basename(shared),
+                        'cli.tar.gz']),
+                sorted(os.listdir(remote_dir)))
+            with open(os.path.join(remote_dir, 'cli.tar.gz')) as f:
+                self.assertEqual(content, f.read())
+        self.assertEqual([fleet.script_path, shared], fleet.uploads)
+        self.assertFalse(os.path.exists(os.path.join(root, 'host3')))
+
+    def test_fleet_exits_if_shared_artifact_fails(self):
+        with LocalHTTPServer({}) as server:
+            fleet = self.get_cloudify.FleetInstaller(
+                [{'host': 'host1'}], no_cache=True,
+                script_args=['--source', server.url('/missing.tar.gz')])
+            with mock.patch('get-cloudify.logger') as mock_log:
+                ex = self.assertRaises(SystemExit, fleet.execute)
+        self.assertEqual(220, ex.code)
+        self.assertIn('Could not download', mock_log.error.call_args[0][0])
+        self.assertFalse(os.path.exists(fleet.staging_dir))
+
+    def test_get_fleet_script_args(self):
+        self.assertEqual(
+            ['-u', '--version', '3.3'],
+            self.get_cloudify._get_fleet_script_args(
+                ['--fleet', 'hosts', '-u', '--fleet-workers=5',
+                 '--ssh-command', 'ssh -i key', '--profile',
+                 '--version', '3.3']))
+
+    def test_parse_inventory(self):
+        inventory = self._make_file(
+            '# staging\n'
+            'admin@host1\n'
+            '\n'
+            'host2 --version 3.3 --pip-args "--quiet --no-cache-dir"\n')
+        self.assertEqual(
+            [{'host': 'admin@host1', 'args': []},
+             {'host': 'host2',
+              'args': ['--version', '3.3', '--pip-args',
+                       '--quiet --no-cache-dir']}],
+            self.get_cloudify._parse_inventory(inventory))
+
+    def _start_mirror(self, cache=None, wheelhouse=None):
+        server = self.get_cloudify._make_mirror_server(('127.0.0.1', 0), cache,
+                                                       wheelhouse)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+    def test_download_from_mirror(self):
+        url = 'http://origin.invalid/cloudify-cli.tar.gz'
+        mirror_cache = self._make_cache()
+        mirror_cache.store(url, self._make_file('source'),
+                           hashlib.sha256('source').hexdigest())
+        mirror = self._start_mirror(cache=mirror_cache)
+        cache = self._make_cache()
+        destination = self._make_file('')
+
+        self.get_cloudify._download_file(url, destination, cache=cache,
+                                         mirror=mirror)
+
+        with open(destination) as f:
+            self.assertEqual('source', f.read())
+        # Kept in the local cache under the original URL
+        self.assertIsNotNone(cache.lookup(url))
+
+    def test_download_falls_back_from_mirror(self):
+        mirror = self._start_mirror(cache=self._make_cache())
+        destination = self._make_file('')
+        with LocalHTTPServer(files={'/file': 'origin'}) as server:
+            self.get_cloudify._download_file(server.url('/file'),
+                                             destination, mirror=mirror)
+        with open(destination) as f:
+            self.assertEqual('origin', f.read())
+
+    def test_mirror_serves_wheelhouse(self):
+        wheelhouse = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, wheelhouse)
+        with open(os.path.join(wheelhouse,
+                               'cloudify-3.4-py27-none-any.whl'), 'w') as f:
+            f.write('wheel')
+        mirror = self._start_mirror(wheelhouse=wheelhouse)
+
+        index = urllib2.urlopen(mirror + '/wheels/').read()
+        self.assertIn('href="cloudify-3.4-py27-none-any.whl"', index)
+        self.assertEqual('wheel', urllib2.urlopen(
+            mirror + '/wheels/cloudify-3.4-py27-none-any.whl').read())
+        self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                          mirror + '/wheels/..%2Fsecret')
+
+    @mock.patch('get-cloudify._run')
+    def test_install_with_mirror(self, mock_run):
+        type(mock_run.return_value).returncode = mock.PropertyMock(
+            return_value=0,
+        )
+        self.get_cloudify._install_package('test-package',
+                                           mirror='http://mirror:8080/')
+        mock_run.assert_called_once_with(
+            'pip install test-package --find-links http://mirror:8080/wheels/')
+
+    @mock.patch('get-cloudify._run')
+    def test_install_with_force_reinstall(self, mock_run):
+        type(mock_run.return_value).returncode = mock.PropertyMock(
+            return_value=0,
+        )
+        self.get_cloudify._install_package('test-package', upgrade=True,
+                                           force_reinstall=True)
+        mock_run.assert_called_once_with(
+            'pip install test-package --upgrade --force-reinstall')
+
+    def test_download_manager_prefetch(self):
+        downloads = self.get_cloudify._DownloadManager()
+        destination = self._make_file('')
+        with LocalHTTPServer(files={'/a': 'a', '/b': 'b'}) as server:
+            downloads.prefetch(server.url('/a'))
+            downloads.prefetch(server.url('/b'))
+            downloads.prefetch(server.url('/a'))
+            downloads.fetch(server.url('/a'), destination)
+            downloads.fetch(server.url('/b'), self._make_file(''))
+            self.assertEqual(2, len(server.requests))
+        with open(destination) as f:
+            self.assertEqual('a', f.read())
+        prefetched = downloads.path
+        downloads.cleanup()
+        self.assertFalse(os.path.exists(prefetched))
+
+    def test_download_manager_raises_on_fetch(self):
+        downloads = self.get_cloudify._DownloadManager()
+        with LocalHTTPServer() as server:
+            downloads.prefetch(server.url('/missing'))
+            self.assertRaises(urllib2.HTTPError, downloads.fetch,
+                              server.url('/missing'), self._make_file(''))
+        downloads.cleanup()
+
+    def test_download_manager_fetch_without_prefetch(self):
+        downloads = self.get_cloudify._DownloadManager()
+        destination = self._make_file('')
+        with LocalHTTPServer(files={'/a': 'a'}) as server:
+            downloads.fetch(server.url('/a'), destination)
+        with open(destination) as f:
+            self.assertEqual('a', f.read())
+        self.assertIsNone(downloads.path)
+
+    @mock.patch('get-cloudify._install_package')
+    @mock.patch('get-cloudify.CloudifyInstaller.handle_upgrade')
+    @mock.patch('get-cloudify.CloudifyInstaller.is_installed',
+                return_value=False)
+    def test_downloads_prefetched_up_front(self, mock_installed,
+                                           mock_upgrade, mock_install):
+        url = 'https://github.com/cloudify-cosmo/cloudify-cli/archive/' \
+              'master.tar.gz'
+        installer = self.get_cloudify.CloudifyInstaller(
+            source=url, with_requirements=[], install_pip=True,
+            no_cache=True)
+        prefetched = []
+
+        def get(url, destination, cache=None, mirror=None, sha256=None):
+            return self._create_dummy_requirements_tar(url, destination)
+
+        with mock.patch.object(installer.downloads, 'prefetch',
+                               prefetched.append):
+            with mock.patch.object(installer, 'get_pip') as mock_get_pip:
+                mock_get_pip.side_effect = lambda: self.assertEqual(
+                    [self.get_cloudify.PIP_URL, url], prefetched)
+                with mock.patch('get-cloudify._download_file',
+                                side_effect=get):
+                    installer.execute()
+        self.assertTrue(mock_get_pip.called)
+
+    def test_download_verifies_sha256(self):
+        cache = self._make_cache()
+        destination = self._make_file('')
+        os.remove(destination)
+        digest = hashlib.sha256('content').hexdigest()
+        with LocalHTTPServer(files={'/file': 'content'}) as server:
+            self.assertRaises(
+                self.get_cloudify._IntegrityError,
+                self.get_cloudify._download_file,
+                server.url('/file'), destination, cache=cache,
+                sha256=hashlib.sha256('other').hexdigest())
+            self.assertFalse(os.path.exists(destination))
+            self.assertFalse(os.path.exists(destination + '.part'))
+            self.assertIsNone(cache.lookup(server.url('/file')))
+
+            self.get_cloudify._download_file(
+                server.url('/file'), destination, cache=cache,
+                sha256=digest.upper())
+            # Cached copies are checked against the digest too
+            self.assertRaises(
+                self.get_cloudify._IntegrityError,
+                self.get_cloudify._download_file,
+                server.url('/file'), destination, cache=cache,
+                sha256=hashlib.sha256('other').hexdigest())
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+
+    def test_download_verifies_local_sha256(self):
+        source = self._make_file('content')
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        destination = os.path.join(tempdir, 'destination')
+        self.assertRaises(
+            self.get_cloudify._IntegrityError,
+            self.get_cloudify._download_file, source, destination,
+            sha256=hashlib.sha256('other').hexdigest())
+        self.assertFalse(os.path.exists(destination))
+
+    def test_download_manager_verifies_sidecar(self):
+        digest = hashlib.sha256('content').hexdigest()
+        downloads = self.get_cloudify._DownloadManager(verify=True)
+        destination = self._make_file('')
+        files = {
+            '/good': 'content',
+            '/good.sha256': '{0}  good\n'.format(digest),
+            '/bad': 'tampered',
+            '/bad.sha256': digest,
+            '/unpublished': 'content',
+        }
+        with LocalHTTPServer(files=files) as server:
+            downloads.fetch(server.url('/good'), destination)
+            for path in ('/bad', '/unpublished'):
+                self.assertRaises(self.get_cloudify._IntegrityError,
+                                  downloads.fetch, server.url(path),
+                                  destination)
+            # Pinned digests don't need a sidecar
+            downloads.digests[server.url('/unpublished')] = digest
+            downloads.fetch(server.url('/unpublished'), destination)
+
+    def test_parse_sha256_args(self):
+        digest = hashlib.sha256('content').hexdigest()
+        args = self.get_cloudify.parse_args(
+            ['--sha256', 'https://example.com/a=b.tar.gz={0}'.format(digest)])
+        self.assertEqual({'https://example.com/a=b.tar.gz': digest},
+                         args['sha256_digests'])
+        self.assertRaises(SystemExit, self.get_cloudify.parse_args,
+                          ['--sha256', 'https://example.com/a.tar.gz'])
+
+    def test_profiler_records_commands(self):
+        profiler = self.get_cloudify._Profiler()
+        with mock.patch('get-cloudify._profiler', profiler):
+            self.get_cloudify._run('echo Hi!')
+
+        self.assertEqual(1, len(profiler.records))
+        self.assertEqual('command', profiler.records[0]['kind'])
+        self.assertEqual('echo Hi!', profiler.records[0]['name'])
+        self.assertIn('echo Hi!', profiler.report())
+
+    @mock.patch('get-cloudify._run')
+    def test_profiler_records_phases(self, mock_run):
+        type(mock_run.return_value).returncode = mock.PropertyMock(
+            return_value=0,
+        )
+        profiler = self.get_cloudify._Profiler()
+        with mock.patch('get-cloudify._profiler', profiler):
+            self.get_cloudify._install_package('test-package')
+
+        self.assertEqual([('phase', '_install_package')],
+                         [(r['kind'], r['name']) for r in profiler.records])
+
+    def test_profiler_records_failures(self):
+        profiler = self.get_cloudify._Profiler()
+
+        def fail():
+            with profiler.measure('phase', 'failing'):
+                raise SystemExit(1)
+
+        self.assertRaises(SystemExit, fail)
+        self.assertEqual('failing', profiler.records[0]['name'])
+
+    def test_profiler_dump(self):
+        profiler = self.get_cloudify._Profiler()
+        with profiler.measure('download', 'http://example.com'):
+            pass
+        path = self._make_file('')
+        profiler.dump(path)
+
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(self.get_cloudify.version_str, report['version'])
+        self.assertEqual(['http://example.com'],
+                         [r['name'] for r in report['records']])
+
+    @mock.patch('get-cloudify.logger')
+    @mock.patch('get-cloudify.CloudifyInstaller')
+    @mock.patch('get-cloudify._exit')
+    def test_main_profile_output_on_failure(self,
+                                            mock_exit,
+                                            mock_installer,
+                                            mock_log):
+        mock_installer().execute.side_effect = SystemExit
+        path = self._make_file('')
+        with mock.patch('get-cloudify.parse_args', return_value={
+                'quiet': False,
+                'verbose': False,
+                'profile': True,
+                'profile_output': path}):
+            self.assertRaises(SystemExit, self.get_cloudify.main)
+
+        with open(path) as f:
+            self.assertIn('records', json.load(f))
+
+    def test_step_scheduler_runs_independent_steps_concurrently(self):
+        events = [threading.Event(), threading.Event()]
+        results = []
+
+        def step(mine, other):
+            events[mine].set()
+            results.append(events[other].wait(5))
+
+        steps = self.get_cloudify._StepScheduler()
+        steps.add('a', lambda: step(0, 1))
+        steps.add('b', lambda: step(1, 0))
+        steps.run()
+
+        self.assertEqual([True, True], results)
+
+    def test_step_scheduler_respects_requirements(self):
+        order = []
+        steps = self.get_cloudify._StepScheduler()
+        steps.add('c', lambda: order.append('c'), requires=['a', 'b'])
+        steps.add('b', lambda: order.append('b'), requires=['a'])
+        steps.add('a', lambda: order.append('a'), requires=['missing'])
+        steps.run()
+
+        self.assertEqual(['a', 'b', 'c'], order)
+        self.assertEqual(['a', 'b', 'c'], steps.critical_path())
+
+    def test_step_scheduler_raises_step_errors(self):
+        order = []
+
+        def fail():
+            sys.exit(222)
+
+        steps = self.get_cloudify._StepScheduler()
+        steps.add('a', fail)
+        steps.add('b', lambda: order.append('b'), requires=['a'])
+        ex = self.assertRaises(SystemExit, steps.run)
+
+        self.assertEqual(222, ex.code)
+        self.assertEqual([], order)
+
+    def test_waits_for_threads_can_be_interrupted(self):
+        if self.get_cloudify.IS_WIN:
+            self.skipTest('Relies on SIGINT')
+        release = threading.Event()
+        blocked = []
+
+        def block(*args, **kwargs):
+            blocked.append(threading.current_thread())
+            release.wait(10)
+
+        def unblock():
+            release.set()
+            for thread in blocked:
+                thread.join()
+        self.addCleanup(unblock)
+
+        def scheduled():
+            steps = self.get_cloudify._StepScheduler()
+            steps.add('block', block)
+            steps.run()
+
+        def prefetched():
+            downloads = self.get_cloudify._DownloadManager()
+            self.addCleanup(downloads.cleanup)
+            with mock.patch('get-cloudify._download_file', block):
+                downloads.prefetch('http://example.com/file')
+                downloads.fetch('http://example.com/file', 'file')
+
+        def pooled():
+            self.get_cloudify._run_pool(block, [1], 1)
+
+        for wait in (scheduled, prefetched, pooled):
+            timer = threading.Timer(0.2, os.kill,
+                                    (os.getpid(), signal.SIGINT))
+            timer.start()
+            start = time.time()
+            self.assertRaises(KeyboardInterrupt, wait)
+            timer.join()
+            self.assertLess(time.time() - start, 3, wait.__name__)
+
+    def test_step_scheduler_keeps_step_tracebacks(self):
+        def fail_in_step():
+            raise IOError('step failed')
+
+        steps = self.get_cloudify._StepScheduler()
+        steps.add('a', fail_in_step)
+        try:
+            steps.run()
+        except IOError:
+            frames = traceback.extract_tb(sys.exc_info()[2])
+        else:
+            self.fail('The step error was not raised')
+        self.assertEqual('fail_in_step', frames[-1][2])
+
+    def test_step_scheduler_critical_path(self):
+        steps = self.get_cloudify._StepScheduler()
+        steps.add('pip', None)
+        steps.add('pythondev', None)
+        steps.add('environment', None, requires=['pip', 'pythondev'])
+        steps.add('source', None)
+        steps.timings = {
+            'pip': (0, 2),
+            'pythondev': (0, 5),
+            'environment': (5, 7),
+            'source': (0, 3),
+        }
+
+        self.assertEqual(['pythondev', 'environment'],
+                         steps.critical_path())
 
     def test_get_requirements_from_source_path(self):
         tempdir = tempfile.mkdtemp()
@@ -854,6 +2537,26 @@ class TestArgParser(testtools.TestCase):
             'with_requirements': None,
             'upgrade': False,
             'pip_args': None,
+            'cache_dir': get_cloudify.DEFAULT_CACHE_DIR,
+            'no_cache': False,
+            'build_wheelhouse': None,
+            'wheelhouse': None,
+            'snapshot_in': None,
+            'snapshot_out': None,
+            'batch': None,
+            'batch_workers': get_cloudify.DEFAULT_BATCH_WORKERS,
+            'sha256_digests': None,
+            'verify_downloads': False,
+            'mirror': None,
+            'serve_mirror': None,
+            'fleet': None,
+            'fleet_workers': get_cloudify.DEFAULT_FLEET_WORKERS,
+            'fleet_python': 'python',
+            'ssh_command': get_cloudify.DEFAULT_SSH_COMMAND,
+            'scp_command': get_cloudify.DEFAULT_SCP_COMMAND,
+            'profile': False,
+            'profile_output': None,
+            'inventory': False,
         }
 
         self.expected_repo_url = \
@@ -1103,7 +2806,7 @@ class TestArgParser(testtools.TestCase):
     @mock.patch('get-cloudify.IS_LINUX')
     @mock.patch('get-cloudify.IS_WIN')
     @mock.patch('get-cloudify.IS_DARWIN')
-    @mock.patch('get-cloudify.argparse.ArgumentParser.error',
+    @mock.patch('argparse.ArgumentParser.error',
                 side_effect=SystemExit)
     def test_with_requirements_alone_fails(self,
                                            mock_parse_error,
@@ -1220,7 +2923,7 @@ class TestArgParser(testtools.TestCase):
     @mock.patch('get-cloudify.IS_LINUX')
     @mock.patch('get-cloudify.IS_WIN')
     @mock.patch('get-cloudify.IS_DARWIN')
-    @mock.patch('get-cloudify.argparse.ArgumentParser.error',
+    @mock.patch('argparse.ArgumentParser.error',
                 side_effect=SystemExit)
     def test_use_branch_invalid_format(self,
                                        mock_parse_error,
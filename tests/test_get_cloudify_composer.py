@@ -0,0 +1,289 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+import hashlib
+import importlib
+import mock
+import os
+import shutil
+from StringIO import StringIO
+import sys
+import tarfile
+import tempfile
+import testtools
+
+from test_get_cloudify import LocalHTTPServer
+
+sys.path.append("../")
+
+composer = importlib.import_module('get-cloudify-composer')
+
+
+class ComposerUnitTests(testtools.TestCase):
+    """Unit tests for functions in get-cloudify-composer.py"""
+
+    def setUp(self):
+        super(ComposerUnitTests, self).setUp()
+        self.composer = composer
+
+    def test_import(self):
+        module = importlib.import_module('get-cloudify-composer')
+        self.assertIs(composer, module)
+        self.assertTrue(callable(module.parse_args))
+        self.assertIsNotNone(module.lgr)
+
+    @mock.patch('get-cloudify-composer.IS_LINUX', True)
+    def test_detect_os_props(self):
+        releases = [
+            ('ID="rhel"\nVERSION_ID="7.2"\n', ('redhat', '7.2')),
+            ('ID="ol"\nID_LIKE="fedora"\nVERSION_ID="7.9"\n',
+             ('redhat', '7.9')),
+            ('ID="rocky"\nID_LIKE="rhel centos fedora"\nVERSION_ID="8.5"\n',
+             ('redhat', '8.5')),
+            ('ID=linuxmint\nID_LIKE="ubuntu debian"\nVERSION_ID="20.3"\n',
+             ('debian', '20.3')),
+            ('ID=ubuntu\nID_LIKE=debian\nVERSION_ID="16.04"\n',
+             ('ubuntu', '16.04')),
+        ]
+        for os_release, expected in releases:
+            root = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, root)
+            os.mkdir(os.path.join(root, 'etc'))
+            with open(os.path.join(root, 'etc', 'os-release'), 'w') as f:
+                f.write(os_release)
+            self.assertEqual(expected, self.composer.detect_os_props(root))
+
+    def _make_member(self, name, type=tarfile.REGTYPE, linkname=''):
+        member = tarfile.TarInfo(name)
+        member.type = type
+        member.linkname = linkname
+        return member
+
+    def test_strip_leading_components(self):
+        members = [
+            self._make_member('node-v6/', tarfile.DIRTYPE),
+            self._make_member('node-v6/bin', tarfile.DIRTYPE),
+            self._make_member('node-v6/bin/node'),
+            self._make_member('./node-v6/README.md'),
+        ]
+        self.assertEqual(
+            ['bin', 'bin/node', 'README.md'],
+            [m.name for m in self.composer.strip_leading_components(
+                members, 1)])
+
+    def test_strip_leading_components_of_hard_links(self):
+        members = [
+            self._make_member('node-v6/bin/node'),
+            self._make_member('node-v6/bin/nodejs', tarfile.LNKTYPE,
+                              linkname='node-v6/bin/node'),
+            self._make_member('node-v6/bin/npm', tarfile.SYMTYPE,
+                              linkname='../lib/npm-cli.js'),
+        ]
+        stripped = list(self.composer.strip_leading_components(members, 1))
+        self.assertEqual(['bin/node', 'bin/nodejs', 'bin/npm'],
+                         [m.name for m in stripped])
+        self.assertEqual('bin/node', stripped[1].linkname)
+        # Symbolic links are relative to the link, so they are kept as is
+        self.assertEqual('../lib/npm-cli.js', stripped[2].linkname)
+
+    def test_strip_no_components(self):
+        members = [self._make_member('node-v6/bin/node')]
+        self.assertEqual(
+            ['node-v6/bin/node'],
+            [m.name for m in self.composer.strip_leading_components(
+                members, 0)])
+
+    def test_untar_strips_components(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        archive = os.path.join(tempdir, 'node.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            tar.addfile(self._make_member('node-v6', tarfile.DIRTYPE))
+            node = self._make_member('node-v6/bin/node')
+            node.size = 4
+            tar.addfile(node, StringIO('node'))
+            tar.addfile(self._make_member(
+                'node-v6/bin/nodejs', tarfile.LNKTYPE,
+                linkname='node-v6/bin/node'))
+        destination = os.path.join(tempdir, 'nodejs')
+
+        self.composer.untar(archive, destination, strip_components=1)
+
+        self.assertEqual(['bin'], os.listdir(destination))
+        self.assertEqual(['node', 'nodejs'],
+                         sorted(os.listdir(os.path.join(destination, 'bin'))))
+        with open(os.path.join(destination, 'bin', 'nodejs')) as f:
+            self.assertEqual('node', f.read())
+
+    def test_run_concurrently(self):
+        called = []
+
+        def succeed():
+            called.append('succeed')
+
+        def fail():
+            called.append('fail')
+            raise IOError('download failed')
+
+        def exit():
+            called.append('exit')
+            sys.exit('exited')
+
+        failures = self.composer.run_concurrently([succeed, fail, exit])
+
+        self.assertEqual(['exit', 'fail', 'succeed'], sorted(called))
+        self.assertEqual([exit, fail],
+                         sorted([func for func, _ in failures],
+                                key=lambda func: func.__name__))
+        errors = dict((func, exc_info) for func, exc_info in failures)
+        self.assertIsInstance(errors[fail][1], IOError)
+        self.assertIsInstance(errors[exit][1], SystemExit)
+
+    def test_run_concurrently_without_failures(self):
+        self.assertEqual([], self.composer.run_concurrently([lambda: None]))
+
+    def test_failed_install_is_removed(self):
+        home = os.path.join(tempfile.mkdtemp(), 'cloudify-composer')
+        self.addCleanup(shutil.rmtree, os.path.dirname(home))
+
+        def install_nodejs():
+            open(os.path.join(home, 'nodejs'), 'w').close()
+
+        def install_composer():
+            raise IOError('download failed')
+
+        installer = self.composer.ComposerInstaller()
+        with mock.patch.object(self.composer.ComposerInstaller, 'HOME',
+                               home):
+            with mock.patch.multiple(installer,
+                                     install_nodejs=install_nodejs,
+                                     install_composer=install_composer,
+                                     install_dsl_parser=mock.Mock(
+                                         __name__='install_dsl_parser')):
+                with mock.patch('get-cloudify-composer.lgr') as mock_log:
+                    ex = self.assertRaises(IOError, installer.execute)
+
+        self.assertEqual('download failed', str(ex))
+        self.assertFalse(os.path.exists(home))
+        mock_log.error.assert_called_once_with(
+            'install_composer failed: download failed')
+
+    def _make_archive(self, files):
+        """Returns a tar.gz of `files` ({name: content}) under a top level
+        directory, like node.js archives.
+        """
+        archive = StringIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            tar.addfile(self._make_member('node-v6', tarfile.DIRTYPE))
+            for name, content in sorted(files.items()):
+                member = self._make_member('node-v6/{0}'.format(name))
+                member.size = len(content)
+                tar.addfile(member, StringIO(content))
+        return archive.getvalue()
+
+    def _assert_tree(self, destination, files):
+        for name, content in files.items():
+            with open(os.path.join(destination, name), 'rb') as f:
+                self.assertEqual(content, f.read())
+
+    def test_extract_source_streams_url(self):
+        files = {'bin/node': os.urandom(1024), 'README.md': 'node'}
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+        installer = self.composer.ComposerInstaller()
+        with LocalHTTPServer({'/node.tar.gz': self._make_archive(files)},
+                             ranges=True) as server:
+            with mock.patch('get-cloudify-composer.download_file') as \
+                    mock_download:
+                installer.extract_source(server.url('/node.tar.gz'),
+                                         destination, strip_components=1)
+
+        self._assert_tree(destination, files)
+        self.assertFalse(mock_download.called)
+        self.assertEqual(1, len(server.requests))
+
+    def test_extract_source_falls_back_to_download(self):
+        files = {'bin/node': os.urandom(512 * 1024), 'README.md': 'node'}
+        destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, destination)
+        installer = self.composer.ComposerInstaller()
+        with LocalHTTPServer({'/node.tar.gz': self._make_archive(files)},
+                             ranges=True,
+                             truncate={'/node.tar.gz': 64 * 1024}) as server:
+            with mock.patch('get-cloudify-composer.lgr') as mock_log:
+                installer.extract_source(server.url('/node.tar.gz'),
+                                         destination, strip_components=1)
+
+        self._assert_tree(destination, files)
+        self.assertEqual(2, len(server.requests))
+        self.assertIn('Downloading it first',
+                      mock_log.warning.call_args[0][0])
+
+    def test_download_file_resumes_interrupted_download(self):
+        content = os.urandom(1024 * 1024)
+        destination = os.path.join(tempfile.mkdtemp(), 'file')
+        self.addCleanup(shutil.rmtree, os.path.dirname(destination))
+        with LocalHTTPServer({'/file': content}, ranges=True,
+                             truncate={'/file': 1000}) as server:
+            self.composer.download_file(server.url('/file'), destination)
+
+        with open(destination, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual('bytes=1000-1048575',
+                         server.requests[1][1]['range'])
+        self.assertEqual(['file'], os.listdir(os.path.dirname(destination)))
+
+    def test_download_file_resumes_partial_file(self):
+        destination = os.path.join(tempfile.mkdtemp(), 'file')
+        self.addCleanup(shutil.rmtree, os.path.dirname(destination))
+        with open(destination + '.part', 'w') as f:
+            f.write('cont')
+        with open(destination + '.part.validator', 'w') as f:
+            f.write('"{0}"'.format(hashlib.sha256('content').hexdigest()))
+        with LocalHTTPServer({'/file': 'content'}, ranges=True) as server:
+            self.composer.download_file(server.url('/file'), destination)
+
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+        self.assertEqual('bytes=4-', server.requests[0][1]['range'])
+
+    def test_download_file_restarts_changed_partial_file(self):
+        destination = os.path.join(tempfile.mkdtemp(), 'file')
+        self.addCleanup(shutil.rmtree, os.path.dirname(destination))
+        with open(destination + '.part', 'w') as f:
+            f.write('old c')
+        with open(destination + '.part.validator', 'w') as f:
+            f.write('"{0}"'.format(hashlib.sha256('old content').hexdigest()))
+        with LocalHTTPServer({'/file': 'new content'}, ranges=True) as server:
+            self.composer.download_file(server.url('/file'), destination)
+
+        with open(destination) as f:
+            self.assertEqual('new content', f.read())
+
+    @mock.patch('get-cloudify-composer.MIN_SEGMENTED_SIZE', 1024)
+    def test_download_file_in_segments(self):
+        content = os.urandom(64 * 1024)
+        destination = os.path.join(tempfile.mkdtemp(), 'file')
+        self.addCleanup(shutil.rmtree, os.path.dirname(destination))
+        with LocalHTTPServer({'/file': content}, ranges=True) as server:
+            self.composer.download_file(server.url('/file'), destination,
+                                        segments=4)
+
+        with open(destination, 'rb') as f:
+            self.assertEqual(content, f.read())
+        ranges = sorted(headers['range'] for _, headers in server.requests
+                        if 'range' in headers)
+        self.assertEqual(['bytes=0-16383', 'bytes=16384-32767',
+                          'bytes=32768-49151', 'bytes=49152-65535'], ranges)